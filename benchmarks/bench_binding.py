@@ -0,0 +1,235 @@
+# -----------------------------------------------------------------------------
+# PyLg: module to facilitate and automate the process of writing runtime logs.
+# Copyright (C) 2017 Wojciech Kozlowski <wk@wojciechkozlowski.eu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+
+""" Benchmark for building the ENTRY message of a traced call.
+
+    Usage:
+
+        python benchmarks/bench_binding.py [--number N] [--repeat N]
+
+    Compares the BindingPlan used by TraceFunction with the argspec
+    lookup it replaced: the argument names were walked by index and
+    the defaults looked up in a dictionary on every call. The old path
+    only supports plain positional parameters with defaults. It is not
+    timed on the calls it fails on or logs incorrectly.
+
+    Every message built by the plan is first checked against the
+    arguments the function is actually called with, and the benchmark
+    stops if they differ.
+"""
+
+import argparse
+import inspect
+import time
+import sys
+import os
+
+# -----------------------------------------------------------------------------
+# Always test the PyLg in this source tree.
+# -----------------------------------------------------------------------------
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pylg.pylg as pylg_module
+from pylg.pylg import BindingPlan, entry_message, get_value_string
+
+
+class ArgspecStruct(object):
+
+    """ The function properties kept by the argspec path.
+    """
+
+    def __init__(self, function):
+        argspec = inspect.getfullargspec(function)
+
+        self.varnames = argspec.args
+        self.defaults = None
+        if argspec.defaults is not None:
+            self.defaults = dict(zip(argspec.args[-len(argspec.defaults):],
+                                     argspec.defaults))
+
+
+def argspec_entry_message(function, args, kwargs):
+
+    """ The ENTRY message as built by the argspec path.
+    """
+
+    msg = "-> ENTRY"
+    if args or kwargs:
+        msg += ": "
+
+        n_args = len(args)
+        for arg in range(n_args):
+
+            if not pylg_module.TRACE_SELF and function.varnames[arg] == "self":
+                continue
+
+            msg += (function.varnames[arg] + " = " +
+                    get_value_string(args[arg]) + ", ")
+
+        for name in function.varnames[n_args:]:
+            msg += name + " = "
+            if name in kwargs:
+                value = kwargs[name]
+            else:
+                value = function.defaults[name]
+            msg += get_value_string(value) + ", "
+
+        msg = msg[:-2]
+
+    return msg
+
+
+class PlanStruct(object):
+
+    """ The function properties kept by TraceFunction.
+    """
+
+    def __init__(self, function):
+        self.plan = BindingPlan(function)
+
+
+def positional(a, b, c=3, d=4):
+    return locals()
+
+
+def method(self, a, b=2):
+    return locals()
+
+
+def keyword_only(a, *, b, c=3):
+    return locals()
+
+
+def variadic(a, *args, **kwargs):
+    return locals()
+
+
+def positional_only(a, b=2, /, c=3, *, d, **kwargs):
+    return locals()
+
+
+# -----------------------------------------------------------------------------
+# The calls to time: (name, function, args, kwargs).
+# -----------------------------------------------------------------------------
+CALLS = [
+    ("positional", positional, (1, 2), {}),
+    ("positional-defaults", positional, (1,), {"b": 2}),
+    ("method", method, (object(), 1), {}),
+    ("keyword-only", keyword_only, (1,), {"b": 2}),
+    ("variadic", variadic, (1, 2, 3), {"x": 4, "y": 5}),
+    ("positional-only", positional_only, (1,), {"d": 4}),
+    ("positional-only-kwargs", positional_only, (1,), {"b": 5, "d": 4}),
+]
+
+
+def signature_entry_message(function, args, kwargs):
+
+    """ The ENTRY message as built from the arguments the function is
+        actually called with, to check the plan against. The functions
+        return their locals.
+    """
+
+    msg = "-> ENTRY"
+    if not args and not kwargs:
+        return msg
+
+    bound = function(*args, **kwargs)
+
+    values = []
+    for param in inspect.signature(function).parameters.values():
+        value = bound[param.name]
+        label = param.name + " = "
+
+        if param.kind == param.VAR_POSITIONAL:
+            label = "*" + label
+        elif param.kind == param.VAR_KEYWORD:
+            label = "**" + label
+
+        if param.kind in (param.VAR_POSITIONAL, param.VAR_KEYWORD):
+            if not value:
+                continue
+
+        if param.name == "self" and not pylg_module.TRACE_SELF:
+            continue
+
+        values.append(label + get_value_string(value))
+
+    return msg + ": " + ", ".join(values)
+
+
+def measure(function, number, repeat):
+
+    """ Time a callable.
+
+        :return: The best time per call in seconds.
+    """
+
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        best = min(best, (time.perf_counter() - start) / number)
+
+    return best
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=20000,
+                        help="messages per timing run")
+    parser.add_argument("--repeat", type=int, default=15,
+                        help="timing runs per call (the best is kept)")
+    args = parser.parse_args()
+
+    print("{:24} {:>12} {:>12}".format("call", "argspec", "plan"))
+
+    for name, function, call_args, call_kwargs in CALLS:
+
+        plan = PlanStruct(function)
+
+        expected = signature_entry_message(function, call_args, call_kwargs)
+        if entry_message(plan, True, call_args, call_kwargs) != expected:
+            sys.exit("{}: the plan logs {!r}, expected {!r}".format(
+                name, entry_message(plan, True, call_args, call_kwargs),
+                expected))
+
+        timed = measure(lambda: entry_message(plan, True, call_args,
+                                              call_kwargs),
+                        args.number, args.repeat)
+        plan_ns = "{:.0f} ns".format(timed * 1e9)
+
+        try:
+            struct = ArgspecStruct(function)
+            message = argspec_entry_message(struct, call_args, call_kwargs)
+        except (KeyError, IndexError, TypeError):
+            argspec_ns = "unsupported"
+        else:
+            if message != expected:
+                argspec_ns = "incorrect"
+            else:
+                timed = measure(lambda: argspec_entry_message(
+                    struct, call_args, call_kwargs), args.number, args.repeat)
+                argspec_ns = "{:.0f} ns".format(timed * 1e9)
+
+        print("{:24} {:>12} {:>12}".format(name, argspec_ns, plan_ns))
+
+
+if __name__ == "__main__":
+    main()
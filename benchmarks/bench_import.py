@@ -0,0 +1,131 @@
+# -----------------------------------------------------------------------------
+# PyLg: module to facilitate and automate the process of writing runtime logs.
+# Copyright (C) 2017 Wojciech Kozlowski <wk@wojciechkozlowski.eu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+
+""" Benchmark for the time it takes to import PyLg.
+
+    Usage:
+
+        python benchmarks/bench_import.py [--runs N] [--json results.json]
+                                          [--max-us US]
+
+    Every run imports PyLg in a fresh interpreter with -X importtime
+    and reports the cumulative import time of the pylg package in
+    microseconds. The check fails (exit status 1) if the median is
+    above --max-us or if importing PyLg pulls in any of the modules
+    that are only meant to be loaded on demand.
+"""
+
+import subprocess
+import argparse
+import json
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# -----------------------------------------------------------------------------
+# Modules that PyLg loads lazily. Importing PyLg must not import them.
+# -----------------------------------------------------------------------------
+LAZY_MODULES = ["inspect", "textwrap", "traceback", "dis", "tokenize",
+                "logging"]
+
+PROBE = ("import sys; before = set(sys.modules); import pylg; "
+         "print(' '.join(sorted(set(sys.modules) - before)))")
+
+
+def environment():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    return env
+
+
+def import_time():
+
+    """ Import PyLg in a fresh interpreter.
+
+        :return: The cumulative import time of pylg in microseconds.
+    """
+
+    output = subprocess.check_output(
+        [sys.executable, "-X", "importtime", "-c", "import pylg"],
+        stderr=subprocess.STDOUT, env=environment()).decode()
+
+    for line in output.splitlines():
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == "pylg":
+            return int(fields[1])
+
+    raise RuntimeError("No import time for pylg in:\n" + output)
+
+
+def imported_modules():
+
+    """ Get the modules that importing PyLg adds to sys.modules.
+    """
+
+    output = subprocess.check_output([sys.executable, "-c", PROBE],
+                                     env=environment()).decode()
+    return output.split()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20,
+                        help="the number of fresh interpreters to import in")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--max-us", type=int, default=0,
+                        help="fail if the median import time is above this")
+    args = parser.parse_args()
+
+    # -------------------------------------------------------------------------
+    # The first import compiles the bytecode cache so it is not
+    # counted.
+    # -------------------------------------------------------------------------
+    import_time()
+    times = sorted(import_time() for _ in range(args.runs))
+
+    median = times[len(times) // 2]
+    modules = imported_modules()
+    eager = [module for module in LAZY_MODULES if module in modules]
+
+    print("import pylg: min {} us, median {} us, max {} us".format(
+        times[0], median, times[-1]))
+    print("modules imported: {}".format(len(modules)))
+
+    if args.json:
+        with open(args.json, "w") as jfile:
+            json.dump({"min_us": times[0], "median_us": median,
+                       "max_us": times[-1], "modules": modules},
+                      jfile, indent=2, sort_keys=True)
+
+    failed = False
+
+    if eager:
+        print("FAIL: eagerly imported " + ", ".join(eager))
+        failed = True
+
+    if args.max_us and median > args.max_us:
+        print("FAIL: median import time above {} us".format(args.max_us))
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
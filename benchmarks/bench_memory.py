@@ -0,0 +1,185 @@
+# -----------------------------------------------------------------------------
+# PyLg: module to facilitate and automate the process of writing runtime logs.
+# Copyright (C) 2017 Wojciech Kozlowski <wk@wojciechkozlowski.eu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+
+""" Benchmark for the memory used by PyLg.
+
+    Usage:
+
+        python benchmarks/bench_memory.py [--functions N] [--records N]
+                                          [--json results.json]
+                                          [--compare old.json]
+
+    Reports the bytes allocated per decorated function, with the
+    default options and with options given to the decorator, and per
+    record staged in a thread buffer, formatted and with
+    DEFERRED_FORMAT. Allocations are measured with tracemalloc.
+"""
+
+import tracemalloc
+import argparse
+import tempfile
+import shutil
+import json
+import sys
+import os
+
+# -----------------------------------------------------------------------------
+# Always test the PyLg in this source tree.
+# -----------------------------------------------------------------------------
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pylg.pylg as pylg_module
+from pylg.pylg import TraceFunction, PyLg
+
+
+def make_function():
+
+    """ Create a new function object to decorate.
+    """
+
+    def function(a, b, c=3):
+        return a
+
+    return function
+
+
+def allocated(setup, count):
+
+    """ Measure the memory allocated by a callable.
+
+        :param setup: Called with count, it must return the objects to
+                      keep alive while measuring.
+        :return: The bytes allocated per object.
+    """
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = setup(count)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    del kept
+    return float(after - before) / count
+
+
+def stage_records(count):
+
+    """ Stage count ENTRY and EXIT records in the thread buffer.
+    """
+
+    traced = TraceFunction(make_function())
+    for _ in range(count // 2):
+        traced(1, [2, 3])
+    return list(PyLg.buffer().pending)
+
+
+def per_function(decorate):
+
+    """ Measure a way of decorating functions. The functions themselves
+        are created before measuring.
+    """
+
+    def measure(count):
+        functions = [make_function() for _ in range(count)]
+        return allocated(lambda n: [decorate(function)
+                                    for function in functions], count)
+
+    return measure
+
+
+def per_record(count):
+    return allocated(stage_records, count)
+
+
+# -----------------------------------------------------------------------------
+# The measurements: (name, measure, settings).
+# -----------------------------------------------------------------------------
+MEASUREMENTS = [
+    ("function/default",
+     per_function(lambda function: TraceFunction(function)), {}),
+    ("function/options",
+     per_function(lambda function: TraceFunction(trace_rv=False,
+                                                 max_depth=4)(function)),
+     {}),
+    ("record/formatted", per_record, {}),
+    ("record/deferred", per_record, {"DEFERRED_FORMAT": True}),
+]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--functions", type=int, default=10000,
+                        help="functions to decorate per measurement")
+    parser.add_argument("--records", type=int, default=10000,
+                        help="records to stage per measurement")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="compare against an earlier --json")
+    args = parser.parse_args()
+
+    logdir = tempfile.mkdtemp(prefix="pylg-bench-")
+    PyLg.set_filename(os.path.join(logdir, "bench.log"))
+
+    # -------------------------------------------------------------------------
+    # Records stay in the thread buffer until they are measured.
+    # -------------------------------------------------------------------------
+    pylg_module.THREAD_BUFFER = 10 ** 9
+    pylg_module.STATS_INTERVAL = 0
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as jfile:
+            previous = json.load(jfile)["results"]
+
+    results = {}
+    try:
+        for name, measure, overrides in MEASUREMENTS:
+            saved = dict((setting, getattr(pylg_module, setting))
+                         for setting in overrides)
+            for setting, value in overrides.items():
+                setattr(pylg_module, setting, value)
+
+            try:
+                count = (args.functions if name.startswith("function/")
+                         else args.records)
+                per_object = measure(count)
+            finally:
+                for setting, value in saved.items():
+                    setattr(pylg_module, setting, value)
+                PyLg.buffer().drain()
+
+            results[name] = {"bytes": per_object}
+
+            line = "{:24} {:10.0f} bytes".format(name, per_object)
+            if name in previous:
+                old = previous[name]["bytes"]
+                line += "  (was {:.0f}, {:+.1f}%)".format(
+                    old, 100.0 * (per_object - old) / old)
+            print(line)
+
+    finally:
+        shutil.rmtree(logdir)
+
+    if args.json:
+        with open(args.json, "w") as jfile:
+            json.dump({"python": sys.version.split()[0], "results": results},
+                      jfile, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
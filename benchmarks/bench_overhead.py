@@ -0,0 +1,688 @@
+# -----------------------------------------------------------------------------
+# PyLg: module to facilitate and automate the process of writing runtime logs.
+# Copyright (C) 2017 Wojciech Kozlowski <wk@wojciechkozlowski.eu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+
+""" Benchmark suite for the per-call overhead of PyLg.
+
+    Usage:
+
+        python benchmarks/bench_overhead.py [--json results.json]
+                                            [--compare old.json]
+                                            [--filter PATTERN]
+                                            [--number N] [--repeat R]
+
+    Every benchmark reports the time per call in nanoseconds and the
+    number of log records written per second. The JSON output of two
+    runs can be compared with --compare.
+"""
+
+from contextlib import contextmanager
+from fnmatch import fnmatch
+import itertools
+import argparse
+import platform
+import logging
+import enum
+import tempfile
+import warnings
+import shutil
+import json
+import time
+import sys
+import os
+
+# -----------------------------------------------------------------------------
+# Always benchmark the PyLg in this source tree.
+# -----------------------------------------------------------------------------
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pylg.pylg as pylg_module
+from pylg.pylg import TraceFunction, trace, PyLg
+from pylg.dummy import TraceFunctionDummy
+from pylg.handler import PyLgHandler
+
+# -----------------------------------------------------------------------------
+# The registry of benchmarks. Each entry is a tuple of the name, the
+# number of records written per call, the function that builds the
+# callable to time and the settings to override while it runs.
+# -----------------------------------------------------------------------------
+BENCHMARKS = []
+
+
+def benchmark(name, records, **overrides):
+
+    """ Decorator to register a benchmark. The decorated function is
+        called with no arguments inside the benchmark's settings and
+        must return the callable to time.
+
+        :param str name: The benchmark name.
+        :param int records: The number of log records per call.
+        :param overrides: PyLg settings to use for this benchmark.
+    """
+
+    def register(setup):
+        BENCHMARKS.append((name, records, setup, overrides))
+        return setup
+
+    return register
+
+
+@contextmanager
+def settings(**overrides):
+
+    """ Temporarily override PyLg settings. The settings are read
+        from the pylg.pylg module globals at call time.
+    """
+
+    saved = dict((name, getattr(pylg_module, name)) for name in overrides)
+    for name, value in overrides.items():
+        setattr(pylg_module, name, value)
+
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(pylg_module, name, value)
+
+
+def plain_function(a, b, c=3):
+    return a
+
+
+# -----------------------------------------------------------------------------
+# Reference points: no decorator and the disabled PyLg.
+# -----------------------------------------------------------------------------
+@benchmark("baseline/undecorated", 0)
+def bench_undecorated():
+    return lambda: plain_function(1, 2)
+
+
+@benchmark("baseline/disabled", 0)
+def bench_disabled():
+    return lambda f=TraceFunctionDummy(plain_function): f(1, 2)
+
+
+# -----------------------------------------------------------------------------
+# Every combination of TRACE_* columns.
+# -----------------------------------------------------------------------------
+COLUMNS = ["TRACE_TIME", "TRACE_FILENAME", "TRACE_LINENO",
+           "TRACE_FUNCTION", "TRACE_MESSAGE"]
+
+
+def register_columns(combination):
+
+    name = "columns/" + ("+".join(column[6:].lower()
+                                  for column, on in zip(COLUMNS, combination)
+                                  if on) or "none")
+
+    @benchmark(name, 2, **dict(zip(COLUMNS, combination)))
+    def bench_columns():
+        return lambda f=TraceFunction(plain_function): f(1, 2)
+
+
+for combination in itertools.product([True, False], repeat=len(COLUMNS)):
+    register_columns(combination)
+
+
+@benchmark("columns/compact-sites", 2, COMPACT_SITES=True)
+def bench_columns_compact_sites():
+    return lambda f=TraceFunction(plain_function): f(1, 2)
+
+
+# -----------------------------------------------------------------------------
+# Argument tracing.
+# -----------------------------------------------------------------------------
+@benchmark("args/off", 2)
+def bench_args_off():
+    f = TraceFunction(trace_args=False)(plain_function)
+    return lambda: f(1, 2)
+
+
+@benchmark("args/small", 2)
+def bench_args_small():
+    f = TraceFunction(plain_function)
+    return lambda: f(1, "two", c=3.0)
+
+
+@benchmark("args/keyword-only", 2)
+def bench_args_keyword_only():
+
+    @TraceFunction
+    def keyword_only(a, *, b, c=3):
+        return a
+
+    return lambda: keyword_only(1, b=2)
+
+
+@benchmark("args/variadic", 2)
+def bench_args_variadic():
+
+    @TraceFunction
+    def variadic(a, *args, **kwargs):
+        return a
+
+    return lambda: variadic(1, 2, 3, x=4)
+
+
+@benchmark("args/large", 2)
+def bench_args_large():
+    f = TraceFunction(plain_function)
+    big_list = list(range(1000))
+    big_dict = dict((str(i), i) for i in range(1000))
+    return lambda: f(big_list, big_dict, c="x" * 1000)
+
+
+@benchmark("args/large-collapsed", 2, COLLAPSE_LISTS=True,
+           COLLAPSE_DICTS=True)
+def bench_args_large_collapsed():
+    f = TraceFunction(plain_function)
+    big_list = list(range(1000))
+    big_dict = dict((str(i), i) for i in range(1000))
+    return lambda: f(big_list, big_dict, c="x" * 1000)
+
+
+# -----------------------------------------------------------------------------
+# Deferred formatting. The buffer is large enough not to be flushed
+# while timing, so these measure the cost left in the traced code.
+# -----------------------------------------------------------------------------
+def bench_deferred():
+    f = TraceFunction(plain_function)
+    medium_list = list(range(20))
+    medium_dict = dict((str(i), i) for i in range(20))
+    return lambda: f(medium_list, medium_dict, c="x" * 20)
+
+
+benchmark("deferred/off", 2, THREAD_BUFFER=10 ** 6)(bench_deferred)
+benchmark("deferred/reference", 2, THREAD_BUFFER=10 ** 6,
+          DEFERRED_FORMAT=True,
+          DEFERRED_SNAPSHOT="reference")(bench_deferred)
+benchmark("deferred/shallow", 2, THREAD_BUFFER=10 ** 6, DEFERRED_FORMAT=True,
+          DEFERRED_SNAPSHOT="shallow")(bench_deferred)
+
+
+# -----------------------------------------------------------------------------
+# Rendering the same argument values on every call, with and without
+# RENDER_CACHE. The buffer is large enough not to be flushed while
+# timing.
+# -----------------------------------------------------------------------------
+class Mode(enum.Enum):
+    FAST = 1
+    SAFE = 2
+
+
+class Config(object):
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+    def __repr__(self):
+        return "Config(" + ", ".join(name + "=" + repr(value) for name, value
+                                     in sorted(self.__dict__.items())) + ")"
+
+
+CONFIG = Config(host="localhost", port=8080, timeout=2.5, retries=3,
+                paths=["/a", "/b"], verbose=False)
+
+
+def bench_render():
+    f = TraceFunction(plain_function)
+    return lambda: f(CONFIG, Mode.SAFE, c=2.5)
+
+
+benchmark("render/uncached", 2, THREAD_BUFFER=10 ** 6)(bench_render)
+benchmark("render/cached", 2, THREAD_BUFFER=10 ** 6, RENDER_CACHE=256,
+          RENDER_CACHE_TYPES=(Config,))(bench_render)
+
+
+# -----------------------------------------------------------------------------
+# Methods vs functions.
+# -----------------------------------------------------------------------------
+@benchmark("call/function", 2)
+def bench_function():
+    return lambda f=TraceFunction(plain_function): f(1, 2)
+
+
+@benchmark("call/method", 2)
+def bench_method():
+
+    class Traced(object):
+
+        @TraceFunction
+        def method(self, a, b, c=3):
+            return a
+
+    obj = Traced()
+    return lambda: obj.method(1, 2)
+
+
+# -----------------------------------------------------------------------------
+# Measurements written in the EXIT records. tracemalloc is not
+# tracing, so metrics/allocations only measures the check for it.
+# -----------------------------------------------------------------------------
+def bench_metrics():
+    return lambda f=TraceFunction(plain_function): f(1, 2)
+
+
+benchmark("metrics/duration", 2, TRACE_DURATION=True)(bench_metrics)
+benchmark("metrics/cpu-time", 2, TRACE_CPU_TIME=True)(bench_metrics)
+benchmark("metrics/allocations", 2, TRACE_ALLOCATIONS=True)(bench_metrics)
+benchmark("metrics/all", 2, TRACE_DURATION=True, TRACE_CPU_TIME=True,
+          TRACE_ALLOCATIONS=True)(bench_metrics)
+
+
+# -----------------------------------------------------------------------------
+# Calls rejected by filters.
+# -----------------------------------------------------------------------------
+@benchmark("filter/args-rejected", 0)
+def bench_filter_args():
+    traced = TraceFunction(filter_args=lambda a, b, c=3: a == 42)
+    return lambda f=traced(plain_function): f(1, 2)
+
+
+@benchmark("filter/rv-rejected", 0)
+def bench_filter_rv():
+    traced = TraceFunction(filter_rv=lambda rv: rv == 42)
+    return lambda f=traced(plain_function): f(1, 2)
+
+
+@benchmark("filter/min-duration", 0)
+def bench_filter_min_duration():
+    traced = TraceFunction(min_duration=0.05)
+    return lambda f=traced(plain_function): f(1, 2)
+
+
+# -----------------------------------------------------------------------------
+# Bare trace calls at various stack depths.
+# -----------------------------------------------------------------------------
+def at_depth(depth, function):
+
+    """ Call function with depth extra frames on the stack.
+    """
+
+    if depth == 0:
+        return function()
+    return at_depth(depth - 1, function)
+
+
+def register_depth(depth):
+
+    @benchmark("trace/depth-" + str(depth), 1)
+    def bench_trace_depth():
+
+        def run():
+            trace("message")
+
+        return lambda: at_depth(depth, run)
+
+
+for depth in (1, 10, 50):
+    register_depth(depth)
+
+
+# -----------------------------------------------------------------------------
+# A traced recursion 50 levels deep, logged in full, collapsed below
+# two levels and cut off at depth two.
+# -----------------------------------------------------------------------------
+def recursive(**options):
+
+    @TraceFunction(**options)
+    def descend(n):
+        return n if n == 0 else descend(n - 1)
+
+    return lambda: descend(49)
+
+
+@benchmark("recursion/full", 100)
+def bench_recursion_full():
+    return recursive(trace_args=False)
+
+
+@benchmark("recursion/collapsed", 5)
+def bench_recursion_collapsed():
+    return recursive(trace_args=False, recursion_limit=2)
+
+
+@benchmark("recursion/max-depth", 4)
+def bench_recursion_max_depth():
+    return recursive(trace_args=False, max_depth=2)
+
+
+@benchmark("recursion/indented", 100, INDENT_WIDTH=2)
+def bench_recursion_indented():
+    return recursive(trace_args=False)
+
+
+# -----------------------------------------------------------------------------
+# The span column, with every call a root span and nested in a single
+# trace.
+# -----------------------------------------------------------------------------
+@benchmark("spans/root", 2, TRACE_SPANS=True)
+def bench_spans_root():
+    return lambda f=TraceFunction(plain_function): f(1, 2)
+
+
+@benchmark("spans/recursion", 100, TRACE_SPANS=True)
+def bench_spans_recursion():
+    return recursive(trace_args=False)
+
+
+# -----------------------------------------------------------------------------
+# Message wrapping and truncation.
+# -----------------------------------------------------------------------------
+LONG_MESSAGE = " ".join(["word"] * 100)
+
+
+@benchmark("message/unlimited", 1)
+def bench_message_unlimited():
+    return lambda: trace(LONG_MESSAGE, function=SITE)
+
+
+@benchmark("message/wrapped", 1, MESSAGE_WIDTH=40, MESSAGE_WRAP=True)
+def bench_message_wrapped():
+    return lambda: trace(LONG_MESSAGE, function=SITE)
+
+
+@benchmark("message/truncated", 1, MESSAGE_WIDTH=40, MESSAGE_WRAP=False)
+def bench_message_truncated():
+    return lambda: trace(LONG_MESSAGE, function=SITE)
+
+
+@benchmark("message/multiline", 1)
+def bench_message_multiline():
+    return lambda: trace("\n".join(["line"] * 10), function=SITE)
+
+
+# -----------------------------------------------------------------------------
+# Exceptions.
+# -----------------------------------------------------------------------------
+def raising_function(a):
+    raise ValueError(a)
+
+
+def catching(f):
+
+    def run():
+        try:
+            f(1)
+        except ValueError:
+            pass
+
+    return run
+
+
+@benchmark("exception/baseline", 0)
+def bench_exception_baseline():
+    return catching(raising_function)
+
+
+@benchmark("exception/no-traceback", 2)
+def bench_exception_no_tb():
+    return catching(TraceFunction(exception_warning=False,
+                                  exception_tb_file=False)(raising_function))
+
+
+@benchmark("exception/traceback", 2)
+def bench_exception_tb():
+    return catching(TraceFunction(exception_warning=False,
+                                  exception_tb_file=True)(raising_function))
+
+
+@benchmark("exception/nested-traceback", 6)
+def bench_exception_nested_tb():
+
+    options = dict(exception_warning=False, exception_tb_file=True)
+
+    inner = TraceFunction(**options)(raising_function)
+
+    def middle(a):
+        return inner(a)
+
+    def outer(a):
+        return middle(a)
+
+    middle = TraceFunction(**options)(middle)
+    outer = TraceFunction(**options)(outer)
+
+    return catching(outer)
+
+
+def deep_raising(depth, **options):
+
+    """ Build a stack of depth traced functions with raising_function
+        at the bottom.
+    """
+
+    function = TraceFunction(**options)(raising_function)
+    for _ in range(depth - 1):
+        function = TraceFunction(**options)(
+            lambda a, inner=function: inner(a))
+
+    return catching(function)
+
+
+@benchmark("exception/deep-traceback", 40)
+def bench_exception_deep_tb():
+    return deep_raising(20, exception_warning=False, exception_tb_file=True)
+
+
+@benchmark("exception/deep-summary", 40)
+def bench_exception_deep_summary():
+    return deep_raising(20, exception_warning=False, exception_tb_file=True,
+                        exception_tb_summary=True)
+
+
+# -----------------------------------------------------------------------------
+# Log file writers. Settings that are read when the log file is opened
+# are listed in REOPEN_SETTINGS.
+# -----------------------------------------------------------------------------
+REOPEN_SETTINGS = ["MMAP_CHUNK", "PYLG_RING"]
+
+
+@benchmark("sink/file", 1)
+def bench_sink_file():
+    return lambda: trace("record", function=SITE)
+
+
+@benchmark("sink/file-buffered", 1, THREAD_BUFFER=256)
+def bench_sink_file_buffered():
+    return lambda: trace("record", function=SITE)
+
+
+@benchmark("sink/mmap", 1, MMAP_CHUNK=16 * 1024 * 1024)
+def bench_sink_mmap():
+    return lambda: trace("record", function=SITE)
+
+
+@benchmark("sink/mmap-buffered", 1, MMAP_CHUNK=16 * 1024 * 1024,
+           THREAD_BUFFER=256)
+def bench_sink_mmap_buffered():
+    return lambda: trace("record", function=SITE)
+
+
+@benchmark("sink/ring", 1, PYLG_RING=16 * 1024 * 1024)
+def bench_sink_ring():
+    return lambda: trace("record", function=SITE)
+
+
+@benchmark("sink/ring-buffered", 1, PYLG_RING=16 * 1024 * 1024,
+           THREAD_BUFFER=256)
+def bench_sink_ring_buffered():
+    return lambda: trace("record", function=SITE)
+
+
+# -----------------------------------------------------------------------------
+# The logging module bridge: traced calls passed to a logger that is
+# disabled and to one with a handler that drops the records, and
+# logging calls written to the PyLg log.
+# -----------------------------------------------------------------------------
+BENCH_LOGGER = logging.getLogger("pylg-bench")
+BENCH_LOGGER.addHandler(logging.NullHandler())
+BENCH_LOGGER.propagate = False
+
+
+@benchmark("logging/sink-disabled", 0, PYLG_LOGGER="pylg-bench")
+def bench_logging_sink_disabled():
+    BENCH_LOGGER.setLevel(logging.INFO)
+    return lambda f=TraceFunction(plain_function): f(1, 2)
+
+
+@benchmark("logging/sink-enabled", 2, PYLG_LOGGER="pylg-bench")
+def bench_logging_sink_enabled():
+    BENCH_LOGGER.setLevel(logging.DEBUG)
+    return lambda f=TraceFunction(plain_function): f(1, 2)
+
+
+@benchmark("logging/handler", 1)
+def bench_logging_handler():
+    logger = logging.getLogger("pylg-bench.handler")
+    logger.addHandler(PyLgHandler())
+    logger.setLevel(logging.INFO)
+    return lambda: logger.info("record %d", 1)
+
+
+# -----------------------------------------------------------------------------
+# A call site for trace calls that should not pay for stack inspection.
+# -----------------------------------------------------------------------------
+SITE = TraceFunction.TraceFunctionStruct()
+SITE.filename = "bench_overhead.py"
+SITE.lineno = 1
+SITE.functionname = "bench"
+
+
+def measure(function, number, repeat):
+
+    """ Time a callable.
+
+        :return: The best time per call in seconds.
+    """
+
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        best = min(best, (time.perf_counter() - start) / number)
+
+    return best
+
+
+def close_log():
+
+    """ Write out the buffered records and close the log file so that
+        the next record opens it again with the current settings.
+    """
+
+    PyLg.flush()
+    if PyLg.wfile is not None:
+        PyLg.close()
+
+
+def run(pattern, number, repeat):
+
+    """ Run the benchmarks whose names match pattern.
+
+        :return: A dictionary with the results of every benchmark.
+    """
+
+    results = {}
+
+    for name, records, setup, overrides in BENCHMARKS:
+
+        if not fnmatch(name, pattern):
+            continue
+
+        reopen = any(name in REOPEN_SETTINGS for name in overrides)
+
+        with settings(**overrides):
+            if reopen:
+                close_log()
+
+            function = setup()
+            function()
+            per_call = measure(function, number, repeat)
+
+            if reopen:
+                close_log()
+
+        result = {"ns_per_call": per_call * 1e9,
+                  "records_per_s": records / per_call}
+        results[name] = result
+
+        print("{name:40} {ns:12.0f} ns/call {rps:14.0f} records/s".format(
+            name=name, ns=result["ns_per_call"], rps=result["records_per_s"]))
+
+    return results
+
+
+def compare(old, new):
+
+    """ Print the relative change of every benchmark present in both
+        result sets.
+    """
+
+    print()
+    print("{:40} {:>12} {:>12} {:>8}".format("benchmark", "old ns", "new ns",
+                                             "change"))
+
+    for name in sorted(set(old) & set(new)):
+        old_ns = old[name]["ns_per_call"]
+        new_ns = new[name]["ns_per_call"]
+        print("{:40} {:12.0f} {:12.0f} {:+7.1f}%".format(
+            name, old_ns, new_ns, 100.0 * (new_ns - old_ns) / old_ns))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="compare against an earlier --json")
+    parser.add_argument("--filter", default="*",
+                        help="only run benchmarks matching this pattern")
+    parser.add_argument("--number", type=int, default=2000,
+                        help="calls per timing run")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="timing runs per benchmark (the best is kept)")
+    args = parser.parse_args()
+
+    logdir = tempfile.mkdtemp(prefix="pylg-bench-")
+    PyLg.set_filename(os.path.join(logdir, "bench.log"))
+
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            results = run(args.filter, args.number, args.repeat)
+    finally:
+        close_log()
+        shutil.rmtree(logdir)
+
+    output = {"python": platform.python_version(),
+              "implementation": platform.python_implementation(),
+              "number": args.number,
+              "repeat": args.repeat,
+              "results": results}
+
+    if args.json:
+        with open(args.json, "w") as jfile:
+            json.dump(output, jfile, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as jfile:
+            compare(json.load(jfile)["results"], results)
+
+
+if __name__ == "__main__":
+    main()
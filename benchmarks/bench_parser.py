@@ -0,0 +1,113 @@
+# -----------------------------------------------------------------------------
+# PyLg: module to facilitate and automate the process of writing runtime logs.
+# Copyright (C) 2017 Wojciech Kozlowski <wk@wojciechkozlowski.eu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+
+""" Benchmark for parsing PyLg logs serially and in parallel.
+
+    Usage:
+
+        python benchmarks/bench_parser.py [--records N] [--jobs N ...]
+                                          [--chunk-size BYTES]
+
+    Writes a log of ENTRY, EXIT and multi-line records and parses it
+    with each number of --jobs. It checks that every run yields the
+    same records and reports the throughput and the CPU time of the
+    consuming process, which bounds the speedup on a machine with
+    enough CPUs.
+"""
+
+import argparse
+import tempfile
+import shutil
+import time
+import sys
+import os
+
+# -----------------------------------------------------------------------------
+# Always test the PyLg in this source tree.
+# -----------------------------------------------------------------------------
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pylg.pylg as pylg_module
+from pylg.pylg import TraceFunction, PyLg, trace
+from pylg.parser import parse_file, CHUNK_SIZE
+
+
+def write_log(filename, records):
+
+    """ Write a log of about the given number of records.
+    """
+
+    PyLg.set_filename(filename)
+    pylg_module.THREAD_BUFFER = 1024
+
+    @TraceFunction
+    def handle(request, payload):
+        trace("payload:\n" + "\n".join(payload))
+        return len(payload)
+
+    payload = ["line {}".format(i) for i in range(4)]
+    for i in range(records // 3):
+        handle(i, payload)
+
+    PyLg.close()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=300000,
+                        help="records to write to the log")
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1, 2, 4],
+                        help="the numbers of processes to parse with")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+                        help="the size of the chunks parsed by a process")
+    args = parser.parse_args()
+
+    logdir = tempfile.mkdtemp(prefix="pylg-bench-")
+    try:
+        filename = os.path.join(logdir, "bench.log")
+        write_log(filename, args.records)
+        size = os.path.getsize(filename)
+
+        print("{:.1f} MB log, {} CPUs".format(size / 1e6, os.cpu_count()))
+        print("{:>6} {:>12} {:>12} {:>14}".format("jobs", "MB/s",
+                                                  "records/s",
+                                                  "consumer cpu"))
+
+        expected = None
+        for jobs in args.jobs:
+            wall = time.perf_counter()
+            cpu = time.process_time()
+            records = list(parse_file(filename, jobs, args.chunk_size))
+            cpu = time.process_time() - cpu
+            wall = time.perf_counter() - wall
+
+            if expected is None:
+                expected = records
+            elif records != expected:
+                sys.exit("jobs={} parsed different records".format(jobs))
+
+            print("{:6d} {:12.1f} {:12.0f} {:13.2f}s".format(
+                jobs, size / 1e6 / wall, len(records) / wall, cpu))
+
+    finally:
+        shutil.rmtree(logdir)
+
+
+if __name__ == "__main__":
+    main()
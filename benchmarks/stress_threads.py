@@ -0,0 +1,181 @@
+# -----------------------------------------------------------------------------
+# PyLg: module to facilitate and automate the process of writing runtime logs.
+# Copyright (C) 2017 Wojciech Kozlowski <wk@wojciechkozlowski.eu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+
+""" Stress test for logging from many threads at once.
+
+    Usage:
+
+        python benchmarks/stress_threads.py [--threads N] [--records N]
+                                            [--buffer N] [--thread-files]
+                                            [--mmap-chunk BYTES]
+                                            [--switch-interval SECONDS]
+
+    Every thread logs --records numbered records as fast as it can,
+    all threads starting together. The log is then parsed back and
+    the check fails (exit status 1) unless every record is present
+    exactly once, intact and in its thread's order. Run it on a
+    free-threaded build of CPython to exercise real parallelism. With
+    the GIL, a tiny --switch-interval forces frequent thread switches.
+"""
+
+from collections import defaultdict
+import threading
+import argparse
+import tempfile
+import shutil
+import time
+import sys
+import os
+
+# -----------------------------------------------------------------------------
+# Always test the PyLg in this source tree.
+# -----------------------------------------------------------------------------
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pylg.pylg as pylg_module
+from pylg.pylg import TraceFunction, trace, PyLg
+from pylg.parser import parse_file
+
+SITE = TraceFunction.TraceFunctionStruct()
+SITE.filename = "stress_threads.py"
+SITE.lineno = 1
+SITE.functionname = "stress"
+
+# -----------------------------------------------------------------------------
+# The column layout the log is written and parsed with.
+# -----------------------------------------------------------------------------
+LAYOUT = dict(TRACE_TIME=True, TRACE_THREAD=True, TRACE_FILENAME=True,
+              TRACE_LINENO=True, TRACE_FUNCTION=True)
+
+
+def worker(barrier, records):
+
+    """ Log numbered records as fast as possible.
+    """
+
+    name = threading.current_thread().name
+    barrier.wait()
+    for seq in range(records):
+        trace("{} {}".format(name, seq), function=SITE)
+
+
+def check(filenames, names, records):
+
+    """ Check the records in the log files.
+
+        :return: A list of error messages.
+    """
+
+    errors = []
+    seen = defaultdict(list)
+
+    for filename in filenames:
+        for record in parse_file(filename, **LAYOUT):
+            try:
+                name, seq = record.message.split(" ")
+                seq = int(seq)
+            except ValueError:
+                errors.append("torn record: {!r}".format(record.message))
+                continue
+
+            if name != record.thread:
+                errors.append("record of {} logged as {}".format(
+                    name, record.thread))
+            seen[name].append(seq)
+
+    for name in names:
+        if seen.pop(name, []) != list(range(records)):
+            errors.append("records of {} missing or out of order".format(
+                name))
+
+    for name in seen:
+        errors.append("records of unknown thread {}".format(name))
+
+    return errors
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=16,
+                        help="the number of logging threads")
+    parser.add_argument("--records", type=int, default=5000,
+                        help="records logged by every thread")
+    parser.add_argument("--buffer", type=int, default=0,
+                        help="the THREAD_BUFFER setting")
+    parser.add_argument("--thread-files", action="store_true",
+                        help="enable THREAD_FILES")
+    parser.add_argument("--mmap-chunk", type=int, default=0,
+                        help="the MMAP_CHUNK setting")
+    parser.add_argument("--switch-interval", type=float, default=1e-6,
+                        help="the interpreter's thread switch interval")
+    args = parser.parse_args()
+
+    for name, value in LAYOUT.items():
+        setattr(pylg_module, name, value)
+    pylg_module.THREAD_BUFFER = args.buffer
+    pylg_module.THREAD_FILES = args.thread_files
+    pylg_module.MMAP_CHUNK = args.mmap_chunk
+    pylg_module.STATS_INTERVAL = 0
+
+    sys.setswitchinterval(args.switch_interval)
+
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print("python {}, GIL {}".format(sys.version.split()[0],
+                                     "enabled" if gil else "disabled"))
+
+    logdir = tempfile.mkdtemp(prefix="pylg-stress-")
+    logname = os.path.join(logdir, "stress.log")
+    PyLg.set_filename(logname)
+
+    try:
+        barrier = threading.Barrier(args.threads)
+        threads = [threading.Thread(target=worker, name="T{}".format(idx),
+                                    args=(barrier, args.records))
+                   for idx in range(args.threads)]
+
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        PyLg.close()
+        elapsed = time.time() - start
+
+        total = args.threads * args.records
+        print("{} records from {} threads in {:.3f} s ({:.0f} records/s)"
+              .format(total, args.threads, elapsed, total / elapsed))
+
+        if args.thread_files:
+            filenames = [logname + "." + thread.name for thread in threads]
+        else:
+            filenames = [logname]
+
+        errors = check(filenames, [thread.name for thread in threads],
+                       args.records)
+    finally:
+        shutil.rmtree(logdir)
+
+    for error in errors[:20]:
+        print("FAIL: " + error)
+
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
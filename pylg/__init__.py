@@ -17,8 +17,14 @@
 # -----------------------------------------------------------------------------
 
 from .loadSettings import PYLG_ENABLE
+from .pylg import stats
 
 if PYLG_ENABLE:
     from .pylg import TraceFunction, trace
+    from .pylg import TraceContext, propagate, current_span
+    from .profiler import TraceProfiler
 else:
     from .dummy import TraceFunctionDummy as TraceFunction, trace
+    from .dummy import TraceContextDummy as TraceContext
+    from .dummy import propagate, current_span
+    from .dummy import TraceProfilerDummy as TraceProfiler
@@ -0,0 +1,339 @@
+# -----------------------------------------------------------------------------
+# PyLg: module to facilitate and automate the process of writing runtime logs.
+# Copyright (C) 2017 Wojciech Kozlowski <wk@wojciechkozlowski.eu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+
+""" Rebuild call trees from the ENTRY and EXIT records of a PyLg log.
+
+    Usage:
+
+        python -m pylg.calltree LOG [--collapsed FILE] [--json]
+                                    [--sort KEY] [--limit N] [--jobs N]
+
+    Prints the number of calls and the inclusive and exclusive time of
+    every traced function, and the CPU time and net allocations of the
+    calls if they were measured (TRACE_CPU_TIME and
+    TRACE_ALLOCATIONS). --collapsed writes the call stacks in the
+    collapsed format used by flame graph tools (e.g. flamegraph.pl or
+    speedscope) with the exclusive time in microseconds as the value.
+"""
+
+import argparse
+import json
+import sys
+import re
+
+from .parser import parse_file
+
+ENTRY = "-> ENTRY"
+EXIT = "<- EXIT"
+
+# -----------------------------------------------------------------------------
+# The measurements written in an EXIT record, e.g.
+# '<- EXIT [wall=0.012034s cpu=0.000410s alloc=+2048B] : 1'.
+# -----------------------------------------------------------------------------
+METRICS = re.compile(r"<- EXIT \[([^\]]*)\]")
+
+
+def parse_metrics(message):
+
+    """ Get the measurements of a call from its EXIT message.
+
+        :return: A dictionary of the measurements, empty if there are
+                 none.
+    """
+
+    match = METRICS.match(message)
+    if match is None:
+        return {}
+
+    metrics = {}
+    for field in match.group(1).split():
+        name, _, value = field.partition("=")
+        if name == "alloc":
+            metrics[name] = int(value[:-1])
+        else:
+            metrics[name] = float(value[:-1])
+
+    return metrics
+
+
+class FunctionStats(object):
+
+    """ Aggregated times of a single function. The CPU time and the
+        net allocations are inclusive, and None if they were not
+        measured.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.inclusive = 0.0
+        self.exclusive = 0.0
+        self.cpu = None
+        self.alloc = None
+
+    def as_dict(self):
+        stats = {"calls": self.calls,
+                 "inclusive": self.inclusive,
+                 "exclusive": self.exclusive}
+
+        if self.cpu is not None:
+            stats["cpu"] = self.cpu
+        if self.alloc is not None:
+            stats["alloc"] = self.alloc
+
+        return stats
+
+
+class Frame(object):
+
+    """ A call that has been entered but has not exited yet.
+    """
+
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start
+        self.children = 0.0
+
+
+class CallTree(object):
+
+    """ Aggregates the call tree of a log. Only the currently open
+        calls and one entry per distinct call stack are kept in
+        memory so logs of any size can be streamed through it.
+    """
+
+    def __init__(self):
+
+        # ---------------------------------------------------------------------
+        # The stacks of open calls keyed by thread, see thread_of.
+        # ---------------------------------------------------------------------
+        self.stacks = {}
+
+        self.functions = {}
+
+        # ---------------------------------------------------------------------
+        # Exclusive time in seconds keyed by the tuple of function
+        # names from the root of the stack.
+        # ---------------------------------------------------------------------
+        self.paths = {}
+
+        # ---------------------------------------------------------------------
+        # The number of times each function is open on each thread's
+        # stack so that recursive calls are not counted twice in the
+        # inclusive time.
+        # ---------------------------------------------------------------------
+        self.active = {}
+
+        self.unmatched = 0
+
+    @staticmethod
+    def thread_of(record):
+
+        """ Get the key of the stack a record belongs to. Logs
+            without a thread column are a single stream. In a log
+            merged by pylg.collector, every program has its own
+            threads.
+        """
+
+        if record.source is None:
+            return record.thread
+
+        return record.source, record.thread
+
+    def add(self, record):
+
+        """ Process a single Record.
+        """
+
+        if record.time is None or record.function is None:
+            return
+
+        if record.message.startswith(ENTRY):
+            self.enter(self.thread_of(record), record.function, record.time)
+        elif record.message.startswith(EXIT):
+            self.exit(self.thread_of(record), record.function, record.time,
+                      parse_metrics(record.message))
+
+    def enter(self, thread, name, time):
+
+        stack = self.stacks.setdefault(thread, [])
+        stack.append(Frame(name, time))
+
+        active = self.active.setdefault(thread, {})
+        active[name] = active.get(name, 0) + 1
+
+    def exit(self, thread, name, time, metrics=None):
+
+        stack = self.stacks.get(thread)
+
+        # ---------------------------------------------------------------------
+        # An EXIT without a matching ENTRY happens when tracing
+        # started in the middle of a call. Calls above the matching
+        # frame never logged their EXIT (e.g. a non-traced exception
+        # exit) and are closed here as well.
+        # ---------------------------------------------------------------------
+        if not stack or (stack[-1].name != name and
+                         all(frame.name != name for frame in stack)):
+            self.unmatched += 1
+            return
+
+        while True:
+            matched = stack[-1].name == name
+            self.close(thread, stack, time, metrics if matched else None)
+            if matched:
+                break
+
+    def close(self, thread, stack, time, metrics=None):
+
+        path = tuple(frame.name for frame in stack)
+        frame = stack.pop()
+
+        elapsed = (time - frame.start).total_seconds()
+        exclusive = elapsed - frame.children
+
+        if stack:
+            stack[-1].children += elapsed
+
+        stats = self.functions.get(frame.name)
+        if stats is None:
+            stats = self.functions[frame.name] = FunctionStats()
+
+        active = self.active[thread]
+        active[frame.name] -= 1
+
+        stats.calls += 1
+        stats.exclusive += exclusive
+        if not active[frame.name]:
+            stats.inclusive += elapsed
+
+            if metrics:
+                if "cpu" in metrics:
+                    stats.cpu = (stats.cpu or 0.0) + metrics["cpu"]
+                if "alloc" in metrics:
+                    stats.alloc = (stats.alloc or 0) + metrics["alloc"]
+
+        self.paths[path] = self.paths.get(path, 0.0) + exclusive
+
+    def collapsed(self):
+
+        """ Generate the call stacks in the collapsed stack format.
+
+            :return: A generator of lines without trailing newlines.
+        """
+
+        for path, exclusive in sorted(self.paths.items()):
+            value = int(round(exclusive * 1e6))
+            if value > 0:
+                yield (";".join(name.replace(";", ":") for name in path) +
+                       " " + str(value))
+
+
+def build(filename, tree=None, jobs=1):
+
+    """ Stream a log file into a CallTree.
+
+        :param str filename: The log file name.
+        :param tree: The CallTree to add to, a new one if None.
+        :param int jobs: The number of processes parsing the log, see
+                         parse_file.
+        :return: The CallTree.
+    """
+
+    if tree is None:
+        tree = CallTree()
+
+    for record in parse_file(filename, jobs):
+        tree.add(record)
+
+    return tree
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        prog="python -m pylg.calltree",
+        description="Rebuild call trees from a PyLg log.")
+    parser.add_argument("log", help="the PyLg log file")
+    parser.add_argument("--collapsed", metavar="FILE",
+                        help="write collapsed stacks for flame graph tools "
+                             "('-' for stdout)")
+    parser.add_argument("--json", action="store_true",
+                        help="print the per-function times as JSON")
+    parser.add_argument("--sort", default="inclusive",
+                        choices=["inclusive", "exclusive", "calls", "cpu",
+                                 "alloc"],
+                        help="the column to sort the table by")
+    parser.add_argument("--limit", type=int, default=0,
+                        help="only print the top LIMIT functions")
+    parser.add_argument("--jobs", type=int, default=0,
+                        help="the number of processes parsing the log, "
+                             "0 for one per CPU (default: 0)")
+    args = parser.parse_args(argv)
+
+    tree = build(args.log, jobs=args.jobs)
+
+    if args.collapsed:
+        out = sys.stdout if args.collapsed == "-" else open(args.collapsed,
+                                                            "w")
+        for line in tree.collapsed():
+            out.write(line + "\n")
+        if out is not sys.stdout:
+            out.close()
+        return
+
+    ranked = sorted(tree.functions.items(),
+                    key=lambda item: getattr(item[1], args.sort) or 0,
+                    reverse=True)
+    if args.limit:
+        ranked = ranked[:args.limit]
+
+    if args.json:
+        json.dump(dict((name, stats.as_dict()) for name, stats in ranked),
+                  sys.stdout, indent=2, sort_keys=True)
+        print()
+        return
+
+    # -------------------------------------------------------------------------
+    # The CPU time and allocation columns are only printed if they
+    # were measured.
+    # -------------------------------------------------------------------------
+    has_cpu = any(stats.cpu is not None for _, stats in ranked)
+    has_alloc = any(stats.alloc is not None for _, stats in ranked)
+
+    header = "{:40} {:>10} {:>14} {:>14}".format("function", "calls",
+                                                 "inclusive (s)",
+                                                 "exclusive (s)")
+    if has_cpu:
+        header += " {:>14}".format("cpu (s)")
+    if has_alloc:
+        header += " {:>14}".format("alloc (B)")
+    print(header)
+
+    for name, stats in ranked:
+        line = "{:40} {:10d} {:14.6f} {:14.6f}".format(
+            name, stats.calls, stats.inclusive, stats.exclusive)
+        if has_cpu:
+            line += (" {:14.6f}".format(stats.cpu) if stats.cpu is not None
+                     else " {:>14}".format("-"))
+        if has_alloc:
+            line += (" {:+14d}".format(stats.alloc)
+                     if stats.alloc is not None else " {:>14}".format("-"))
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+# -----------------------------------------------------------------------------
+# PyLg: module to facilitate and automate the process of writing runtime logs.
+# Copyright (C) 2017 Wojciech Kozlowski <wk@wojciechkozlowski.eu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+
+""" Reference collector for the logs sent with PYLG_COLLECTOR.
+
+    Usage:
+
+        python -m pylg.collector ADDRESS --output LOG
+        python -m pylg.collector --spool FILE [--spool FILE ...] --output LOG
+
+    Listens on ADDRESS ('unix:PATH' or 'tcp:HOST:PORT') and appends the
+    records of all the programs connected to it to a single log. Every
+    frame holds whole records, so the records of each program stay
+    intact and in order, and frames from different programs are
+    written in the order they arrive. Every line starts with a source
+    column naming the host and pid of the program that wrote it.
+    --spool appends the frames left in spool files by programs that
+    could not reach the collector instead.
+"""
+
+from datetime import datetime
+import socketserver
+import threading
+import argparse
+import signal
+import socket
+import sys
+import os
+
+from .sinks import FRAME_HEADER, FRAME_HELLO, FRAME_DATA, parse_address
+
+HEADER = b"=== Log initialised at "
+COLLECTED_HEADER = b"=== Log collected at "
+
+# -----------------------------------------------------------------------------
+# The source column of the frames received before any HELLO frame,
+# e.g. from the spool files of older versions.
+# -----------------------------------------------------------------------------
+UNKNOWN_SOURCE = b"-  "
+
+
+def read_exact(rfile, size):
+
+    """ Read exactly size bytes.
+
+        :return: The bytes or None if the stream ended first.
+    """
+
+    data = rfile.read(size)
+    if len(data) < size:
+        return None
+    return data
+
+
+def source_column(source):
+
+    """ Get the source column of the frames of a source.
+
+        :param str source: The source named by a HELLO frame,
+                           'HOST:PID:FILENAME'.
+        :return: The column, 'HOST:PID' followed by the separator.
+    """
+
+    host, _, rest = source.partition(":")
+    pid = rest.partition(":")[0]
+    return "".join((host + ":" + pid).split()).encode("utf-8") + b"  "
+
+
+class Collector(object):
+
+    """ Merges the frames received from any number of sources into a
+        single log. Frames are written whole, one at a time.
+    """
+
+    def __init__(self, out):
+
+        """ Constructor for Collector.
+
+            :param out: The merged log opened for appending in binary
+                        mode. A header is written if it is empty.
+        """
+
+        self.out = out
+        self.lock = threading.Lock()
+
+        self.sources = set()
+        self.frames = 0
+        self.bytes = 0
+
+        if out.tell() == 0:
+            out.write(COLLECTED_HEADER + str(datetime.now()).encode() +
+                      b" ===\n\n")
+            out.flush()
+
+    def receive(self, rfile):
+
+        """ Read frames from a connection or a spool file until it
+            ends. A frame cut off at the end is dropped: the sink sends
+            it again in full.
+
+            :param rfile: The stream opened in binary mode.
+        """
+
+        column = UNKNOWN_SOURCE
+
+        while True:
+            header = read_exact(rfile, FRAME_HEADER.size)
+            if header is None:
+                return
+
+            length, kind = FRAME_HEADER.unpack(header)
+            payload = read_exact(rfile, length)
+            if payload is None:
+                return
+
+            if kind == FRAME_HELLO:
+                source = payload.decode("utf-8", "replace")
+                column = source_column(source)
+                with self.lock:
+                    self.sources.add(source)
+
+            elif kind == FRAME_DATA:
+                self.write(payload, column)
+
+    def write(self, payload, column=UNKNOWN_SOURCE):
+
+        """ Append the records of a frame to the merged log.
+
+            :param bytes column: The source column written before every
+                                 line.
+        """
+
+        # ---------------------------------------------------------------------
+        # Every log starts with its own header, in its first frame. The
+        # merged log only has one.
+        # ---------------------------------------------------------------------
+        if payload.startswith(HEADER):
+            payload = payload[payload.find(b"\n\n") + 2:]
+
+        if not payload:
+            return
+
+        # ---------------------------------------------------------------------
+        # Frames end with a newline, after which no column is written.
+        # ---------------------------------------------------------------------
+        payload = (column + payload[:-1].replace(b"\n", b"\n" + column) +
+                   payload[-1:])
+
+        with self.lock:
+            self.out.write(payload)
+            self.out.flush()
+            self.frames += 1
+            self.bytes += len(payload)
+
+    def report(self):
+
+        return "{} frames, {} bytes from {} sources".format(
+            self.frames, self.bytes, len(self.sources))
+
+
+class ReusableTCPServer(socketserver.ThreadingTCPServer):
+
+    """ A TCP server that can be restarted straight away on the same
+        port.
+    """
+
+    allow_reuse_address = True
+
+
+class ConnectionHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        self.server.collector.receive(self.rfile)
+
+
+def serve(address, collector):
+
+    """ Create the server that receives frames on an address.
+
+        :param str address: 'unix:PATH' or 'tcp:HOST:PORT'.
+        :param Collector collector: Where the frames go.
+        :return: The server, ready for serve_forever.
+    """
+
+    family, addr = parse_address(address)
+
+    if family == getattr(socket, "AF_UNIX", None):
+        # ---------------------------------------------------------------------
+        # A socket file left behind by an earlier collector would make
+        # binding fail.
+        # ---------------------------------------------------------------------
+        if os.path.exists(addr):
+            os.remove(addr)
+        server_class = socketserver.ThreadingUnixStreamServer
+    else:
+        server_class = ReusableTCPServer
+
+    server = server_class(addr, ConnectionHandler)
+    server.daemon_threads = True
+    server.collector = collector
+    return server
+
+
+def stop(signum, frame):
+    raise KeyboardInterrupt
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        prog="python -m pylg.collector",
+        description="Collect the logs sent by PyLg with PYLG_COLLECTOR "
+                    "into a single log.")
+    parser.add_argument("address", nargs="?",
+                        help="the address to listen on, 'unix:PATH' or "
+                             "'tcp:HOST:PORT'")
+    parser.add_argument("--output", metavar="LOG", required=True,
+                        help="the merged log to append to")
+    parser.add_argument("--spool", metavar="FILE", action="append",
+                        default=[],
+                        help="append the frames of a spool file instead of "
+                             "listening (can be repeated)")
+    args = parser.parse_args(argv)
+
+    if not args.address and not args.spool:
+        parser.error("an address or --spool is required")
+
+    with open(args.output, "ab") as out:
+        collector = Collector(out)
+
+        if args.spool:
+            for filename in args.spool:
+                with open(filename, "rb") as sfile:
+                    collector.receive(sfile)
+
+            print(collector.report(), file=sys.stderr)
+            return
+
+        server = serve(args.address, collector)
+        signal.signal(signal.SIGTERM, stop)
+
+        print("Collecting on " + args.address + " into " + args.output,
+              file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if server.address_family == getattr(socket, "AF_UNIX", None):
+                os.remove(server.server_address)
+
+        print(collector.report(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
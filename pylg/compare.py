@@ -0,0 +1,456 @@
+# -----------------------------------------------------------------------------
+# PyLg: module to facilitate and automate the process of writing runtime logs.
+# Copyright (C) 2017 Wojciech Kozlowski <wk@wojciechkozlowski.eu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+
+""" Compare the call durations of two PyLg runs.
+
+    Usage:
+
+        python -m pylg.compare OLD NEW [--json] [--sort KEY] [--limit N]
+                                       [--threshold PCT] [--min-time S]
+                                       [--min-calls N] [--all] [--fail]
+                                       [--jobs N]
+        python -m pylg.compare --save PROFILE LOG
+
+    OLD and NEW are PyLg logs, profiles saved with --save or the output
+    of 'python -m pylg.calltree --json'. Logs are streamed and parsed
+    in parallel processes. For every function, the number of calls and
+    the total, mean and percentile durations of its calls are compared
+    and the functions whose durations changed by more than the noise
+    thresholds are ranked by the relative change. Percentiles are
+    estimated from a histogram with a resolution of about 4%, and are
+    not available for calltree output.
+"""
+
+import argparse
+import math
+import json
+import sys
+
+from .calltree import CallTree, build
+
+PROFILE_VERSION = 1
+
+# -----------------------------------------------------------------------------
+# The histogram buckets are this many per doubling of the duration.
+# -----------------------------------------------------------------------------
+BUCKETS_PER_OCTAVE = 16
+
+PERCENTILES = (50, 90, 99)
+
+
+class DurationStats(object):
+
+    """ The durations of the calls of a single function: their number,
+        total, extremes and a log-scale histogram for the percentiles.
+        It takes the same memory however many calls it counts.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+        # ---------------------------------------------------------------------
+        # The number of calls per bucket. Calls that took no measurable
+        # time are counted in zeros. None if the durations are unknown,
+        # as in calltree output.
+        # ---------------------------------------------------------------------
+        self.buckets = {}
+        self.zeros = 0
+
+    def add(self, duration):
+
+        """ Count a call.
+
+            :param float duration: The duration of the call in seconds.
+        """
+
+        self.calls += 1
+        self.total += duration
+
+        if self.minimum is None or duration < self.minimum:
+            self.minimum = duration
+        if self.maximum is None or duration > self.maximum:
+            self.maximum = duration
+
+        if duration <= 0.0:
+            self.zeros += 1
+            return
+
+        index = int(math.floor(math.log2(duration) * BUCKETS_PER_OCTAVE))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    @property
+    def mean(self):
+        return self.total / self.calls if self.calls else None
+
+    def percentile(self, percent):
+
+        """ Estimate a percentile of the durations.
+
+            :param percent: The percentile, e.g. 90.
+            :return: The duration in seconds or None if the durations
+                     are unknown.
+        """
+
+        if self.buckets is None or not self.calls:
+            return None
+
+        rank = max(1, int(math.ceil(percent / 100.0 * self.calls)))
+        if rank <= self.zeros:
+            return 0.0
+
+        seen = self.zeros
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                break
+
+        # ---------------------------------------------------------------------
+        # The middle of the bucket, within the durations actually seen.
+        # ---------------------------------------------------------------------
+        value = 2.0 ** ((index + 0.5) / BUCKETS_PER_OCTAVE)
+        return min(max(value, self.minimum), self.maximum)
+
+    def summary(self):
+
+        """ The figures compared between runs.
+        """
+
+        summary = {"calls": self.calls, "total": self.total,
+                   "mean": self.mean}
+        for percent in PERCENTILES:
+            summary["p" + str(percent)] = self.percentile(percent)
+
+        return summary
+
+    def as_dict(self):
+        return {"calls": self.calls, "total": self.total,
+                "min": self.minimum, "max": self.maximum,
+                "zeros": self.zeros,
+                "buckets": dict((str(index), count) for index, count
+                                in self.buckets.items())}
+
+    @staticmethod
+    def from_dict(data):
+
+        """ Load the stats saved with as_dict or the function stats of
+            calltree output.
+        """
+
+        stats = DurationStats()
+        stats.calls = data["calls"]
+
+        if "buckets" not in data:
+            stats.total = data["inclusive"]
+            stats.buckets = None
+            return stats
+
+        stats.total = data["total"]
+        stats.minimum = data["min"]
+        stats.maximum = data["max"]
+        stats.zeros = data["zeros"]
+        stats.buckets = dict((int(index), count) for index, count
+                             in data["buckets"].items())
+        return stats
+
+
+class DurationTree(CallTree):
+
+    """ A CallTree that also keeps the durations of the calls of every
+        function. A call's duration is the wall time measured with
+        TRACE_DURATION if there is one, otherwise the time between its
+        ENTRY and EXIT records.
+    """
+
+    def __init__(self):
+        CallTree.__init__(self)
+        self.durations = {}
+
+    def close(self, thread, stack, time, metrics=None):
+
+        frame = stack[-1]
+
+        if metrics and "wall" in metrics:
+            duration = metrics["wall"]
+        else:
+            duration = (time - frame.start).total_seconds()
+
+        stats = self.durations.get(frame.name)
+        if stats is None:
+            stats = self.durations[frame.name] = DurationStats()
+        stats.add(duration)
+
+        CallTree.close(self, thread, stack, time, metrics)
+
+
+def profile(filename, jobs=1):
+
+    """ Stream a log file into a profile.
+
+        :param int jobs: The number of processes parsing the log, see
+                         parse_file.
+        :return: The profile, a dictionary that can be saved as JSON.
+    """
+
+    tree = build(filename, DurationTree(), jobs)
+    return {"version": PROFILE_VERSION,
+            "functions": dict((name, stats.as_dict()) for name, stats
+                              in tree.durations.items())}
+
+
+def load(filename, jobs=1):
+
+    """ Load the durations of a run from a log, a saved profile or
+        calltree output.
+
+        :param int jobs: The number of processes parsing a log.
+        :return: A dictionary of DurationStats keyed by function name.
+    """
+
+    with open(filename, "rb") as bfile:
+        first = bfile.read(1)
+
+    if first == b"{":
+        with open(filename) as jfile:
+            data = json.load(jfile)
+        if "version" in data:
+            data = data["functions"]
+    else:
+        data = profile(filename, jobs)["functions"]
+
+    return dict((name, DurationStats.from_dict(stats))
+                for name, stats in data.items())
+
+
+def change(old, new):
+
+    """ The relative change from old to new, None if it is undefined.
+    """
+
+    if old is None or new is None or old == 0:
+        return None
+    return (new - old) / old
+
+
+class Comparison(object):
+
+    """ The comparison of a single function between two runs.
+    """
+
+    def __init__(self, name, old, new):
+
+        """ Constructor for Comparison.
+
+            :param old: The DurationStats of the old run, None if the
+                        function was not called.
+            :param new: The DurationStats of the new run, None if the
+                        function was not called.
+        """
+
+        self.name = name
+        self.old = old.summary() if old is not None else None
+        self.new = new.summary() if new is not None else None
+
+        self.changes = {}
+        if old is not None and new is not None:
+            for key in self.old:
+                self.changes[key] = change(self.old[key], self.new[key])
+
+        self.status = None
+
+    def classify(self, key, threshold, min_time, min_calls):
+
+        """ Decide whether the function got slower or faster by the
+            given figure, ignoring changes within the noise thresholds.
+
+            :param str key: The figure, e.g. 'mean' or 'p90'.
+            :param float threshold: The smallest relative change.
+            :param float min_time: The smallest change in seconds.
+            :param int min_calls: The fewest calls in each run.
+        """
+
+        if self.old is None:
+            self.status = "new"
+            return
+        if self.new is None:
+            self.status = "gone"
+            return
+
+        self.status = "same"
+
+        relative = self.changes[key]
+        if relative is None or abs(relative) < threshold:
+            return
+
+        if key != "calls":
+            if min(self.old["calls"], self.new["calls"]) < min_calls:
+                return
+            if abs(self.new[key] - self.old[key]) < min_time:
+                return
+
+        self.status = "slower" if relative > 0 else "faster"
+
+    def as_dict(self):
+        return {"status": self.status, "old": self.old, "new": self.new,
+                "change": self.changes}
+
+
+def compare(old, new, key="mean", threshold=0.05, min_time=0.0,
+            min_calls=1):
+
+    """ Compare two runs.
+
+        :param old: The DurationStats of the old run by function name.
+        :param new: The DurationStats of the new run by function name.
+        :param str key: The figure the functions are classified and
+                        ranked by: 'calls', 'total', 'mean' or a
+                        percentile such as 'p90'.
+        :return: The Comparisons of all functions, the largest
+                 regressions first, then the largest improvements, then
+                 the unchanged functions and those only called in one
+                 of the runs.
+    """
+
+    comparisons = []
+    for name in set(old) | set(new):
+        comparison = Comparison(name, old.get(name), new.get(name))
+        comparison.classify(key, threshold, min_time, min_calls)
+        comparisons.append(comparison)
+
+    order = {"slower": 0, "faster": 1, "same": 2, "new": 3, "gone": 4}
+
+    def rank(comparison):
+        relative = comparison.changes.get(key) or 0.0
+        if comparison.status == "faster":
+            relative = -relative
+        return (order[comparison.status], -abs(relative), comparison.name)
+
+    return sorted(comparisons, key=rank)
+
+
+def percent(value):
+    if value is None:
+        return "{:>8}".format("-")
+    return "{:+7.1f}%".format(100.0 * value)
+
+
+def seconds(value):
+    if value is None:
+        return "{:>12}".format("-")
+    return "{:12.6f}".format(value)
+
+
+def print_table(comparisons):
+
+    print("{:40} {:>8} {:>8} {:>12} {:>12} {:>8} {:>8} {:>8} {:>8} "
+          "{:>8}  {}".format("function", "calls", "calls", "mean (s)",
+                             "mean (s)", "mean", "total", "p50", "p90",
+                             "p99", "status"))
+    print("{:40} {:>8} {:>8} {:>12} {:>12}".format("", "old", "new", "old",
+                                                   "new"))
+
+    for comparison in comparisons:
+        old = comparison.old or {}
+        new = comparison.new or {}
+        changes = comparison.changes
+
+        print("{:40} {:>8} {:>8} {} {} {} {} {} {} {}  {}".format(
+            comparison.name, old.get("calls", "-"), new.get("calls", "-"),
+            seconds(old.get("mean")), seconds(new.get("mean")),
+            percent(changes.get("mean")), percent(changes.get("total")),
+            percent(changes.get("p50")), percent(changes.get("p90")),
+            percent(changes.get("p99")), comparison.status))
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        prog="python -m pylg.compare",
+        description="Compare the call durations of two PyLg runs.")
+    parser.add_argument("runs", nargs="*", metavar="RUN",
+                        help="the old and the new run: PyLg logs, saved "
+                             "profiles or calltree --json output")
+    parser.add_argument("--save", metavar="PROFILE",
+                        help="save the profile of a single log for later "
+                             "comparisons instead")
+    parser.add_argument("--json", action="store_true",
+                        help="print the comparison as JSON")
+    parser.add_argument("--sort", default="mean",
+                        choices=["mean", "total", "calls"] +
+                                ["p" + str(p) for p in PERCENTILES],
+                        help="the figure to detect changes in and rank by "
+                             "(default: mean)")
+    parser.add_argument("--threshold", type=float, default=5.0,
+                        metavar="PCT",
+                        help="ignore changes smaller than PCT percent "
+                             "(default: 5)")
+    parser.add_argument("--min-time", type=float, default=0.0, metavar="S",
+                        help="ignore changes smaller than S seconds")
+    parser.add_argument("--min-calls", type=int, default=1, metavar="N",
+                        help="ignore functions called fewer than N times "
+                             "in either run")
+    parser.add_argument("--limit", type=int, default=0,
+                        help="only print the top LIMIT functions")
+    parser.add_argument("--all", action="store_true",
+                        help="also print the functions that did not change")
+    parser.add_argument("--fail", action="store_true",
+                        help="exit with status 1 if any function got slower")
+    parser.add_argument("--jobs", type=int, default=0,
+                        help="the number of processes parsing logs, "
+                             "0 for one per CPU (default: 0)")
+    args = parser.parse_args(argv)
+
+    if args.save:
+        if len(args.runs) != 1:
+            parser.error("--save takes a single log")
+        with open(args.save, "w") as jfile:
+            json.dump(profile(args.runs[0], args.jobs), jfile,
+                      sort_keys=True)
+        return
+
+    if len(args.runs) != 2:
+        parser.error("two runs are required")
+
+    old, new = [load(run, args.jobs) for run in args.runs]
+
+    comparisons = compare(old, new, args.sort, args.threshold / 100.0,
+                          args.min_time, args.min_calls)
+    slower = any(comparison.status == "slower" for comparison in comparisons)
+
+    if not args.all:
+        comparisons = [comparison for comparison in comparisons
+                       if comparison.status != "same"]
+    if args.limit:
+        comparisons = comparisons[:args.limit]
+
+    if args.json:
+        json.dump([dict(comparison.as_dict(), function=comparison.name)
+                   for comparison in comparisons], sys.stdout, indent=2,
+                  sort_keys=True)
+        print()
+    else:
+        print_table(comparisons)
+
+    if args.fail and slower:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
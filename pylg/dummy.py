@@ -25,6 +25,8 @@ class TraceFunctionDummy(TraceFunction):
     """ Dummy implementation of TraceFunction.
     """
 
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
 
         """ Constructor for dummy TraceFunction.
@@ -82,3 +84,47 @@ class TraceFunctionDummy(TraceFunction):
 
 def trace(message, function=None):
     pass
+
+
+class TraceContextDummy(object):
+
+    """ Dummy implementation of TraceContext.
+    """
+
+    def __init__(self, trace_id=None):
+        self.trace_id = trace_id
+
+    def __enter__(self):
+        return self.trace_id
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+
+def propagate(function):
+    return function
+
+
+def current_span():
+    return None
+
+
+class TraceProfilerDummy(object):
+
+    """ Dummy implementation of TraceProfiler.
+    """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
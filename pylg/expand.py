@@ -0,0 +1,113 @@
+# -----------------------------------------------------------------------------
+# PyLg: module to facilitate and automate the process of writing runtime logs.
+# Copyright (C) 2017 Wojciech Kozlowski <wk@wojciechkozlowski.eu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+
+""" Rewrite a log written with COMPACT_SITES in the full layout.
+
+    Usage:
+
+        python -m pylg.expand LOG [--output FILE]
+
+    The call site ids are replaced by the filename, line number and
+    function name columns enabled by the current settings, exactly as
+    trace would have written them.
+"""
+
+import argparse
+import sys
+
+from .loadSettings import *
+from .parser import LogParser
+from .pylg import site_columns, span_column
+
+HEADER = b"=== Log initialised at "
+
+
+def render(record):
+
+    """ Format a record in the full layout.
+
+        :param Record record: A record parsed from a compact log.
+        :return: The record's lines, including the final newline.
+    """
+
+    prefix = ""
+
+    if record.time is not None:
+        prefix += record.time.strftime(TIME_FORMAT) + "  "
+
+    if record.thread is not None:
+        prefix += '{thread:{w}.{w}}  '.format(thread=record.thread,
+                                              w=THREAD_COLUMN_WIDTH)
+
+    if TRACE_SPANS:
+        prefix += '{ids:{w}}  '.format(ids=span_column(record.trace,
+                                                       record.span,
+                                                       record.parent),
+                                       w=SPAN_COLUMN_WIDTH)
+
+    prefix += site_columns(record.filename, record.lineno, record.function)
+
+    indent = "\n" + " " * len(prefix)
+    return prefix + indent.join(record.message.split("\n")) + "\n"
+
+
+def expand(bfile, out):
+
+    """ Rewrite a compact log in the full layout.
+
+        :param bfile: The compact log opened in binary mode.
+        :param out: A text file to write the full log to.
+    """
+
+    first = bfile.readline()
+    if first.startswith(HEADER):
+        out.write(first.decode("utf-8", "replace") + "\n")
+    else:
+        bfile.seek(0)
+
+    # -------------------------------------------------------------------------
+    # Keep the call depth indentation as part of the message.
+    # -------------------------------------------------------------------------
+    parser = LogParser(COMPACT_SITES=True, INDENT_WIDTH=0)
+    for record in parser.parse(bfile, bfile.tell()):
+        out.write(render(record))
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        prog="python -m pylg.expand",
+        description="Rewrite a COMPACT_SITES log in the full layout.")
+    parser.add_argument("log", help="the compact PyLg log file")
+    parser.add_argument("--output", metavar="FILE",
+                        help="the file to write to (default: stdout)")
+    args = parser.parse_args(argv)
+
+    out = sys.stdout
+    if args.output:
+        out = open(args.output, "w", encoding="utf-8")
+
+    with open(args.log, "rb") as bfile:
+        expand(bfile, out)
+
+    if out is not sys.stdout:
+        out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# -----------------------------------------------------------------------------
+# PyLg: module to facilitate and automate the process of writing runtime logs.
+# Copyright (C) 2017 Wojciech Kozlowski <wk@wojciechkozlowski.eu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+
+""" A handler that writes the records of the logging module to the
+    PyLg log. It is kept out of the pylg package namespace so that
+    importing pylg does not import logging.
+
+    Usage:
+
+        import logging
+        from pylg.handler import PyLgHandler
+
+        logging.getLogger().addHandler(PyLgHandler())
+"""
+
+import logging
+
+from . import trace
+from .pylg import TraceFunction
+
+DEFAULT_FORMAT = "%(levelname)s %(name)s: %(message)s"
+
+
+class PyLgHandler(logging.Handler):
+
+    """ Writes LogRecords to the PyLg log with trace, in the columns of
+        the other records. The call site columns are those of the
+        logging call and the message is indented under the traced call
+        it is made from, like the message of a trace call. The time
+        and thread columns are those of the thread that handles the
+        record, which is the logging thread unless the handler sits
+        behind a QueueListener.
+
+        Records that PyLg itself passed to logging with PYLG_LOGGER are
+        ignored. If PyLg is disabled, records are dropped.
+    """
+
+    def __init__(self, level=logging.NOTSET, fmt=DEFAULT_FORMAT):
+
+        """ Constructor for PyLgHandler.
+
+            :param level: The handler's level.
+            :param str fmt: The format of the message column, see
+                            logging.Formatter. Traced calls already log
+                            the time and call site, so by default it
+                            only adds the level and the logger name.
+        """
+
+        super(PyLgHandler, self).__init__(level)
+        self.setFormatter(logging.Formatter(fmt))
+
+        # ---------------------------------------------------------------------
+        # The call sites seen so far, passed to trace in place of the
+        # TraceFunctionStruct of a traced function.
+        # ---------------------------------------------------------------------
+        self.sites = {}
+
+    def site(self, record):
+
+        """ Get the call site of a LogRecord.
+        """
+
+        key = (record.filename, record.lineno, record.funcName)
+
+        try:
+            return self.sites[key]
+        except KeyError:
+            pass
+
+        site = TraceFunction.TraceFunctionStruct()
+        site.filename, site.lineno, site.functionname = key
+        return self.sites.setdefault(key, site)
+
+    def emit(self, record):
+
+        """ Write a LogRecord to the PyLg log.
+        """
+
+        if hasattr(record, "pylg_span"):
+            return
+
+        try:
+            trace(self.format(record), function=self.site(record))
+        except Exception:
+            self.handleError(record)
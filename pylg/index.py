@@ -0,0 +1,321 @@
+# -----------------------------------------------------------------------------
+# PyLg: module to facilitate and automate the process of writing runtime logs.
+# Copyright (C) 2017 Wojciech Kozlowski <wk@wojciechkozlowski.eu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+
+""" Sidecar index for PyLg logs and a query tool that uses it.
+
+    Usage:
+
+        python -m pylg.index LOG [--start TIME] [--end TIME]
+                                 [--function NAME] [--slack SECONDS]
+
+    Prints the records logged between --start and --end and/or the
+    records of the functions matching the fnmatch-style pattern given
+    to --function. The log must have been written with PYLG_INDEX
+    enabled. Only the parts of the log the index points to are read.
+
+    The index is a text file named after the log with an '.idx'
+    suffix. It has three kinds of lines:
+
+        T <time> <offset>   - the record at <offset> was written at
+                              <time> (seconds since the epoch), one
+                              line every INDEX_INTERVAL seconds
+        D <id> <function>   - defines the id of a function name
+        F <id> <offset>     - a record of function <id> is at <offset>
+"""
+
+from datetime import datetime
+from fnmatch import fnmatch
+import argparse
+import mmap
+import time
+
+from .parser import LogParser, mmap_lines
+
+INDEX_SUFFIX = ".idx"
+
+
+class IndexWriter(object):
+
+    """ Writes the sidecar index as records are written to the log.
+    """
+
+    def __init__(self, filename, interval):
+
+        """ Constructor for IndexWriter.
+
+            :param str filename: The index file name.
+            :param interval: The number of seconds between time entries.
+        """
+
+        self.ifile = open(filename, "w")
+        self.interval = interval
+        self.next_time = 0.0
+        self.ids = {}
+
+    def add(self, offset, functionname):
+
+        """ Index a record.
+
+            :param int offset: The byte offset of the record in the log.
+            :param str functionname: The function name of the record or
+                                     None.
+        """
+
+        now = time.time()
+        if now >= self.next_time:
+            self.ifile.write("T {:.6f} {}\n".format(now, offset))
+            self.next_time = now + self.interval
+
+        if functionname is not None:
+            fid = self.ids.get(functionname)
+            if fid is None:
+                fid = self.ids[functionname] = len(self.ids)
+                self.ifile.write("D {} {}\n".format(fid, functionname))
+            self.ifile.write("F {} {}\n".format(fid, offset))
+
+    def close(self):
+        self.ifile.close()
+
+
+def to_timestamp(moment):
+
+    """ Convert a local naive datetime, as logged by trace, to seconds
+        since the epoch.
+    """
+
+    return time.mktime(moment.timetuple()) + moment.microsecond / 1e6
+
+
+class IndexedLog(object):
+
+    """ A log file opened together with its index. The log is memory
+        mapped and only the ranges the index points to are read.
+    """
+
+    def __init__(self, logname, indexname=None, **overrides):
+
+        """ Constructor for IndexedLog.
+
+            :param str logname: The log file name.
+            :param str indexname: The index file name. By default, the
+                                  log file name with an '.idx' suffix.
+            :param overrides: Layout settings that differ from the
+                              current settings, see LogParser.
+        """
+
+        self.indexname = indexname or logname + INDEX_SUFFIX
+        self.parser = LogParser(**overrides)
+
+        self.lfile = open(logname, "rb")
+        self.lfile.seek(0, 2)
+        self.size = self.lfile.tell()
+
+        self.mm = None
+        if self.size:
+            self.mm = mmap.mmap(self.lfile.fileno(), 0,
+                                access=mmap.ACCESS_READ)
+
+            if self.parser.compact_sites:
+                self.load_sites()
+
+    def load_sites(self):
+
+        """ Read the call site definitions of a COMPACT_SITES log. The
+            ranges the index points to do not necessarily include
+            them, so they are found with a byte search of the whole
+            log instead.
+        """
+
+        mm = self.mm
+        pos = mm.find(b"\n#")
+        while pos >= 0:
+            end = mm.find(b"\n", pos + 1)
+            if end < 0:
+                end = self.size
+            self.parser.define_site(mm[pos + 1:end].decode("utf-8",
+                                                           "replace"))
+            pos = mm.find(b"\n#", end)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.lfile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def entries(self):
+
+        """ Stream the index one parsed line at a time.
+
+            :return: A generator of (kind, first, second) tuples.
+        """
+
+        with open(self.indexname) as ifile:
+            for line in ifile:
+                kind, first, second = line.rstrip("\n").split(" ", 2)
+                yield kind, first, second
+
+    def time_range(self, start=None, end=None, slack=1.0):
+
+        """ Get the records logged within a time range.
+
+            :param datetime start: The start of the range or None.
+            :param datetime end: The end of the range or None.
+            :param float slack: The maximum number of seconds between a
+                                record's timestamp and the time it was
+                                written.
+            :return: A generator of Records.
+        """
+
+        if self.mm is None:
+            return
+
+        # ---------------------------------------------------------------------
+        # Every record before a T entry was written, and therefore
+        # logged, before its time. A record may have been written up
+        # to slack seconds after it was logged, so the end of the range
+        # is extended by slack.
+        # ---------------------------------------------------------------------
+        first = 0
+        last = self.size
+
+        start_ts = to_timestamp(start) if start is not None else None
+        end_ts = to_timestamp(end) + slack if end is not None else None
+
+        for kind, when, offset in self.entries():
+            if kind != "T":
+                continue
+            when = float(when)
+            if start_ts is not None and when < start_ts:
+                first = int(offset)
+            elif end_ts is not None and when > end_ts:
+                last = int(offset)
+                break
+
+        lines = mmap_lines(self.mm, first, last)
+        for record in self.parser.parse(lines, first):
+            if record.time is not None:
+                if start is not None and record.time < start:
+                    continue
+                if end is not None and record.time > end:
+                    continue
+            yield record
+
+    def function_records(self, pattern):
+
+        """ Get the records of the functions matching a pattern.
+
+            :param str pattern: An fnmatch-style pattern for the full
+                                function name.
+            :return: A generator of Records.
+        """
+
+        if self.mm is None:
+            return
+
+        ids = set()
+        offsets = []
+        for kind, first, second in self.entries():
+            if kind == "D":
+                if fnmatch(second, pattern):
+                    ids.add(first)
+            elif kind == "F" and first in ids:
+                offsets.append(int(second))
+
+        for offset in offsets:
+            lines = mmap_lines(self.mm, offset, self.size)
+            for record in self.parser.parse(lines, offset):
+                yield record
+                break
+
+
+def parse_time(parser, string):
+
+    """ Parse a time given on the command line either in TIME_FORMAT
+        or as 'YYYY-MM-DD HH:MM:SS'.
+    """
+
+    try:
+        return parser.parse_time(string)
+    except ValueError:
+        return datetime.strptime(string, "%Y-%m-%d %H:%M:%S")
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        prog="python -m pylg.index",
+        description="Query a PyLg log through its index.")
+    parser.add_argument("log", help="the PyLg log file")
+    parser.add_argument("--index", help="the index file (default: LOG.idx)")
+    parser.add_argument("--start", help="only records logged from this time")
+    parser.add_argument("--end", help="only records logged until this time")
+    parser.add_argument("--function",
+                        help="only records of functions matching this "
+                             "fnmatch-style pattern")
+    parser.add_argument("--slack", type=float, default=1.0,
+                        help="the maximum delay in seconds between logging "
+                             "and writing a record")
+    args = parser.parse_args(argv)
+
+    with IndexedLog(args.log, args.index) as log:
+
+        start = end = None
+        if args.start:
+            start = parse_time(log.parser, args.start)
+        if args.end:
+            end = parse_time(log.parser, args.end)
+
+        if args.function:
+            records = log.function_records(args.function)
+            if start is not None or end is not None:
+                records = (r for r in records if r.time is None or (
+                    (start is None or r.time >= start) and
+                    (end is None or r.time <= end)))
+        else:
+            records = log.time_range(start, end, args.slack)
+
+        for record in records:
+            print(record_text(log.mm, log.parser, record))
+
+
+def record_text(mm, parser, record):
+
+    """ Get the original text of a record, including its continuation
+        lines, from the log. The call site definitions of a
+        COMPACT_SITES log are written before the record that uses them
+        and so end the previous record too.
+    """
+
+    lines = []
+    for bline in mmap_lines(mm, record.offset, len(mm)):
+        line = bline.decode("utf-8", "replace").rstrip("\r\n")
+        if lines and (not line or parser.is_record_start(line) or
+                      parser.is_site_definition(line)):
+            break
+        lines.append(line)
+
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    main()
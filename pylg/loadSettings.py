@@ -16,15 +16,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # -----------------------------------------------------------------------------
 
-import traceback
 import warnings
-import inspect
 import sys
-import os
 
 # -----------------------------------------------------------------------------
 # Import all the defaults first.
 # -----------------------------------------------------------------------------
+from . import settings as defaults
 from .settings import *
 
 # -----------------------------------------------------------------------------
@@ -47,7 +45,7 @@ try:
     # -------------------------------------------------------------------------
     import pylg_settings
     from pylg_settings import *
-    PYLG_USER_FILE = inspect.getsourcefile(pylg_settings)
+    PYLG_USER_FILE = getattr(pylg_settings, "__file__", "pylg_settings")
 
 except ImportError:
     # -------------------------------------------------------------------------
@@ -58,6 +56,8 @@ except ImportError:
 
 except (NameError, SyntaxError):
 
+    import traceback
+
     warnings.warn("There was a problem importing user settings")
 
     sys.stderr.write("\n")
@@ -147,206 +147,284 @@ def pylg_check_pos_int(value, name):
         raise ImportError
 
 
-if PYLG_USER_FILE is not None:
-    # -------------------------------------------------------------------------
-    # If PYLG_USER_FILE is set, we have successfully imported user
-    # settings. Nowe, we need to sanity check them. If anything is
-    # wrong we reset the value to its default. At this stage a single
-    # error should not affect any other settings.
-    # -------------------------------------------------------------------------
+def pylg_check_nonneg_number(value, name):
 
-    # -------------------------------------------------------------------------
-    # PYLG_ENABLE - bool
-    # -------------------------------------------------------------------------
-    try:
-        pylg_check_bool(PYLG_ENABLE, "PYLG_ENABLE")
-    except ImportError:
-        from .settings import PYLG_ENABLE
+    if not isinstance(value, (int, float)) or isinstance(value, bool):
 
-    # -------------------------------------------------------------------------
-    # PYLG_FILE - string
-    # -------------------------------------------------------------------------
-    try:
-        pylg_check_string(PYLG_FILE, "PYLG_FILE")
-    except ImportError:
-        from .settings import PYLG_FILE
+        warning_msg = ("Invalid type for " + name + " in " +
+                       PYLG_USER_FILE +
+                       " - should be a number, is " +
+                       type(value).__name__)
 
-    # -------------------------------------------------------------------------
-    # DEFAULT_EXCEPTION_WARNING - bool
-    # -------------------------------------------------------------------------
-    try:
-        pylg_check_bool(DEFAULT_EXCEPTION_WARNING, "DEFAULT_EXCEPTION_WARNING")
-    except ImportError:
-        from .settings import DEFAULT_EXCEPTION_WARNING
+        warnings.warn(warning_msg)
 
-    # -------------------------------------------------------------------------
-    # DEFAULT_EXCEPTION_TB_FILE - bool
-    # -------------------------------------------------------------------------
-    try:
-        pylg_check_bool(DEFAULT_EXCEPTION_TB_FILE, "DEFAULT_EXCEPTION_TB_FILE")
-    except ImportError:
-        from .settings import DEFAULT_EXCEPTION_TB_FILE
+        raise ImportError
 
-    # -------------------------------------------------------------------------
-    # DEFAULT_EXCEPTION_TB_STDERR - bool
-    # -------------------------------------------------------------------------
-    try:
-        pylg_check_bool(DEFAULT_EXCEPTION_TB_STDERR,
-                        "DEFAULT_EXCEPTION_TB_STDERR")
-    except ImportError:
-        from .settings import DEFAULT_EXCEPTION_TB_STDERR
+    if value < 0:
 
-    # -------------------------------------------------------------------------
-    # DEFAULT_EXCEPTION_EXIT - bool
-    # -------------------------------------------------------------------------
-    try:
-        pylg_check_bool(DEFAULT_EXCEPTION_EXIT, "DEFAULT_EXCEPTION_EXIT")
-    except ImportError:
-        from .settings import DEFAULT_EXCEPTION_EXIT
+        warning_msg = ("Invalid value for " + name + " in " +
+                       PYLG_USER_FILE +
+                       " - should be non-negative, is " +
+                       str(value))
 
-    # -------------------------------------------------------------------------
-    # TRACE_TIME - bool
-    # -------------------------------------------------------------------------
-    try:
-        pylg_check_bool(TRACE_TIME, "TRACE_TIME")
-    except ImportError:
-        from .settings import TRACE_TIME
+        warnings.warn(warning_msg)
 
-    # -------------------------------------------------------------------------
-    # TIME_FORMAT - string
-    # -------------------------------------------------------------------------
-    try:
-        pylg_check_string(TIME_FORMAT, "TIME_FORMAT")
-    except ImportError:
-        from .settings import TIME_FORMAT
+        raise ImportError
 
-    # -------------------------------------------------------------------------
-    # TRACE_FILENAME - bool
-    # -------------------------------------------------------------------------
-    try:
-        pylg_check_bool(TRACE_FILENAME, "TRACE_FILENAME")
-    except ImportError:
-        from .settings import TRACE_FILENAME
 
-    # -------------------------------------------------------------------------
-    # FILENAME_COLUMN_WIDTH - non-negative integer
-    # -------------------------------------------------------------------------
-    try:
-        pylg_check_pos_int(FILENAME_COLUMN_WIDTH, "FILENAME_COLUMN_WIDTH")
-    except ImportError:
-        from .settings import FILENAME_COLUMN_WIDTH
+def pylg_check_callable(value, name):
 
-    # -------------------------------------------------------------------------
-    # TRACE_LINENO - bool
-    # -------------------------------------------------------------------------
-    try:
-        pylg_check_bool(TRACE_LINENO, "TRACE_LINENO")
-    except ImportError:
-        from .settings import TRACE_LINENO
+    if not callable(value):
 
-    # -------------------------------------------------------------------------
-    # LINENO_WIDTH - non-negative integer
-    # -------------------------------------------------------------------------
-    try:
-        pylg_check_nonneg_int(LINENO_WIDTH, "LINENO_WIDTH")
-    except ImportError:
-        from .settings import LINENO_WIDTH
+        warning_msg = ("Invalid type for " + name + " in " +
+                       PYLG_USER_FILE +
+                       " - should be callable, is " +
+                       type(value).__name__)
 
-    # -------------------------------------------------------------------------
-    # TRACE_FUNCTION - bool
-    # -------------------------------------------------------------------------
-    try:
-        pylg_check_bool(TRACE_FUNCTION, "TRACE_FUNCTION")
-    except ImportError:
-        from .settings import TRACE_FUNCTION
+        warnings.warn(warning_msg)
 
-    # -------------------------------------------------------------------------
-    # FUNCTION_COLUMN_WIDTH - non-negative integer
-    # -------------------------------------------------------------------------
-    try:
-        pylg_check_pos_int(FUNCTION_COLUMN_WIDTH, "FUNCTION_COLUMN_WIDTH")
-    except ImportError:
-        from .settings import FUNCTION_COLUMN_WIDTH
+        raise ImportError
 
-    # -------------------------------------------------------------------------
-    # CLASS_NAME_RESOLUTION - bool
-    # -------------------------------------------------------------------------
-    try:
-        pylg_check_bool(CLASS_NAME_RESOLUTION, "CLASS_NAME_RESOLUTION")
-    except ImportError:
-        from .settings import CLASS_NAME_RESOLUTION
 
-    # -------------------------------------------------------------------------
-    # TRACE_MESSAGE - bool
-    # -------------------------------------------------------------------------
-    try:
-        pylg_check_bool(TRACE_MESSAGE, "TRACE_MESSAGE")
-    except ImportError:
-        from .settings import TRACE_MESSAGE
+def pylg_check_filter_rules(value, name):
 
-    # -------------------------------------------------------------------------
-    # MESSAGE_WIDTH - non-negative integer - note 0 denotes unlimited
-    # -------------------------------------------------------------------------
-    try:
-        pylg_check_nonneg_int(MESSAGE_WIDTH, "MESSAGE_WIDTH")
-    except ImportError:
-        from .settings import MESSAGE_WIDTH
+    if not isinstance(value, list):
 
-    # -------------------------------------------------------------------------
-    # MESSAGE_WRAP - bool
-    # -------------------------------------------------------------------------
-    try:
-        pylg_check_bool(MESSAGE_WRAP, "MESSAGE_WRAP")
-    except ImportError:
-        from .settings import MESSAGE_WRAP
+        warning_msg = ("Invalid type for " + name + " in " +
+                       PYLG_USER_FILE +
+                       " - should be list, is " +
+                       type(value).__name__)
 
-    # -------------------------------------------------------------------------
-    # MESSAGE_MARK_TRUNCATION - bool
-    # -------------------------------------------------------------------------
-    try:
-        pylg_check_bool(MESSAGE_MARK_TRUNCATION, "MESSAGE_MARK_TRUNCATION")
-    except ImportError:
-        from .settings import MESSAGE_MARK_TRUNCATION
+        warnings.warn(warning_msg)
 
-    # -------------------------------------------------------------------------
-    # TRACE_SELF - bool
-    # -------------------------------------------------------------------------
-    try:
-        pylg_check_bool(TRACE_SELF, "TRACE_SELF")
-    except ImportError:
-        from .settings import TRACE_SELF
+        raise ImportError
 
-    # -------------------------------------------------------------------------
-    # COLLAPSE_LISTS - bool
-    # -------------------------------------------------------------------------
-    try:
-        pylg_check_bool(COLLAPSE_LISTS, "COLLAPSE_LISTS")
-    except ImportError:
-        from .settings import COLLAPSE_LISTS
+    for rule in value:
 
-    # -------------------------------------------------------------------------
-    # COLLAPSE_DICTS - bool
-    # -------------------------------------------------------------------------
-    try:
-        pylg_check_bool(COLLAPSE_DICTS, "COLLAPSE_DICTS")
-    except ImportError:
-        from .settings import COLLAPSE_DICTS
+        if not isinstance(rule, dict) or "function" not in rule:
 
-    # -------------------------------------------------------------------------
-    # DEFAULT_TRACE_ARGS - bool
-    # -------------------------------------------------------------------------
-    try:
-        pylg_check_bool(DEFAULT_TRACE_ARGS, "DEFAULT_TRACE_ARGS")
-    except ImportError:
-        from .settings import DEFAULT_TRACE_ARGS
+            warning_msg = ("Invalid rule in " + name + " in " +
+                           PYLG_USER_FILE +
+                           " - should be a dict with a 'function' "
+                           "pattern, is " + repr(rule))
 
+            warnings.warn(warning_msg)
+
+            raise ImportError
+
+        pylg_check_string(rule["function"], name + " 'function'")
+
+        for key in rule:
+            if key == "args" or key == "rv":
+                pylg_check_callable(rule[key], name + " '" + key + "'")
+            elif key == "min_duration":
+                pylg_check_nonneg_number(rule[key], name + " 'min_duration'")
+            elif key != "function":
+
+                warning_msg = ("Unknown key in " + name + " in " +
+                               PYLG_USER_FILE + " - " + repr(key))
+
+                warnings.warn(warning_msg)
+
+                raise ImportError
+
+
+def pylg_check_pos_number(value, name):
+
+    pylg_check_nonneg_number(value, name)
+
+    if value == 0:
+
+        warning_msg = ("Invalid value for " + name + " in " +
+                       PYLG_USER_FILE +
+                       " - should be positive, is " +
+                       str(value))
+
+        warnings.warn(warning_msg)
+
+        raise ImportError
+
+
+def pylg_check_collector(value, name):
+
+    if value is None:
+        return
+
+    pylg_check_string(value, name)
+
+    if not value.startswith(("unix:", "tcp:")):
+
+        warning_msg = ("Invalid value for " + name + " in " +
+                       PYLG_USER_FILE +
+                       " - should be 'unix:PATH' or 'tcp:HOST:PORT', is " +
+                       repr(value))
+
+        warnings.warn(warning_msg)
+
+        raise ImportError
+
+
+def pylg_check_ring(value, name):
+
+    pylg_check_nonneg_int(value, name)
+
+    if 0 < value < 4096:
+
+        warning_msg = ("Invalid value for " + name + " in " +
+                       PYLG_USER_FILE +
+                       " - should be 0 or at least 4096, is " +
+                       str(value))
+
+        warnings.warn(warning_msg)
+
+        raise ImportError
+
+
+def pylg_check_types(value, name):
+
+    if (not isinstance(value, (tuple, list)) or
+            not all(isinstance(item, type) for item in value)):
+
+        warning_msg = ("Invalid value for " + name + " in " +
+                       PYLG_USER_FILE +
+                       " - should be a tuple of types, is " +
+                       repr(value))
+
+        warnings.warn(warning_msg)
+
+        raise ImportError
+
+
+def pylg_check_logger(value, name):
+
+    if value is not None:
+        pylg_check_string(value, name)
+
+
+def pylg_check_level(value, name):
+
+    if isinstance(value, str):
+
+        if value not in ("CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"):
+
+            warning_msg = ("Invalid value for " + name + " in " +
+                           PYLG_USER_FILE +
+                           " - should be a logging level name, is " +
+                           repr(value))
+
+            warnings.warn(warning_msg)
+
+            raise ImportError
+
+    else:
+        pylg_check_nonneg_int(value, name)
+
+
+def pylg_check_snapshot(value, name):
+
+    pylg_check_string(value, name)
+
+    if value not in ("reference", "shallow"):
+
+        warning_msg = ("Invalid value for " + name + " in " +
+                       PYLG_USER_FILE +
+                       " - should be 'reference' or 'shallow', is " +
+                       repr(value))
+
+        warnings.warn(warning_msg)
+
+        raise ImportError
+
+
+# -----------------------------------------------------------------------------
+# The validation table. Every setting is listed with the function
+# that checks its value.
+# -----------------------------------------------------------------------------
+SETTINGS_CHECKS = [
+    ("PYLG_ENABLE", pylg_check_bool),
+    ("PYLG_FILE", pylg_check_string),
+    ("DEFAULT_EXCEPTION_WARNING", pylg_check_bool),
+    ("DEFAULT_EXCEPTION_TB_FILE", pylg_check_bool),
+    ("DEFAULT_EXCEPTION_TB_STDERR", pylg_check_bool),
+    ("DEFAULT_EXCEPTION_TB_SUMMARY", pylg_check_bool),
+    ("DEFAULT_EXCEPTION_EXIT", pylg_check_bool),
+    ("TRACE_TIME", pylg_check_bool),
+    ("TIME_FORMAT", pylg_check_string),
+    ("TRACE_THREAD", pylg_check_bool),
+    ("THREAD_COLUMN_WIDTH", pylg_check_pos_int),
+    ("TRACE_SPANS", pylg_check_bool),
+    ("SPAN_COLUMN_WIDTH", pylg_check_pos_int),
+    ("TRACE_FILENAME", pylg_check_bool),
+    ("FILENAME_COLUMN_WIDTH", pylg_check_pos_int),
+    ("TRACE_LINENO", pylg_check_bool),
+    ("LINENO_WIDTH", pylg_check_nonneg_int),
+    ("TRACE_FUNCTION", pylg_check_bool),
+    ("FUNCTION_COLUMN_WIDTH", pylg_check_pos_int),
+    ("CLASS_NAME_RESOLUTION", pylg_check_bool),
+    ("INDENT_WIDTH", pylg_check_nonneg_int),
+    ("TRACE_MESSAGE", pylg_check_bool),
+    # 0 denotes unlimited.
+    ("MESSAGE_WIDTH", pylg_check_nonneg_int),
+    ("MESSAGE_WRAP", pylg_check_bool),
+    ("MESSAGE_MARK_TRUNCATION", pylg_check_bool),
+    ("TRACE_SELF", pylg_check_bool),
+    ("COLLAPSE_LISTS", pylg_check_bool),
+    ("COLLAPSE_DICTS", pylg_check_bool),
+    # 0 denotes disabled.
+    ("RENDER_CACHE", pylg_check_nonneg_int),
+    ("RENDER_CACHE_TYPES", pylg_check_types),
+    ("DEFAULT_TRACE_ARGS", pylg_check_bool),
+    ("DEFAULT_TRACE_RV", pylg_check_bool),
+    ("DEFAULT_TRACE_RV_TYPE", pylg_check_bool),
+    ("TRACE_DURATION", pylg_check_bool),
+    ("TRACE_CPU_TIME", pylg_check_bool),
+    ("TRACE_ALLOCATIONS", pylg_check_bool),
+    # 0 denotes unlimited.
+    ("DEFAULT_MAX_DEPTH", pylg_check_nonneg_int),
+    ("DEFAULT_RECURSION_LIMIT", pylg_check_nonneg_int),
+    # 0 denotes every call is logged.
+    ("DEFAULT_MIN_DURATION", pylg_check_nonneg_number),
+    ("FILTER_RULES", pylg_check_filter_rules),
+    ("PYLG_STATS", pylg_check_bool),
+    # 0 denotes never.
+    ("STATS_INTERVAL", pylg_check_nonneg_number),
+    ("PYLG_INDEX", pylg_check_bool),
+    ("INDEX_INTERVAL", pylg_check_pos_int),
+    ("THREAD_BUFFER", pylg_check_nonneg_int),
+    ("THREAD_FILES", pylg_check_bool),
+    # 0 denotes regular writes.
+    ("MMAP_CHUNK", pylg_check_nonneg_int),
+    # None denotes local files.
+    ("PYLG_COLLECTOR", pylg_check_collector),
+    ("COLLECTOR_BATCH", pylg_check_pos_int),
+    ("COLLECTOR_LATENCY", pylg_check_pos_number),
+    ("COLLECTOR_TIMEOUT", pylg_check_pos_number),
+    ("COLLECTOR_RETRY", pylg_check_nonneg_number),
+    # None denotes log files.
+    ("PYLG_LOGGER", pylg_check_logger),
+    ("LOGGER_LEVEL", pylg_check_level),
+    # 0 denotes log files.
+    ("PYLG_RING", pylg_check_ring),
+    ("COMPACT_SITES", pylg_check_bool),
+    ("DEFERRED_FORMAT", pylg_check_bool),
+    ("DEFERRED_SNAPSHOT", pylg_check_snapshot),
+]
+
+if PYLG_USER_FILE is not None:
     # -------------------------------------------------------------------------
-    # DEFAULT_TRACE_RV - bool
-    # -------------------------------------------------------------------------
-    try:
-        pylg_check_bool(DEFAULT_TRACE_RV, "DEFAULT_TRACE_RV")
-    except ImportError:
-        from .settings import DEFAULT_TRACE_RV
+    # If PYLG_USER_FILE is set, we have successfully imported user
+    # settings. Now, we need to sanity check them in a single pass
+    # over the table. If anything is wrong we reset the value to its
+    # default. At this stage a single error should not affect any
+    # other settings.
+    # -------------------------------------------------------------------------
+    for name, check in SETTINGS_CHECKS:
+        try:
+            check(globals()[name], name)
+        except ImportError:
+            globals()[name] = getattr(defaults, name)
+
+    del name, check
 
 # -----------------------------------------------------------------------------
 # Some final value processing.
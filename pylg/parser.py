@@ -0,0 +1,528 @@
+# -----------------------------------------------------------------------------
+# PyLg: module to facilitate and automate the process of writing runtime logs.
+# Copyright (C) 2017 Wojciech Kozlowski <wk@wojciechkozlowski.eu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+
+from collections import namedtuple
+from datetime import datetime
+import mmap
+import os
+import re
+import io
+
+from .loadSettings import *
+
+# -----------------------------------------------------------------------------
+# A single parsed log record. Continuation lines of wrapped and
+# multi-line messages are joined into message with newlines. offset is
+# the byte offset of the record in the log file. trace, span and
+# parent are the ids of the span column, None if not set. source is
+# the host and pid of the program that wrote the record in a log
+# merged by pylg.collector, None in other logs.
+# -----------------------------------------------------------------------------
+Record = namedtuple("Record", ["time", "thread", "filename", "lineno",
+                               "function", "message", "offset", "trace",
+                               "span", "parent", "source"])
+Record.__new__.__defaults__ = (None, None, None, None)
+
+DEFAULT_TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+# -----------------------------------------------------------------------------
+# The size of the chunks parse_file splits a log into when it parses
+# in parallel. The records of a chunk are parsed by one process and
+# sent back in one go, so this bounds the memory used per process.
+# -----------------------------------------------------------------------------
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# -----------------------------------------------------------------------------
+# A call site definition line in a COMPACT_SITES log, and in one
+# merged by pylg.collector, where it follows the source column.
+# -----------------------------------------------------------------------------
+SITE_DEFINITION = re.compile(rb"^#[^\t\n]*\t[^\t\n]*\t[^\t\n]*\t[^\n]*$",
+                             re.MULTILINE)
+SOURCE_SITE_DEFINITION = re.compile(
+    rb"^[^ \n]*  #[^\t\n]*\t[^\t\n]*\t[^\t\n]*\t[^\n]*$", re.MULTILINE)
+
+# -----------------------------------------------------------------------------
+# The header of a log merged by pylg.collector. Every line of such a
+# log starts with a source column.
+# -----------------------------------------------------------------------------
+COLLECTED_HEADER = "=== Log collected at "
+HEADERS = ("=== Log initialised at ", COLLECTED_HEADER)
+
+
+def parse_default_time(string):
+
+    """ Fast parser for timestamps in the default TIME_FORMAT.
+    """
+
+    return datetime(int(string[0:4]), int(string[5:7]), int(string[8:10]),
+                    int(string[11:13]), int(string[14:16]),
+                    int(string[17:19]), int(string[20:26]))
+
+
+class LogParser(object):
+
+    """ Parser for the column layout written by trace. The layout is
+        taken from the settings, which must therefore match the ones
+        the log was written with. Any of them can be overridden with
+        keyword arguments, e.g. LogParser(TRACE_TIME=False).
+        TRACE_SOURCE is not a setting: it is set for the logs merged by
+        pylg.collector, which are recognised by their header.
+    """
+
+    def __init__(self, **overrides):
+
+        """ Constructor for LogParser.
+
+            :param overrides: Layout settings that differ from the
+                              current settings.
+        """
+
+        layout = dict(TRACE_TIME=TRACE_TIME,
+                      TIME_FORMAT=TIME_FORMAT,
+                      TRACE_THREAD=TRACE_THREAD,
+                      THREAD_COLUMN_WIDTH=THREAD_COLUMN_WIDTH,
+                      TRACE_SPANS=TRACE_SPANS,
+                      SPAN_COLUMN_WIDTH=SPAN_COLUMN_WIDTH,
+                      TRACE_FILENAME=TRACE_FILENAME,
+                      FILENAME_COLUMN_WIDTH=FILENAME_COLUMN_WIDTH,
+                      TRACE_LINENO=TRACE_LINENO,
+                      TRACE_FUNCTION=TRACE_FUNCTION,
+                      FUNCTION_COLUMN_WIDTH=FUNCTION_COLUMN_WIDTH,
+                      COMPACT_SITES=COMPACT_SITES,
+                      INDENT_WIDTH=INDENT_WIDTH,
+                      TRACE_SOURCE=False)
+
+        for name, value in overrides.items():
+            assert name in layout, "Unknown layout setting " + name
+            layout[name] = value
+
+        self.trace_time = layout["TRACE_TIME"]
+        self.time_format = layout["TIME_FORMAT"]
+        self.trace_thread = layout["TRACE_THREAD"]
+        self.thread_width = layout["THREAD_COLUMN_WIDTH"]
+        self.trace_spans = layout["TRACE_SPANS"]
+        self.span_width = layout["SPAN_COLUMN_WIDTH"]
+        self.trace_filename = layout["TRACE_FILENAME"]
+        self.filename_width = layout["FILENAME_COLUMN_WIDTH"]
+        self.trace_lineno = layout["TRACE_LINENO"]
+        self.trace_function = layout["TRACE_FUNCTION"]
+        self.function_width = layout["FUNCTION_COLUMN_WIDTH"]
+        self.compact_sites = layout["COMPACT_SITES"]
+        self.indent_width = layout["INDENT_WIDTH"]
+        self.trace_source = layout["TRACE_SOURCE"]
+
+        # ---------------------------------------------------------------------
+        # The call sites defined so far in a COMPACT_SITES log, mapping
+        # the id to the filename, line number and function name. The
+        # ids are only unique within a program, so in a merged log they
+        # are keyed by the (source, id) tuple instead.
+        # ---------------------------------------------------------------------
+        self.sites = {}
+
+        # ---------------------------------------------------------------------
+        # The time column has no padding so its width is taken from a
+        # formatted timestamp.
+        # ---------------------------------------------------------------------
+        self.time_width = len(datetime.now().strftime(self.time_format))
+
+        if self.time_format == DEFAULT_TIME_FORMAT:
+            self.parse_time = parse_default_time
+        else:
+            self.parse_time = self.parse_custom_time
+
+        # ---------------------------------------------------------------------
+        # If no prefix column is enabled, every line is a new record.
+        # ---------------------------------------------------------------------
+        self.has_prefix = (self.trace_time or self.trace_thread or
+                           self.trace_spans or self.trace_filename or
+                           self.trace_lineno or self.trace_function or
+                           self.compact_sites)
+
+    def parse_custom_time(self, string):
+        return datetime.strptime(string, self.time_format)
+
+    def split_source(self, line):
+
+        """ Split the source column off a line of a log merged by
+            pylg.collector. The other methods take lines without it.
+
+            :param str line: The line without the trailing newline.
+            :return: A (source, line) tuple. source is None if the log
+                     has no source column.
+        """
+
+        if not self.trace_source:
+            return None, line
+
+        source, _, line = line.partition("  ")
+        return source, line
+
+    def is_site_definition(self, line):
+
+        """ Check whether a line defines a call site in a
+            COMPACT_SITES log.
+        """
+
+        return self.compact_sites and line.startswith("#")
+
+    def define_site(self, line, source=None):
+
+        """ Read a call site definition.
+
+            :param str line: The line without the trailing newline.
+            :param str source: The source of the line in a merged log.
+        """
+
+        site_id, filename, lineno, function = line[1:].split("\t", 3)
+        if source is not None:
+            site_id = (source, site_id)
+        self.sites[site_id] = (filename, int(lineno), function)
+
+    def is_record_start(self, line):
+
+        """ Check whether a line starts a new record rather than
+            continuing the message of the previous one.
+
+            :param str line: The line without the trailing newline.
+        """
+
+        if not line or line.startswith(HEADERS):
+            return False
+
+        if self.is_site_definition(line):
+            return False
+
+        return not self.has_prefix or line[0] != " "
+
+    def parse_line(self, line, offset=None, source=None):
+
+        """ Parse the first line of a record.
+
+            :param str line: The line without the trailing newline.
+            :param int offset: The byte offset of the line.
+            :param str source: The source of the line in a merged log.
+            :return: A tuple of the Record and the length of the prefix
+                     used to strip continuation lines.
+        """
+
+        pos = 0
+        time = thread = filename = lineno = function = None
+        ids = (None, None, None)
+
+        if self.trace_time:
+            time = self.parse_time(line[:self.time_width])
+            pos = self.time_width + 2
+
+        if self.trace_thread:
+            thread = line[pos:pos + self.thread_width].rstrip()
+            pos += self.thread_width + 2
+
+        if self.trace_spans:
+            # -----------------------------------------------------------------
+            # The ids are never truncated, so the column can be wider
+            # than its width.
+            # -----------------------------------------------------------------
+            end = line.index(" ", pos)
+            ids = line[pos:end].split("/")
+            if len(ids) != 3:
+                raise ValueError("Invalid span column " + line[pos:end])
+            ids = tuple(None if value == "-" else value for value in ids)
+            pos = max(end, pos + self.span_width) + 2
+
+        if self.compact_sites:
+            end = line.index(" ", pos)
+            site_id = line[pos + 1:end]
+            if source is not None:
+                site_id = (source, site_id)
+            site = self.sites.get(site_id)
+            if site is None:
+                raise ValueError("Undefined call site " + line[pos:end])
+            filename, lineno, function = site
+            pos = end + 2
+
+        else:
+            if self.trace_filename:
+                filename = line[pos:pos + self.filename_width].rstrip()
+                pos += self.filename_width + 2
+
+            if self.trace_lineno:
+                end = line.index(": ", pos)
+                lineno = int(line[pos:end])
+                pos = end + 2
+
+            if self.trace_function:
+                function = line[pos:pos + self.function_width].rstrip()
+                pos += self.function_width + 2
+
+        message = line[pos:]
+
+        # ---------------------------------------------------------------------
+        # The indentation showing the call depth is not part of the
+        # message, but continuation lines are indented by as much.
+        # ---------------------------------------------------------------------
+        if self.indent_width:
+            stripped = message.lstrip(" ")
+            pos += len(message) - len(stripped)
+            message = stripped
+
+        record = Record(time, thread, filename, lineno, function, message,
+                        offset, *ids, source)
+        return record, pos
+
+    def parse(self, bfile, offset=0):
+
+        """ Parse a log file one record at a time. The file is
+            streamed so memory use does not depend on its size.
+
+            :param bfile: A log file opened in binary mode or any other
+                          iterable of lines as bytes.
+            :param int offset: The byte offset of the first line.
+            :return: A generator of Records.
+        """
+
+        record = None
+        prefix_len = 0
+        continuation = []
+
+        source = None
+        trace_source = self.trace_source
+
+        for bline in bfile:
+
+            line = bline.decode("utf-8", "replace").rstrip("\r\n")
+
+            if trace_source:
+                source, _, line = line.partition("  ")
+
+            if self.is_site_definition(line):
+                self.define_site(line, source)
+
+            elif self.is_record_start(line):
+
+                if record is not None:
+                    yield self.finish(record, continuation)
+
+                try:
+                    record, prefix_len = self.parse_line(line, offset,
+                                                         source)
+                except ValueError:
+                    # ---------------------------------------------------------
+                    # Not a line written by trace with this layout.
+                    # ---------------------------------------------------------
+                    record = None
+
+                continuation = []
+
+            elif record is not None and line:
+                continuation.append(line[prefix_len:])
+
+            elif line.startswith(COLLECTED_HEADER):
+                trace_source = self.trace_source = True
+
+            offset += len(bline)
+
+        if record is not None:
+            yield self.finish(record, continuation)
+
+    @staticmethod
+    def finish(record, continuation):
+
+        if continuation:
+            message = "\n".join([record.message] + continuation)
+            record = record._replace(message=message)
+
+        return record
+
+
+def parse_file(filename, jobs=1, chunk_size=CHUNK_SIZE, **overrides):
+
+    """ Parse a log file one record at a time.
+
+        :param str filename: The log file name.
+        :param int jobs: The number of processes to parse the log in,
+                         0 for one per CPU. See parse_parallel.
+        :param int chunk_size: The size of the chunks parsed by each
+                               process.
+        :param overrides: Layout settings that differ from the current
+                          settings, see LogParser.
+        :return: A generator of Records.
+    """
+
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+
+    if jobs > 1 and os.path.getsize(filename) > chunk_size:
+        records = parse_parallel(filename, jobs, chunk_size, overrides)
+    else:
+        records = parse_serial(filename, overrides)
+
+    for record in records:
+        yield record
+
+
+def parse_serial(filename, overrides):
+
+    parser = LogParser(**overrides)
+    with open(filename, "rb") as bfile:
+        for record in parser.parse(bfile):
+            yield record
+
+
+def mmap_lines(mm, start, end):
+
+    """ Generate the lines of a memory-mapped file between two byte
+        offsets.
+    """
+
+    pos = start
+    while pos < end:
+        newline = mm.find(b"\n", pos, end)
+        if newline < 0:
+            newline = end - 1
+        yield mm[pos:newline + 1]
+        pos = newline + 1
+
+
+def chunk_bounds(mm, parser, chunk_size):
+
+    """ Split a memory-mapped log into chunks that start with a record.
+        A chunk boundary is moved forward past continuation lines, so
+        wrapped and multi-line messages and tracebacks are never split
+        from their record.
+
+        :param LogParser parser: The parser of the log's layout.
+        :param int chunk_size: The approximate size of a chunk.
+        :return: The list of the start offsets of the chunks, followed
+                 by the size of the log.
+    """
+
+    size = len(mm)
+    bounds = [0]
+
+    pos = chunk_size
+    while pos < size:
+
+        # ---------------------------------------------------------------------
+        # Find the first line starting at or after pos that starts a
+        # record.
+        # ---------------------------------------------------------------------
+        start = mm.rfind(b"\n", 0, pos) + 1
+        if start < pos:
+            start = mm.find(b"\n", pos)
+            start = size if start < 0 else start + 1
+
+        for bline in mmap_lines(mm, start, size):
+            line = bline.decode("utf-8", "replace").rstrip("\r\n")
+            if parser.is_record_start(parser.split_source(line)[1]):
+                break
+            start += len(bline)
+
+        if start >= size:
+            break
+
+        bounds.append(start)
+        pos = start + chunk_size
+
+    bounds.append(size)
+    return bounds
+
+
+def parse_chunk(filename, start, end, sites, overrides):
+
+    """ Parse a chunk of a log in a worker process.
+
+        :param dict sites: The call sites of a COMPACT_SITES log, as
+                           LogParser.sites, as a chunk may use sites
+                           defined in earlier ones.
+        :return: The list of the chunk's Records as plain tuples,
+                 which are much faster to send back.
+    """
+
+    parser = LogParser(**overrides)
+    parser.sites.update(sites)
+
+    with open(filename, "rb") as bfile:
+        mm = mmap.mmap(bfile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            data = mm[start:end]
+        finally:
+            mm.close()
+
+    return [tuple(record) for record in parser.parse(io.BytesIO(data), start)]
+
+
+def parse_parallel(filename, jobs, chunk_size, overrides):
+
+    """ Parse a log in a pool of processes. The memory-mapped log is
+        split into chunks that start with a record, see chunk_bounds,
+        and the chunks are parsed in parallel. Their records are
+        generated in the order of the log, with at most two chunks per
+        process parsed ahead of the consumer.
+
+        :param int jobs: The number of processes.
+        :return: A generator of Records.
+    """
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with open(filename, "rb") as bfile:
+        mm = mmap.mmap(bfile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # -----------------------------------------------------------------
+            # The chunks after the first do not have the header that
+            # tells a merged log apart.
+            # -----------------------------------------------------------------
+            if mm[:len(COLLECTED_HEADER)] == COLLECTED_HEADER.encode():
+                overrides = dict(overrides, TRACE_SOURCE=True)
+
+            parser = LogParser(**overrides)
+            bounds = chunk_bounds(mm, parser, chunk_size)
+
+            # -----------------------------------------------------------------
+            # All call site definitions are collected up front so that
+            # every chunk can resolve the sites it uses.
+            # -----------------------------------------------------------------
+            if parser.compact_sites:
+                if parser.trace_source:
+                    definitions = SOURCE_SITE_DEFINITION
+                else:
+                    definitions = SITE_DEFINITION
+
+                for match in definitions.finditer(mm):
+                    line = match.group().decode("utf-8", "replace")
+                    source, line = parser.split_source(line)
+                    parser.define_site(line, source)
+        finally:
+            mm.close()
+
+    chunks = list(zip(bounds[:-1], bounds[1:]))
+    pending = []
+    make = Record._make
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for start, end in chunks:
+            pending.append(pool.submit(parse_chunk, filename, start, end,
+                                       parser.sites, overrides))
+
+            if len(pending) >= 2 * jobs:
+                for values in pending.pop(0).result():
+                    yield make(values)
+
+        for future in pending:
+            for values in future.result():
+                yield make(values)
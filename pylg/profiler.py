@@ -0,0 +1,432 @@
+# -----------------------------------------------------------------------------
+# PyLg: module to facilitate and automate the process of writing runtime logs.
+# Copyright (C) 2017 Wojciech Kozlowski <wk@wojciechkozlowski.eu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+
+import sys
+import os
+
+from .pylg import TraceFunction, trace, entry_message, exit_message
+from .pylg import LazyMessage, snapshot, snapshot_value
+from .pylg import BindingPlan, CO_VARARGS, CO_VARKEYWORDS
+from .loadSettings import *
+
+# -----------------------------------------------------------------------------
+# The directory of the PyLg package. Code in here is never traced as
+# it would recurse into the tracer itself.
+# -----------------------------------------------------------------------------
+PYLG_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def frame_arguments(plan, values):
+
+    """ Turn the arguments of a traced frame back into the arguments
+        of the call, so that the ENTRY message is built by the same
+        BindingPlan code as for TraceFunction.
+
+        :param plan: The BindingPlan of the frame's code.
+        :param values: The values of the frame's arguments in the order
+                       of co_varnames: positional, keyword-only, then
+                       *args and **kwargs.
+        :return: An (args, kwargs) tuple.
+    """
+
+    n_positional = plan.n_positional
+    n_keyword = n_positional + len(plan.keyword_slots)
+
+    args = tuple(values[:n_positional])
+    kwargs = dict(zip([name for _, name, _ in plan.keyword_slots],
+                      values[n_positional:n_keyword]))
+
+    rest = n_keyword
+    if plan.var_positional is not None:
+        args += tuple(values[rest] or ())
+        rest += 1
+
+    if plan.var_keyword is not None:
+        kwargs.update(values[rest] or {})
+
+    return args, kwargs
+
+
+class PatternSet(object):
+
+    """ A set of name patterns compiled for fast lookups. Names
+        without wildcards go into a set and the remaining patterns
+        are compiled into a single regular expression.
+    """
+
+    def __init__(self, patterns):
+
+        """ Constructor for PatternSet.
+
+            :param patterns: An iterable of fnmatch-style patterns or
+                             None to match everything.
+        """
+
+        self.match_all = patterns is None
+        self.exact = set()
+        self.regex = None
+
+        if patterns is None:
+            return
+
+        from fnmatch import translate
+        import re
+
+        wildcards = []
+        for pattern in patterns:
+            if any(c in pattern for c in "*?["):
+                wildcards.append(translate(pattern))
+            else:
+                self.exact.add(pattern)
+
+        if wildcards:
+            self.regex = re.compile("|".join(wildcards))
+
+    def __contains__(self, name):
+
+        if self.match_all or name in self.exact:
+            return True
+
+        return self.regex is not None and self.regex.match(name) is not None
+
+
+class TraceProfiler(object):
+
+    """ Whole-program alternative to TraceFunction. Instead of
+        wrapping functions in decorator objects it uses the
+        interpreter's profiling hooks (sys.monitoring on Python 3.12+,
+        sys.setprofile otherwise) to trace every function whose module
+        and name match the given patterns. It writes the same ENTRY
+        and EXIT records as TraceFunction.
+
+        Used either with start/stop or as a context manager:
+
+            with TraceProfiler(modules=["myapp.*"]):
+                main()
+    """
+
+    def __init__(self, modules=None, functions=None, backend="auto",
+                 trace_args=DEFAULT_TRACE_ARGS,
+                 trace_rv=DEFAULT_TRACE_RV,
+                 trace_rv_type=DEFAULT_TRACE_RV_TYPE):
+
+        """ Constructor for TraceProfiler.
+
+            :param modules: fnmatch-style patterns for the module names
+                            to trace. None means all modules.
+            :param functions: fnmatch-style patterns for the qualified
+                              function names to trace. None means all
+                              functions.
+            :param str backend: One of 'auto', 'monitoring' or
+                                'setprofile'.
+            :param bool trace_args: If True, log input parameters.
+            :param bool trace_rv: If True, log return values.
+            :param bool trace_rv_type: If True, log return value types.
+        """
+
+        assert backend in ("auto", "monitoring", "setprofile")
+
+        if backend == "auto":
+            if hasattr(sys, "monitoring"):
+                backend = "monitoring"
+            else:
+                backend = "setprofile"
+
+        if backend == "monitoring" and not hasattr(sys, "monitoring"):
+            raise ValueError("sys.monitoring requires Python 3.12+")
+
+        self.backend = backend
+
+        self.modules = PatternSet(modules)
+        self.functions = PatternSet(functions)
+
+        self.trace_args = trace_args
+        self.trace_rv = trace_rv
+        self.trace_rv_type = trace_rv_type
+
+        # ---------------------------------------------------------------------
+        # Map from code objects to their TraceFunctionStruct or None
+        # if the code object is not traced. The filter decision is
+        # made only once per code object.
+        # ---------------------------------------------------------------------
+        self.structs = {}
+
+        self.tool_id = None
+        self.running = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+
+    def start(self):
+
+        """ Start tracing.
+        """
+
+        assert not self.running
+
+        if self.backend == "monitoring":
+            self.start_monitoring()
+        else:
+            self.start_setprofile()
+
+        self.running = True
+
+    def stop(self):
+
+        """ Stop tracing.
+        """
+
+        assert self.running
+
+        if self.backend == "monitoring":
+            self.stop_monitoring()
+        else:
+            self.stop_setprofile()
+
+        self.running = False
+
+    def lookup(self, code, frame):
+
+        """ Get the TraceFunctionStruct for a code object, deciding
+            whether it should be traced if it has not been seen before.
+
+            :param code: The code object.
+            :param frame: A frame executing the code object.
+            :return: The TraceFunctionStruct or None if not traced.
+        """
+
+        try:
+            return self.structs[code]
+        except KeyError:
+            pass
+
+        module = frame.f_globals.get("__name__", "")
+        name = getattr(code, "co_qualname", code.co_name)
+        filename = code.co_filename
+
+        struct = None
+        if (module in self.modules and name in self.functions and
+                not os.path.abspath(filename).startswith(PYLG_DIR)):
+
+            struct = TraceFunction.TraceFunctionStruct()
+            struct.filename = os.path.basename(filename)
+            struct.lineno = code.co_firstlineno
+            struct.functionname = name
+
+            # -----------------------------------------------------------------
+            # The argument names are the first entries of co_varnames:
+            # positional, keyword-only, then *args and **kwargs.
+            # -----------------------------------------------------------------
+            nargs = code.co_argcount + getattr(code, "co_kwonlyargcount", 0)
+            if code.co_flags & CO_VARARGS:
+                nargs += 1
+            if code.co_flags & CO_VARKEYWORDS:
+                nargs += 1
+            struct.varnames = code.co_varnames[:nargs]
+            struct.plan = BindingPlan.from_code(code)
+
+        self.structs[code] = struct
+        return struct
+
+    def trace_entry(self, struct, frame):
+
+        """ Log the entry into a traced frame.
+        """
+
+        args, kwargs = (), {}
+        if struct.varnames:
+            f_locals = frame.f_locals
+            args, kwargs = frame_arguments(
+                struct.plan, [f_locals.get(name) for name in struct.varnames])
+
+        if ((DEFERRED_FORMAT or PYLG_LOGGER is not None) and
+                self.trace_args and (args or kwargs)):
+            msg = LazyMessage(entry_message, struct, True, snapshot(args),
+                              snapshot(kwargs))
+        else:
+            msg = entry_message(struct, self.trace_args, args, kwargs)
+
+        trace(msg, function=struct)
+
+    def trace_exit(self, struct, rv):
+
+        """ Log the normal exit from a traced frame.
+        """
+
+        if ((DEFERRED_FORMAT or PYLG_LOGGER is not None) and self.trace_rv
+                and rv is not None):
+            msg = LazyMessage(exit_message, snapshot_value(rv), True,
+                              self.trace_rv_type)
+        else:
+            msg = exit_message(rv, self.trace_rv, self.trace_rv_type)
+
+        trace(msg, function=struct)
+
+    def trace_exception(self, struct, exception):
+
+        """ Log the exit from a traced frame due to an exception. The
+            setprofile backend cannot see the exception so it passes
+            None.
+        """
+
+        if exception is None:
+            msg = "<- EXIT : EXCEPTION RAISED"
+        else:
+            msg = "<- EXIT : " + type(exception).__name__ + " RAISED"
+            if str(exception) != "":
+                msg += " - " + str(exception)
+
+        trace(msg, function=struct)
+
+    # -------------------------------------------------------------------------
+    # The sys.setprofile backend.
+    # -------------------------------------------------------------------------
+    def start_setprofile(self):
+
+        import threading
+        import dis
+
+        # ---------------------------------------------------------------------
+        # The opcodes that end a frame without an exception. When a
+        # 'return' event's last instruction is not one of these, the
+        # frame is being unwound by an exception.
+        # ---------------------------------------------------------------------
+        self.return_opcodes = frozenset(
+            dis.opmap[name] for name in
+            ("RETURN_VALUE", "RETURN_CONST", "YIELD_VALUE")
+            if name in dis.opmap)
+
+        sys.setprofile(self.profile)
+        if hasattr(threading, "setprofile_all_threads"):
+            threading.setprofile_all_threads(self.profile)
+        else:
+            threading.setprofile(self.profile)
+
+    def stop_setprofile(self):
+
+        import threading
+
+        sys.setprofile(None)
+        if hasattr(threading, "setprofile_all_threads"):
+            threading.setprofile_all_threads(None)
+        else:
+            threading.setprofile(None)
+
+    def profile(self, frame, event, arg):
+
+        """ The sys.setprofile callback.
+        """
+
+        if event == "call":
+            struct = self.lookup(frame.f_code, frame)
+            if struct is not None:
+                self.trace_entry(struct, frame)
+
+        elif event == "return":
+            code = frame.f_code
+            struct = self.lookup(code, frame)
+            if struct is not None:
+                if code.co_code[frame.f_lasti] in self.return_opcodes:
+                    self.trace_exit(struct, arg)
+                else:
+                    self.trace_exception(struct, None)
+
+    # -------------------------------------------------------------------------
+    # The sys.monitoring backend.
+    # -------------------------------------------------------------------------
+    def start_monitoring(self):
+
+        monitoring = sys.monitoring
+
+        # ---------------------------------------------------------------------
+        # Prefer the id reserved for profilers, but fall back to any
+        # free id if another profiler is already using it.
+        # ---------------------------------------------------------------------
+        for tool_id in [monitoring.PROFILER_ID] + list(range(6)):
+            if monitoring.get_tool(tool_id) is None:
+                break
+        else:
+            raise RuntimeError("No free sys.monitoring tool id")
+
+        monitoring.use_tool_id(tool_id, "pylg")
+        self.tool_id = tool_id
+
+        events = monitoring.events
+        callbacks = [(events.PY_START, self.monitor_start),
+                     (events.PY_RESUME, self.monitor_start),
+                     (events.PY_RETURN, self.monitor_return),
+                     (events.PY_YIELD, self.monitor_return),
+                     (events.PY_UNWIND, self.monitor_unwind)]
+
+        event_set = 0
+        for event, callback in callbacks:
+            monitoring.register_callback(tool_id, event, callback)
+            event_set |= event
+
+        monitoring.set_events(tool_id, event_set)
+
+        # ---------------------------------------------------------------------
+        # Events disabled by a previous profiler with this tool id
+        # would otherwise stay disabled.
+        # ---------------------------------------------------------------------
+        monitoring.restart_events()
+
+    def stop_monitoring(self):
+
+        monitoring = sys.monitoring
+
+        monitoring.set_events(self.tool_id, 0)
+        for event in (monitoring.events.PY_START,
+                      monitoring.events.PY_RESUME,
+                      monitoring.events.PY_RETURN,
+                      monitoring.events.PY_YIELD,
+                      monitoring.events.PY_UNWIND):
+            monitoring.register_callback(self.tool_id, event, None)
+
+        monitoring.free_tool_id(self.tool_id)
+        self.tool_id = None
+
+    def monitor_start(self, code, offset):
+
+        struct = self.lookup(code, sys._getframe(1))
+        if struct is None:
+            return sys.monitoring.DISABLE
+
+        self.trace_entry(struct, sys._getframe(1))
+
+    def monitor_return(self, code, offset, rv):
+
+        struct = self.lookup(code, sys._getframe(1))
+        if struct is None:
+            return sys.monitoring.DISABLE
+
+        self.trace_exit(struct, rv)
+
+    def monitor_unwind(self, code, offset, exception):
+
+        # ---------------------------------------------------------------------
+        # PY_UNWIND cannot be disabled per code object so the cached
+        # decision is all that is used here.
+        # ---------------------------------------------------------------------
+        struct = self.structs.get(code)
+        if struct is not None:
+            self.trace_exception(struct, exception)
@@ -16,507 +16,2250 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # -----------------------------------------------------------------------------
 
-from __future__ import print_function
-from datetime import datetime
+from collections import deque, OrderedDict
+from contextvars import ContextVar
+from datetime import datetime, date, timedelta, time as datetime_time
 from functools import partial
-import traceback
+from operator import itemgetter
+import itertools
+import threading
 import warnings
-import textwrap
-import inspect
 import sys
 import os
 
+try:
+    from time import perf_counter
+except ImportError:
+    from time import time as perf_counter
+
+try:
+    from time import thread_time
+except ImportError:
+    from time import process_time as thread_time
+
 # -----------------------------------------------------------------------------
 # Load settings.
 # -----------------------------------------------------------------------------
 from .loadSettings import *
 
 
-class ClassNameStack(object):
+# -----------------------------------------------------------------------------
+# The traced calls in progress, innermost first, as an immutable linked
+# list of (depth, classname, outer, held) tuples. held is the list the
+# records are held back in while a call with filters on its duration
+# or return value is in progress, None otherwise. A context variable is
+# local to the thread and to the asyncio task, so concurrent tasks in
+# one thread each see their own calls.
+# -----------------------------------------------------------------------------
+CALL_STACK = ContextVar("pylg_call_stack", default=None)
+
+# -----------------------------------------------------------------------------
+# The calls in progress of the functions whose recursion is collapsed,
+# see recursion_limit, innermost first, as an immutable linked list of
+# (function, level, recursion, outer) tuples. function is the
+# TraceFunction, level the number of its calls in progress and
+# recursion the RecursionState of its calls below recursion_limit or
+# None.
+# -----------------------------------------------------------------------------
+RECURSION = ContextVar("pylg_recursion", default=None)
+
+
+class CallStack(object):
 
-    """ A class to keep a global stack of the class names of the
-        functions that are currently executing. The class name of the
-        last traced function that was called will be on top of the
-        stack. It is removed after it finishes executing.
+    """ Access to the traced calls in progress. TraceFunction pushes a
+        call by setting CALL_STACK and pops it by resetting the
+        variable with the token it got back, in a finally block so
+        that exceptions unwind it. Both are O(1) and need no stack
+        inspection.
     """
 
-    stack = []
+    @staticmethod
+    def depth():
+
+        """ Get the number of traced calls in progress.
+        """
+
+        top = CALL_STACK.get()
+        return top[0] if top is not None else 0
 
     @staticmethod
-    def insert(classname):
+    def classname():
+
+        """ Get the class name of the innermost traced call in
+            progress if CLASS_NAME_RESOLUTION is enabled.
+        """
+
         if CLASS_NAME_RESOLUTION:
-            ClassNameStack.stack.append(classname)
+            top = CALL_STACK.get()
+            if top is not None:
+                return top[1]
 
-    @staticmethod
-    def pop():
-        if CLASS_NAME_RESOLUTION and ClassNameStack.stack:
-                ClassNameStack.stack.pop()
+        return None
 
-    @staticmethod
-    def get():
-        if CLASS_NAME_RESOLUTION and ClassNameStack.stack:
-            return ClassNameStack.stack[-1]
-        else:
-            return None
 
+# -----------------------------------------------------------------------------
+# The span of the traced call in progress as a (trace_id, span_id,
+# column) tuple, where column is the text of its span column. The
+# span_id is None inside a TraceContext with no traced call in
+# progress. Like CALL_STACK, the variable is inherited by asyncio
+# tasks. It is carried into other threads by propagate.
+# -----------------------------------------------------------------------------
+SPAN = ContextVar("pylg_span", default=None)
+SPAN_IDS = itertools.count(1)
+NO_SPAN = "-/-/-"
 
-class PyLg(object):
 
-    """ Class to handle the log file.
+def span_column(trace_id, span_id, parent_id):
+
+    """ Format the text of the span column, 'trace/span/parent' with
+        '-' for the ids that are not set.
     """
 
-    wfile = None
-    filename = PYLG_FILE
+    return ((trace_id or "-") + "/" + (span_id or "-") + "/" +
+            (parent_id or "-"))
+
+
+class Span(object):
+
+    """ Access to the span of the traced call in progress. Every
+        traced call is a span. The outermost one starts a trace unless
+        it is made in a TraceContext.
+    """
 
     @staticmethod
-    def set_filename(new_filename):
+    def new_trace_id():
 
-        """ Change the file name of the log file. The change will be
-            rejected if the log file is already open.
+        """ Generate a trace id, random so that traces from different
+            processes can be told apart.
+        """
 
-            :param str new_filename: The new file name for the log file.
+        return os.urandom(6).hex()
+
+    @staticmethod
+    def push():
+
+        """ Start the span of a traced call as a child of the current
+            span.
+
+            :return: The token to reset SPAN with when the call
+                     returns.
         """
 
-        if PyLg.wfile is None:
-            PyLg.filename = new_filename
+        span = SPAN.get()
+        span_id = str(next(SPAN_IDS))
+
+        if span is None:
+            trace_id = Span.new_trace_id()
+            parent_id = None
         else:
-            warnings.warn("PyLg wfile is open - cannot change filename")
+            trace_id, parent_id = span[0], span[1]
+
+        return SPAN.set((trace_id, span_id,
+                         span_column(trace_id, span_id, parent_id)))
 
     @staticmethod
-    def write(string):
+    def current():
 
-        """ Write to the log file. A new log file is opened and
-            initialised if it has not been opened yet.
+        """ Get the ids of the current span.
 
-            :param str string: The string to be written to the log file.
+            :return: A (trace_id, span_id) tuple, where span_id is None
+                     outside of any traced call, or None outside of any
+                     trace.
         """
 
-        if PyLg.wfile is None:
-            PyLg.wfile = open(PyLg.filename, "w")
-            PyLg.wfile.write("=== Log initialised at " +
-                             str(datetime.now()) + " ===\n\n")
+        span = SPAN.get()
+        return span[:2] if span is not None else None
 
-        PyLg.wfile.write(string)
-        PyLg.wfile.flush()
 
-    @staticmethod
-    def close():
+def current_span():
 
-        """ Close the log file.
+    """ Get the ids of the current trace and span, e.g. to pass them on
+        to another service.
+
+        :return: A (trace_id, span_id) tuple, where span_id is None
+                 outside of any traced call, or None outside of any
+                 trace.
+    """
+
+    return Span.current()
+
+
+class TraceContext(object):
+
+    """ Context manager that runs a block in a trace of its own, so
+        that the traced calls in it are correlated even if they are not
+        nested in a single traced call. The trace id can be given, e.g.
+        from the request id of a server, or it is generated:
+
+            with TraceContext(request.headers["X-Request-Id"]):
+                handle(request)
+    """
+
+    def __init__(self, trace_id=None):
+
+        """ Constructor for TraceContext.
+
+            :param str trace_id: The id of the trace. It must not
+                                 contain whitespace or '/'. A random id
+                                 is generated if None.
         """
 
-        if PyLg.wfile is not None:
-            PyLg.wfile.close()
-            PyLg.wfile = None
-        else:
-            warnings.warn("PyLg wfile is not open - nothing to close")
+        if trace_id is None:
+            trace_id = Span.new_trace_id()
 
+        elif (not isinstance(trace_id, str) or
+              trace_id.split() != [trace_id] or "/" in trace_id):
+            raise ValueError("Invalid trace id " + repr(trace_id) +
+                             " - it must be a non-empty string without "
+                             "whitespace or '/'")
 
-class TraceFunction(object):
+        self.trace_id = trace_id
+        self.token = None
 
-    """ Class that serves as a decorator to trace entry and exit from
-        functions. Used by appending @TraceFunction on top of the
-        definition of the function to trace.
+    def __enter__(self):
+
+        self.token = SPAN.set((self.trace_id, None,
+                               span_column(self.trace_id, None, None)))
+        return self.trace_id
+
+    def __exit__(self, exc_type, exc_value, tb):
+
+        SPAN.reset(self.token)
+        self.token = None
+
+
+def propagate(function):
+
+    """ Wrap a callable so that it runs in the current trace and span
+        wherever it is called, e.g. in a thread pool:
+
+            executor.submit(pylg.propagate(fetch), url)
+
+        Only the span is carried over. The traced calls in progress
+        are not, so records in the other thread are not indented and
+        do not count towards max_depth.
+
+        :param function: The callable to wrap.
+        :return: The wrapped callable.
     """
 
-    class TraceFunctionStruct(object):
+    span = SPAN.get()
 
-        """ Internal object to handle traced function properties.
+    def run(*args, **kwargs):
+        token = SPAN.set(span)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            SPAN.reset(token)
+
+    return run
+
+
+class RecursionState(object):
+
+    """ The nested calls of a function collapsed below its deepest
+        logged call.
+    """
+
+    __slots__ = ("calls", "max_level", "time")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+
+        """ Forget the collapsed calls once they have been summarised.
         """
 
-        function = None
-        varnames = None
-        defaults = None
+        self.calls = 0
+        self.max_level = 0
+        self.time = 0.0
 
-        filename = None
-        lineno = None
-        classname = None
-        functionname = None
 
-    def __get__(self, obj, objtype):
+class CallMetrics(object):
 
-        """ Support for instance functions.
+    """ The measurements of a traced call enabled by TRACE_DURATION,
+        TRACE_CPU_TIME and TRACE_ALLOCATIONS. They hold the values at
+        the start of the call until stop turns them into differences.
+        The ones that are not measured are None.
+    """
+
+    __slots__ = ("wall", "cpu", "alloc")
+
+    def __init__(self):
+
+        self.wall = perf_counter() if TRACE_DURATION else None
+        self.cpu = thread_time() if TRACE_CPU_TIME else None
+
+        self.alloc = None
+        if TRACE_ALLOCATIONS:
+            import tracemalloc
+            if tracemalloc.is_tracing():
+                self.alloc = tracemalloc.get_traced_memory()[0]
+
+    def stop(self):
+
+        """ Measure the end of the call, in the opposite order to the
+            start so that the measurements are as little in each
+            other's way as possible.
         """
 
-        return partial(self.__call__, obj)
+        if self.alloc is not None:
+            import tracemalloc
+            if tracemalloc.is_tracing():
+                self.alloc = tracemalloc.get_traced_memory()[0] - self.alloc
+            else:
+                self.alloc = None
 
-    def __init__(self, *args, **kwargs):
+        if self.cpu is not None:
+            self.cpu = thread_time() - self.cpu
 
-        """ Constructor for TraceFunction. Note that the behaviour is
-            different depending on whether TraceFunction is passed any
-            parameters. For details see __call__ in this class.
+        if self.wall is not None:
+            self.wall = perf_counter() - self.wall
+
+    def __str__(self):
+
+        fields = []
+
+        if self.wall is not None:
+            fields.append("wall={:.6f}s".format(self.wall))
+
+        if self.cpu is not None:
+            fields.append("cpu={:.6f}s".format(self.cpu))
+
+        if self.alloc is not None:
+            fields.append("alloc={:+d}B".format(self.alloc))
+
+        return "[" + " ".join(fields) + "]" if fields else ""
+
+
+class PyLgStats(object):
+
+    """ Counters for PyLg's own overhead. The counters updated on
+        every record are kept in each thread's ThreadBuffer so that
+        threads never write to the same counter. The ones below are
+        only updated while PyLg.lock is held, or hold the totals of
+        threads that have finished. Updating them is cheap enough to
+        leave on in production.
+    """
+
+    records = 0
+    bytes = 0
+    format_time = 0.0
+    write_time = 0.0
+    dropped = 0
+    filtered = 0
+    flushes = 0
+
+    started = perf_counter()
+    last_report = started
+
+    render_hits = 0
+    render_misses = 0
+
+    COUNTERS = ["records", "bytes", "format_time", "write_time", "dropped",
+                "filtered", "flushes", "render_hits", "render_misses"]
+
+    @staticmethod
+    def get():
+
+        """ Get a snapshot of the counters.
+
+            :return: A dictionary of counter names to values.
+        """
+
+        counters = dict((name, getattr(PyLgStats, name))
+                        for name in PyLgStats.COUNTERS)
+
+        for buf in list(PyLg.buffers):
+            for name in PyLgStats.COUNTERS:
+                counters[name] += getattr(buf, name)
+
+        counters["uptime"] = perf_counter() - PyLgStats.started
+        return counters
+
+    @staticmethod
+    def reset():
+
+        """ Reset all the counters to zero.
+        """
+
+        for obj in [PyLgStats] + list(PyLg.buffers):
+            for name in PyLgStats.COUNTERS:
+                setattr(obj, name, 0)
+
+        PyLgStats.started = perf_counter()
+        PyLgStats.last_report = PyLgStats.started
+
+    @staticmethod
+    def absorb(buf):
+
+        """ Add the counters of a finished thread's buffer to the
+            totals.
+        """
+
+        for name in PyLgStats.COUNTERS:
+            setattr(PyLgStats, name,
+                    getattr(PyLgStats, name) + getattr(buf, name))
+
+    @staticmethod
+    def report():
+
+        """ Format the counters as a log message.
         """
 
+        return ("PYLG STATS: records={records} bytes={bytes} "
+                "format_time={format_time:.6f} write_time={write_time:.6f} "
+                "dropped={dropped} filtered={filtered} flushes={flushes} "
+                "render_hits={render_hits} render_misses={render_misses} "
+                "uptime={uptime:.3f}".format(**PyLgStats.get()))
+
+
+def stats():
+
+    """ Get PyLg's own counters: the number of records emitted, bytes
+        written, time spent formatting and writing records (in
+        seconds), records dropped by max_depth and recursion
+        collapsing, records suppressed by filters and the number of
+        flushes.
+
+        :return: A dictionary of counter names to values.
+    """
+
+    return PyLgStats.get()
+
+
+# -----------------------------------------------------------------------------
+# Staged records are (key, functionname, string) tuples ordered by
+# their perf_counter key.
+# -----------------------------------------------------------------------------
+RECORD_KEY = itemgetter(0)
+
+
+class ThreadBuffer(object):
+
+    """ The staging buffer of a single thread. Only the owning thread
+        appends records to it, so no locking is needed on the record
+        path. Records are (key, functionname, string) tuples where key
+        orders records across threads. It also holds the thread's
+        share of the PyLgStats counters.
+    """
+
+    def __init__(self, thread):
+
+        self.thread = thread
+        self.name = thread.name
+        self.pending = deque()
+
         # ---------------------------------------------------------------------
-        # Make sure this decorator is never called with no arguments.
+        # The thread's own log file if THREAD_FILES is enabled and the
+        # lock that serialises writing to it. The lock is only ever
+        # contended when another thread flushes all the buffers.
         # ---------------------------------------------------------------------
-        assert args or kwargs
+        self.wfile = None
+        self.lock = threading.Lock()
 
-        if args:
+        # ---------------------------------------------------------------------
+        # The call site column of every site this thread has defined
+        # in the log if COMPACT_SITES is enabled.
+        # ---------------------------------------------------------------------
+        self.sites = {}
 
-            self.exception_warning = DEFAULT_EXCEPTION_WARNING
-            self.exception_tb_file = DEFAULT_EXCEPTION_TB_FILE
-            self.exception_tb_stderr = DEFAULT_EXCEPTION_TB_STDERR
-            self.exception_exit = DEFAULT_EXCEPTION_EXIT
+        for name in PyLgStats.COUNTERS:
+            setattr(self, name, 0)
 
-            self.trace_args = DEFAULT_TRACE_ARGS
-            self.trace_rv = DEFAULT_TRACE_RV
-            self.trace_rv_type = DEFAULT_TRACE_RV_TYPE
+    def site(self, filename, lineno, functionname):
 
-            # -----------------------------------------------------------------
-            # The function init_function will verify the input.
-            # -----------------------------------------------------------------
-            self.init_function(*args, **kwargs)
+        """ Get the call site column used by COMPACT_SITES. The first
+            time this thread uses a call site, its definition is
+            staged ahead of the record so that the log or the thread's
+            own file always defines a site before it is used.
 
-        if kwargs:
+            :return: The column string, e.g. '@12  '.
+        """
 
-            exception_warning_str = 'exception_warning'
-            exception_tb_file_str = 'exception_tb_file'
-            exception_tb_stderr_str = 'exception_tb_stderr'
-            exception_exit_str = 'exception_exit'
+        key = (filename, lineno, functionname)
 
-            trace_args_str = 'trace_args'
-            trace_rv_str = 'trace_rv'
-            trace_rv_type_str = 'trace_rv_type'
+        try:
+            return self.sites[key]
+        except KeyError:
+            pass
 
-            # -----------------------------------------------------------------
-            # If kwargs is non-empty, args should be empty.
-            # -----------------------------------------------------------------
-            assert not args
+        with PyLg.site_lock:
+            site_id = PyLg.site_ids.setdefault(key, len(PyLg.site_ids))
 
-            try:
-                self.exception_warning = kwargs[exception_warning_str]
-                pylg_check_bool(self.exception_warning, "exception_warning")
-            except (KeyError, ImportError):
-                self.exception_warning = DEFAULT_EXCEPTION_WARNING
+        self.add("#{}\t{}\t{}\t{}\n".format(site_id, filename, lineno,
+                                            functionname))
 
-            try:
-                self.exception_tb_file = kwargs[exception_tb_file_str]
-                pylg_check_bool(self.exception_tb_file, "exception_tb_file")
-            except (KeyError, ImportError):
-                self.exception_tb_file = DEFAULT_EXCEPTION_TB_FILE
+        column = self.sites[key] = "@{}  ".format(site_id)
+        return column
+
+    def add(self, string, functionname=None):
+
+        """ Stage a record and flush the buffer once it holds
+            THREAD_BUFFER records.
+
+            :param str string: The string to be written to the log file.
+            :param str functionname: The function name of the record for
+                                     the index.
+        """
+
+        pending = self.pending
+        pending.append((perf_counter(), functionname, string))
+
+        if len(pending) >= THREAD_BUFFER:
+            if THREAD_FILES:
+                self.write_own_file(self)
+            else:
+                PyLg.flush(wait=False)
+
+    def extend(self, records):
+
+        """ Stage records that were held back by a filtered call. They
+            may be older than records staged already and are put in
+            order when the buffer is written out. With PYLG_LOGGER,
+            they are LogRecords and passed on instead.
+
+            :param list records: (key, functionname, string) tuples.
+        """
+
+        if PYLG_LOGGER is not None:
+            sink = PyLg.logging_sink()
+            for record in records:
+                sink.handle(record[2])
+            if PYLG_STATS:
+                self.records += len(records)
+            return
+
+        pending = self.pending
+        pending.extend(records)
+
+        if PYLG_STATS:
+            self.records += len(records)
+
+        if len(pending) >= THREAD_BUFFER:
+            if THREAD_FILES:
+                self.write_own_file(self)
+            else:
+                PyLg.flush(wait=False)
+
+    def drain(self):
+
+        """ Remove the records currently in the buffer. Records
+            appended concurrently are left for the next drain.
+
+            :return: The list of removed records.
+        """
+
+        pending = self.pending
+        return [pending.popleft() for _ in range(len(pending))]
+
+    def write_own_file(self, counters):
+
+        """ Write the buffered records to the thread's own log file.
+
+            :param counters: The object to add the formatting and
+                             writing counters to: the buffer itself
+                             when called by its own thread, PyLgStats
+                             with PyLg.lock held otherwise, so that the
+                             buffer's counters are only ever updated
+                             by its own thread.
+        """
+
+        with self.lock:
+
+            if self.wfile is None:
+                name = "".join(c if c.isalnum() or c in "-_." else "_"
+                               for c in self.name)
+                self.wfile = PyLg.open(PyLg.filename + "." + name)
+                self.wfile.write(("=== Log initialised at " +
+                                  str(datetime.now()) + " ===\n\n").encode())
+
+            records = self.drain()
+            records.sort(key=RECORD_KEY)
+
+            data = "".join(render(record[2], counters)
+                           for record in records).encode("utf-8")
+            self.wfile.write(data)
+            self.wfile.flush()
+
+            if PYLG_STATS:
+                counters.bytes += len(data)
+                counters.flushes += 1
+
+
+def render(record, counters):
+
+    """ Generate the string of a record staged with DEFERRED_FORMAT.
+        Other records are returned unchanged.
+
+        :param record: The staged string or the arguments to
+                       format_record.
+        :param counters: The object to add the formatting time to,
+                         PyLgStats or a ThreadBuffer.
+        :return: The record string.
+    """
+
+    if isinstance(record, str):
+        return record
+
+    if not PYLG_STATS:
+        return format_record(*record)
+
+    start = perf_counter()
+    string = format_record(*record)
+    counters.format_time += perf_counter() - start
+    return string
+
+
+class PyLg(object):
+
+    """ Class to handle the log file.
+
+        Every thread stages its records in its own ThreadBuffer. The
+        log file itself is only ever written by a single consumer at
+        a time: whichever thread holds PyLg.lock drains the buffers of
+        all threads, sorts them in time order and writes them
+        out. Threads that find the lock taken leave their records to
+        the current consumer rather than waiting, so no thread blocks
+        while another one formats or writes.
+    """
+
+    wfile = None
+    filename = PYLG_FILE
+
+    # -------------------------------------------------------------------------
+    # The byte offset of the next record and the index writer if
+    # PYLG_INDEX is enabled.
+    # -------------------------------------------------------------------------
+    offset = 0
+    index = None
+
+    # -------------------------------------------------------------------------
+    # The per-thread buffers. The lock is taken to register a new
+    # thread and by the consumer that writes to the log file.
+    # -------------------------------------------------------------------------
+    local = threading.local()
+    buffers = []
+    lock = threading.Lock()
+
+    # -------------------------------------------------------------------------
+    # The ids of the call sites if COMPACT_SITES is enabled.
+    # -------------------------------------------------------------------------
+    site_ids = {}
+    site_lock = threading.Lock()
+
+    # -------------------------------------------------------------------------
+    # The LoggingSink if PYLG_LOGGER is set.
+    # -------------------------------------------------------------------------
+    sink = None
+
+    @staticmethod
+    def set_filename(new_filename):
+
+        """ Change the file name of the log file. The change will be
+            rejected if the log file is already open.
+
+            :param str new_filename: The new file name for the log file.
+        """
+
+        if PyLg.wfile is None:
+            PyLg.filename = new_filename
+        else:
+            warnings.warn("PyLg wfile is open - cannot change filename")
+
+    @staticmethod
+    def buffer():
+
+        """ Get the calling thread's buffer, creating it on first use.
+        """
+
+        try:
+            return PyLg.local.buffer
+        except AttributeError:
+            pass
+
+        buf = ThreadBuffer(threading.current_thread())
+        with PyLg.lock:
+            if not PyLg.buffers:
+                import atexit
+                atexit.register(PyLg.exit)
+
+            # -----------------------------------------------------------------
+            # Forget the buffers of threads that have finished. Their
+            # own files are closed, so that close_files does not need
+            # to see them to truncate memory-mapped ones.
+            # -----------------------------------------------------------------
+            for old in [old for old in PyLg.buffers
+                        if not old.pending and not old.thread.is_alive()]:
+                with old.lock:
+                    if old.wfile is not None:
+                        old.wfile.close()
+                        old.wfile = None
+
+                PyLgStats.absorb(old)
+                PyLg.buffers.remove(old)
+
+            PyLg.buffers.append(buf)
+
+        PyLg.local.buffer = buf
+        return buf
+
+    @staticmethod
+    def open(filename):
+
+        """ Open a log file for writing, as a ring in shared memory
+            if PYLG_RING is set, as a connection to the collector if
+            PYLG_COLLECTOR is set or through a memory map if MMAP_CHUNK
+            is set.
+
+            :param str filename: The log file name.
+        """
+
+        if PYLG_RING:
+            from .sinks import RingSink
+            return RingSink(filename, PYLG_RING)
+
+        if PYLG_COLLECTOR is not None:
+            from .sinks import SocketSink
+            return SocketSink(PYLG_COLLECTOR, filename, COLLECTOR_BATCH,
+                              COLLECTOR_LATENCY, COLLECTOR_TIMEOUT,
+                              COLLECTOR_RETRY)
+
+        if MMAP_CHUNK:
+            from .sinks import MmapFile
+            return MmapFile(filename, MMAP_CHUNK)
+
+        return open(filename, "wb")
+
+    @staticmethod
+    def logging_sink():
+
+        """ Get the LoggingSink for PYLG_LOGGER, creating it on first
+            use or when the setting has changed.
+        """
+
+        sink = PyLg.sink
+        if sink is None or sink.name != PYLG_LOGGER:
+            from .sinks import LoggingSink
+            sink = PyLg.sink = LoggingSink(PYLG_LOGGER, LOGGER_LEVEL)
+
+        return sink
+
+    @staticmethod
+    def write(string, functionname=None):
+
+        """ Write to the log file. The record is staged in the calling
+            thread's buffer and written out according to THREAD_BUFFER
+            and THREAD_FILES.
+
+            :param str string: The string to be written to the log file.
+            :param str functionname: The function name of the record for
+                                     the index.
+        """
+
+        PyLg.buffer().add(string, functionname)
+
+    @staticmethod
+    def write_file(string, functionname=None):
+
+        """ Write to the log file. A new log file is opened and
+            initialised if it has not been opened yet. Must only be
+            called with PyLg.lock held.
+
+            :param str string: The string to be written to the log file.
+            :param str functionname: The function name of the record for
+                                     the index.
+        """
+
+        if PyLg.wfile is None:
+            header = ("=== Log initialised at " +
+                      str(datetime.now()) + " ===\n\n").encode()
+
+            PyLg.wfile = PyLg.open(PyLg.filename)
+            PyLg.wfile.write(header)
+            PyLg.offset = len(header)
+
+            if PYLG_INDEX and PYLG_COLLECTOR is None and not PYLG_RING:
+                from .index import IndexWriter, INDEX_SUFFIX
+                PyLg.index = IndexWriter(PyLg.filename + INDEX_SUFFIX,
+                                         INDEX_INTERVAL)
+
+        if PyLg.index is not None:
+            PyLg.index.add(PyLg.offset, functionname)
+
+        data = render(string, PyLgStats).encode("utf-8")
+        PyLg.wfile.write(data)
+        PyLg.offset += len(data)
+
+        if PYLG_STATS:
+            PyLgStats.bytes += len(data)
+
+    @staticmethod
+    def flush(wait=True):
+
+        """ Write out all staged records. With THREAD_FILES every
+            thread's records go to its own file. Otherwise the buffers
+            of all threads are merged in time order into the log file.
+
+            :param bool wait: If False and another thread is already
+                              flushing, return immediately and leave
+                              the records to that thread.
+        """
+
+        while True:
+
+            if not PyLg.lock.acquire(wait):
+                return
+
+            try:
+                PyLg.drain()
+            finally:
+                PyLg.lock.release()
+
+            # -----------------------------------------------------------------
+            # A thread may have staged a record and failed to take the
+            # lock after the buffers were drained but before the lock
+            # was released. Its record would be stranded until the
+            # next flush, so check again.
+            # -----------------------------------------------------------------
+            if THREAD_FILES or not any(buf.pending for buf in PyLg.buffers):
+                return
+
+    @staticmethod
+    def drain():
+
+        """ Drain all the buffers. Must only be called with PyLg.lock
+            held.
+        """
+
+        if THREAD_FILES:
+            for buf in PyLg.buffers:
+                if buf.pending:
+                    buf.write_own_file(PyLgStats)
+            return
+
+        drained = [records for records in
+                   (buf.drain() for buf in PyLg.buffers) if records]
+        if not drained:
+            return
+
+        # ---------------------------------------------------------------------
+        # The records of every buffer are mostly in time order already,
+        # but those held back by a filtered call are staged after the
+        # newer records of other calls in the same thread, e.g. other
+        # asyncio tasks. Sorting the runs of all the buffers together
+        # puts them back in order and is cheaper than merging them.
+        # ---------------------------------------------------------------------
+        if len(drained) == 1:
+            merged = drained[0]
+            merged.sort(key=RECORD_KEY)
+        else:
+            merged = sorted(itertools.chain.from_iterable(drained),
+                            key=RECORD_KEY)
+
+        for _, functionname, string in merged:
+            PyLg.write_file(string, functionname)
+
+        PyLg.wfile.flush()
+        if PYLG_STATS:
+            PyLgStats.flushes += 1
+
+    @staticmethod
+    def close():
+
+        """ Close the log file.
+        """
+
+        PyLg.flush()
+
+        if not PyLg.close_files():
+            warnings.warn("PyLg wfile is not open - nothing to close")
+
+    @staticmethod
+    def close_files():
+
+        """ Close the log file and the per-thread files.
+
+            :return: True if any file was open.
+        """
+
+        closed = False
+        with PyLg.lock:
+
+            for buf in PyLg.buffers:
+                with buf.lock:
+                    if buf.wfile is not None:
+                        buf.wfile.close()
+                        buf.wfile = None
+                        closed = True
+
+                # -------------------------------------------------------------
+                # A new log file must define the call sites again.
+                # -------------------------------------------------------------
+                buf.sites = {}
+
+            if PyLg.wfile is not None:
+                PyLg.wfile.close()
+                PyLg.wfile = None
+                closed = True
+
+                if PyLg.index is not None:
+                    PyLg.index.close()
+                    PyLg.index = None
+
+        return closed
+
+    @staticmethod
+    def exit():
+
+        """ Write out the staged records at exit. Memory-mapped log
+            files are closed as well so that they are truncated to the
+            length written, connections to the collector so that their
+            last frames are sent and rings so that they are removed.
+        """
+
+        PyLg.flush()
+
+        if MMAP_CHUNK or PYLG_COLLECTOR is not None or PYLG_RING:
+            PyLg.close_files()
+
+    @staticmethod
+    def force_exit():
+
+        """ Exit the process straight away for EXCEPTION_EXIT. os._exit
+            skips the atexit handlers, so the records held back by the
+            calls in progress in this context are staged first and
+            everything is written out as at exit.
+        """
+
+        buf = PyLg.buffer()
+        seen = set()
+
+        top = CALL_STACK.get()
+        while top is not None:
+            held = top[3]
+            if held and id(held) not in seen:
+                seen.add(id(held))
+                buf.extend(held)
+            top = top[2]
+
+        PyLg.exit()
+        os._exit(1)
+
+
+class TraceFunction(object):
+
+    """ Class that serves as a decorator to trace entry and exit from
+        functions. Used by appending @TraceFunction on top of the
+        definition of the function to trace.
+
+        There is one instance per decorated function, so the decorator
+        and its TraceFunctionStruct use __slots__ for their own
+        attributes. This keeps instrumenting tens of thousands of
+        functions cheap and attribute lookups on every call fast. Like
+        a function, a decorated function can still be weakly referenced
+        and given other attributes, whose dictionary is only created
+        when the first one is set.
+    """
+
+    __slots__ = ("exception_warning", "exception_tb_file",
+                 "exception_tb_stderr", "exception_tb_summary",
+                 "exception_exit", "trace_args", "trace_rv", "trace_rv_type",
+                 "max_depth", "recursion_limit", "filter_args", "filter_rv",
+                 "min_duration", "hold", "function", "__weakref__",
+                 "__dict__")
+
+    class TraceFunctionStruct(object):
+
+        """ Internal object to handle traced function properties.
+        """
+
+        __slots__ = ("function", "varnames", "plan", "filename", "lineno",
+                     "classname", "functionname")
+
+        def __init__(self):
+
+            self.function = None
+            self.varnames = None
+            self.plan = None
+
+            self.filename = None
+            self.lineno = None
+            self.classname = None
+            self.functionname = None
+
+    def __get__(self, obj, objtype):
+
+        """ Support for instance functions.
+        """
+
+        return partial(self.__call__, obj)
+
+    def __init__(self, *args, **kwargs):
+
+        """ Constructor for TraceFunction. Note that the behaviour is
+            different depending on whether TraceFunction is passed any
+            parameters. For details see __call__ in this class.
+        """
+
+        # ---------------------------------------------------------------------
+        # Make sure this decorator is never called with no arguments.
+        # ---------------------------------------------------------------------
+        assert args or kwargs
+
+        if args:
+
+            self.exception_warning = DEFAULT_EXCEPTION_WARNING
+            self.exception_tb_file = DEFAULT_EXCEPTION_TB_FILE
+            self.exception_tb_stderr = DEFAULT_EXCEPTION_TB_STDERR
+            self.exception_tb_summary = DEFAULT_EXCEPTION_TB_SUMMARY
+            self.exception_exit = DEFAULT_EXCEPTION_EXIT
+
+            self.trace_args = DEFAULT_TRACE_ARGS
+            self.trace_rv = DEFAULT_TRACE_RV
+            self.trace_rv_type = DEFAULT_TRACE_RV_TYPE
+
+            self.max_depth = DEFAULT_MAX_DEPTH
+            self.recursion_limit = DEFAULT_RECURSION_LIMIT
+
+            # -----------------------------------------------------------------
+            # The filters are completed from FILTER_RULES by
+            # init_function.
+            # -----------------------------------------------------------------
+            self.filter_args = None
+            self.filter_rv = None
+            self.min_duration = None
+
+            # -----------------------------------------------------------------
+            # The function init_function will verify the input.
+            # -----------------------------------------------------------------
+            self.init_function(*args, **kwargs)
+
+        if kwargs:
+
+            exception_warning_str = 'exception_warning'
+            exception_tb_file_str = 'exception_tb_file'
+            exception_tb_stderr_str = 'exception_tb_stderr'
+            exception_tb_summary_str = 'exception_tb_summary'
+            exception_exit_str = 'exception_exit'
+
+            trace_args_str = 'trace_args'
+            trace_rv_str = 'trace_rv'
+            trace_rv_type_str = 'trace_rv_type'
+
+            max_depth_str = 'max_depth'
+            recursion_limit_str = 'recursion_limit'
+
+            filter_args_str = 'filter_args'
+            filter_rv_str = 'filter_rv'
+            min_duration_str = 'min_duration'
+
+            # -----------------------------------------------------------------
+            # If kwargs is non-empty, args should be empty.
+            # -----------------------------------------------------------------
+            assert not args
+
+            try:
+                self.exception_warning = kwargs[exception_warning_str]
+                pylg_check_bool(self.exception_warning, "exception_warning")
+            except (KeyError, ImportError):
+                self.exception_warning = DEFAULT_EXCEPTION_WARNING
+
+            try:
+                self.exception_tb_file = kwargs[exception_tb_file_str]
+                pylg_check_bool(self.exception_tb_file, "exception_tb_file")
+            except (KeyError, ImportError):
+                self.exception_tb_file = DEFAULT_EXCEPTION_TB_FILE
+
+            try:
+                self.exception_tb_stderr = kwargs[exception_tb_stderr_str]
+                pylg_check_bool(self.exception_tb_stderr,
+                                "exception_tb_stderr")
+            except (KeyError, ImportError):
+                self.exception_tb_stderr = DEFAULT_EXCEPTION_TB_STDERR
+
+            try:
+                self.exception_tb_summary = kwargs[exception_tb_summary_str]
+                pylg_check_bool(self.exception_tb_summary,
+                                "exception_tb_summary")
+            except (KeyError, ImportError):
+                self.exception_tb_summary = DEFAULT_EXCEPTION_TB_SUMMARY
+
+            try:
+                self.exception_exit = kwargs[exception_exit_str]
+                pylg_check_bool(self.exception_exit, "exception_exit")
+            except (KeyError, ImportError):
+                self.exception_exit = DEFAULT_EXCEPTION_EXIT
+
+            try:
+                self.trace_args = kwargs[trace_args_str]
+                pylg_check_bool(self.trace_args, "trace_args")
+            except (KeyError, ImportError):
+                self.trace_args = DEFAULT_TRACE_ARGS
+
+            try:
+                self.trace_rv = kwargs[trace_rv_str]
+                pylg_check_bool(self.trace_rv, "trace_rv")
+            except (KeyError, ImportError):
+                self.trace_rv = DEFAULT_TRACE_RV
+
+            try:
+                self.trace_rv_type = kwargs[trace_rv_type_str]
+                pylg_check_bool(self.trace_rv_type, "trace_rv_type")
+            except (KeyError, ImportError):
+                self.trace_rv_type = DEFAULT_TRACE_RV_TYPE
+
+            try:
+                self.max_depth = kwargs[max_depth_str]
+                pylg_check_nonneg_int(self.max_depth, "max_depth")
+            except (KeyError, ImportError):
+                self.max_depth = DEFAULT_MAX_DEPTH
+
+            try:
+                self.recursion_limit = kwargs[recursion_limit_str]
+                pylg_check_nonneg_int(self.recursion_limit, "recursion_limit")
+            except (KeyError, ImportError):
+                self.recursion_limit = DEFAULT_RECURSION_LIMIT
+
+            # -----------------------------------------------------------------
+            # Filters that are not given are completed from FILTER_RULES
+            # by init_function.
+            # -----------------------------------------------------------------
+            try:
+                self.filter_args = kwargs[filter_args_str]
+                pylg_check_callable(self.filter_args, "filter_args")
+            except (KeyError, ImportError):
+                self.filter_args = None
+
+            try:
+                self.filter_rv = kwargs[filter_rv_str]
+                pylg_check_callable(self.filter_rv, "filter_rv")
+            except (KeyError, ImportError):
+                self.filter_rv = None
+
+            try:
+                self.min_duration = kwargs[min_duration_str]
+                pylg_check_nonneg_number(self.min_duration, "min_duration")
+            except (KeyError, ImportError):
+                self.min_duration = None
+
+            self.function = None
+
+    def __call__(self, *args, **kwargs):
+
+        """ The actual wrapper that is called when a call to a
+            decorated function is made. It also handles extra
+            initialisation when parameters are passed to
+            TraceFunction.
+
+            :return: The return value of the decorated function.
+        """
+
+        # ---------------------------------------------------------------------
+        # __call__ has to behave differently depending on whether the
+        # decorator has been given any parameters. The reason for this
+        # is as follows:
+        #
+        # @TraceFunction
+        # decorated_function
+        #
+        # translates to TraceFunction(decorated_function)
+        #
+        # @TraceFunction(*args, **kwargs)
+        # decorated_function
+        #
+        # translates to TraceFunction(*args, **kwargs)(decorated_function)
+        #
+        # In both cases, the result should be a callable object which
+        # will be called whenever the decorated function is called. In
+        # the first case, the callable object is an instance of
+        # TraceFunction, in the latter case the return value of
+        # TraceFunction.__call__ is the callable object.
+        # ---------------------------------------------------------------------
+
+        if self.function is None:
+            # -----------------------------------------------------------------
+            # If the decorator has been passed a parameter, __init__
+            # will not define self.function and __call__ will be
+            # called immediately after __init__ with the decorated
+            # function as the only parameter. Therefore, this __call__
+            # function has to return the callable object that is meant
+            # to be called every time the decorated function is
+            # called. Here, self is returned in order to return the
+            # object as the callable handle for the decorated
+            # function. This if block should be hit only once at most
+            # and only during initialisation.
+            # -----------------------------------------------------------------
+            self.init_function(*args, **kwargs)
+            return self
+
+        # ---------------------------------------------------------------------
+        # Nothing is logged while the logger of PYLG_LOGGER is disabled
+        # for LOGGER_LEVEL.
+        # ---------------------------------------------------------------------
+        if PYLG_LOGGER is not None and not PyLg.logging_sink().enabled():
+            return self.function.function(*args, **kwargs)
+
+        # ---------------------------------------------------------------------
+        # The actual decorating. The call is pushed on the call stack
+        # whether it is logged or not, so the depth counts every
+        # traced call in progress.
+        # ---------------------------------------------------------------------
+        top = CALL_STACK.get()
+        if top is None:
+            depth = 0
+            held = None
+        else:
+            depth = top[0]
+            held = top[3]
+
+        token = CALL_STACK.set((depth + 1, self.function.classname, top, held))
+
+        try:
+            if self.recursion_limit:
+                return self.call_recursive(depth, args, kwargs)
+
+            if self.max_depth and depth >= self.max_depth:
+                if PYLG_STATS:
+                    PyLg.buffer().dropped += 2
+                return self.function.function(*args, **kwargs)
+
+            return self.call_traced(args, kwargs)
+
+        finally:
+            CALL_STACK.reset(token)
+
+    def call_traced(self, args, kwargs, recursion=None):
+
+        """ Call the decorated function and log its entry and exit
+            unless it is rejected by its filters. Calls that raise are
+            always logged.
+
+            :param recursion: The RecursionState of the function if
+                              its recursion is collapsed.
+            :return: The return value of the decorated function.
+        """
+
+        if self.filter_args is not None and not self.filter_args(*args,
+                                                                 **kwargs):
+            if PYLG_STATS:
+                PyLg.buffer().filtered += 2
+            return self.function.function(*args, **kwargs)
+
+        # ---------------------------------------------------------------------
+        # With filters on the duration or the return value, whether the
+        # call is logged is only known once it returns. Its records, and
+        # those of the calls it makes, are held back unformatted until
+        # then, keeping the time they were traced at. They are passed on
+        # to the caller, which may be holding back records itself,
+        # whether the call is logged or not: a rejected call only
+        # leaves out its own records.
+        # ---------------------------------------------------------------------
+        span_token = None
+        if TRACE_SPANS:
+            span_token = Span.push()
+
+        held = None
+        if self.hold:
+            top = CALL_STACK.get()
+            held = []
+            token = CALL_STACK.set(top[:3] + (held,))
+
+        try:
+            self.trace_entry(*args, **kwargs)
+
+            if held is not None:
+                start = perf_counter()
+
+            metrics = None
+            if TRACE_DURATION or TRACE_CPU_TIME or TRACE_ALLOCATIONS:
+                metrics = CallMetrics()
+
+            try:
+                rv = self.function.function(*args, **kwargs)
+            except Exception as e:
+                if metrics is not None:
+                    metrics.stop()
+
+                if recursion is not None and recursion.calls:
+                    self.trace_recursion(recursion)
+
+                self.trace_exception(e, metrics)
+
+                if self.exception_exit:
+                    warnings.warn("Exit forced by EXCEPTION_EXIT")
+                    PyLg.force_exit()
+
+                raise
+
+            if metrics is not None:
+                metrics.stop()
+
+            if held is not None and (
+                    perf_counter() - start < self.min_duration or
+                    self.filter_rv is not None and not self.filter_rv(rv)):
+                # -------------------------------------------------------------
+                # The first held record is this call's ENTRY.
+                # -------------------------------------------------------------
+                del held[0]
+                if recursion is not None:
+                    recursion.reset()
+                if PYLG_STATS:
+                    PyLg.buffer().filtered += 2
+                return rv
+
+            if recursion is not None and recursion.calls:
+                self.trace_recursion(recursion)
+
+            self.trace_exit(rv, metrics)
+
+            return rv
+
+        finally:
+            if held is not None:
+                CALL_STACK.reset(token)
+
+                if top[3] is not None:
+                    top[3].extend(held)
+                elif held:
+                    PyLg.buffer().extend(held)
+
+            if span_token is not None:
+                SPAN.reset(span_token)
+
+    def call_recursive(self, depth, args, kwargs):
+
+        """ Call a function whose recursion is collapsed. Nested calls
+            beyond recursion_limit levels are not logged, but they are
+            counted and timed and summarised in one line before the
+            EXIT line of the deepest logged call.
+
+            :return: The return value of the decorated function.
+        """
+
+        # ---------------------------------------------------------------------
+        # The recursion level and the RecursionState shared by the
+        # deepest logged call and the calls collapsed below it are
+        # kept in RECURSION, like the call stack. The innermost call of
+        # this function is usually the first entry.
+        # ---------------------------------------------------------------------
+        outer = entry = RECURSION.get()
+        while entry is not None and entry[0] is not self:
+            entry = entry[3]
+
+        if entry is None:
+            level, recursion = 1, None
+        else:
+            level, recursion = entry[1] + 1, entry[2]
+
+        if level == self.recursion_limit:
+            recursion = RecursionState()
+
+        token = RECURSION.set((self, level, recursion, outer))
+
+        try:
+            if level > self.recursion_limit:
+                recursion.calls += 1
+                if PYLG_STATS:
+                    PyLg.buffer().dropped += 2
+                if level > recursion.max_level:
+                    recursion.max_level = level
+
+                if level > self.recursion_limit + 1:
+                    return self.function.function(*args, **kwargs)
+
+                start = perf_counter()
+                try:
+                    return self.function.function(*args, **kwargs)
+                finally:
+                    recursion.time += perf_counter() - start
+
+            if self.max_depth and depth >= self.max_depth:
+                if PYLG_STATS:
+                    PyLg.buffer().dropped += 2
+                return self.function.function(*args, **kwargs)
+
+            if level < self.recursion_limit:
+                return self.call_traced(args, kwargs)
+
+            return self.call_traced(args, kwargs, recursion)
+
+        finally:
+            RECURSION.reset(token)
+
+    def init_function(self, *args, **kwargs):
+
+        """ Function to initialise the TraceFunctionStruct kept by the
+            decorator.
+        """
+
+        # ---------------------------------------------------------------------
+        # This function should only ever be called with one parameter
+        # - the function to be decorated. These checks are done here,
+        # rather than by the caller, as anything that calls this
+        # function should also have been called with the decorated
+        # function as its only parameter.
+        # ---------------------------------------------------------------------
+        assert not kwargs
+        assert len(args) == 1
+        assert callable(args[0])
+
+        self.function = TraceFunction.TraceFunctionStruct()
+
+        self.function.function = args[0]
+
+        self.function.plan = BindingPlan(self.function.function)
+        self.function.varnames = self.function.plan.names
+
+        # ---------------------------------------------------------------------
+        # init_function is called from either __init__ or __call__ and
+        # we want the frame before that.
+        # ---------------------------------------------------------------------
+        frames_back = 2
+        caller_frame = sys._getframe(frames_back)
+
+        self.function.filename = os.path.basename(
+            caller_frame.f_code.co_filename)
+        self.function.lineno = caller_frame.f_lineno
+        self.function.classname = caller_frame.f_code.co_name
+        self.function.functionname = self.function.function.__name__
+
+        self.init_filters()
+
+    def init_filters(self):
+
+        """ Complete the filters not given to the decorator from the
+            first rule in FILTER_RULES that matches the function and
+            min_duration from DEFAULT_MIN_DURATION.
+        """
+
+        if FILTER_RULES:
+            import fnmatch
+
+            names = [self.function.functionname]
+            if self.function.classname != "<module>":
+                names.append(self.function.classname + "." +
+                             self.function.functionname)
+
+            for rule in FILTER_RULES:
+                if any(fnmatch.fnmatchcase(name, rule["function"])
+                       for name in names):
+                    if self.filter_args is None:
+                        self.filter_args = rule.get("args")
+                    if self.filter_rv is None:
+                        self.filter_rv = rule.get("rv")
+                    if self.min_duration is None:
+                        self.min_duration = rule.get("min_duration")
+                    break
+
+        if self.min_duration is None:
+            self.min_duration = DEFAULT_MIN_DURATION
+
+        # ---------------------------------------------------------------------
+        # Whether the records of a call are held back until it returns.
+        # ---------------------------------------------------------------------
+        self.hold = bool(self.min_duration) or self.filter_rv is not None
+
+    def trace_entry(self, *args, **kwargs):
+
+        """ Called on function entry. This function collects all the
+            function arguments and constructs a message to pass to
+            trace.
+        """
+
+        lazy = (DEFERRED_FORMAT or PYLG_LOGGER is not None or
+                CALL_STACK.get()[3] is not None)
+
+        if lazy and self.trace_args and (args or kwargs):
+            msg = LazyMessage(entry_message, self.function, True,
+                              snapshot(args), snapshot(kwargs))
+        else:
+            msg = entry_message(self.function, self.trace_args, args, kwargs)
+
+        trace(msg, function=self.function)
+
+    def trace_exit(self, rv=None, metrics=None):
+
+        """ Called on function exit to log the fact that a function has
+            finished executing.
+
+            :param rv: The return value of the traced function.
+            :param metrics: The CallMetrics of the call or None.
+        """
+
+        lazy = (DEFERRED_FORMAT or PYLG_LOGGER is not None or
+                CALL_STACK.get()[3] is not None)
+
+        if lazy and self.trace_rv and rv is not None:
+            msg = LazyMessage(exit_message, snapshot_value(rv), True,
+                              self.trace_rv_type, metrics)
+        else:
+            msg = exit_message(rv, self.trace_rv, self.trace_rv_type,
+                               metrics)
+
+        trace(msg, function=self.function)
+        return
+
+    def trace_recursion(self, recursion):
+
+        """ Log the summary of the collapsed nested calls and reset
+            it.
+
+            :param recursion: The RecursionState of the function.
+        """
+
+        msg = ("-- RECURSION COLLAPSED: {} calls, {} levels, "
+               "{:.6f} s".format(recursion.calls,
+                                 recursion.max_level - self.recursion_limit,
+                                 recursion.time))
+        recursion.reset()
+
+        trace(msg, function=self.function)
+
+    def trace_exception(self, exception, metrics=None):
+
+        """ Called when a function terminated due to an exception.
+
+            :param exception: The raised exception.
+            :param metrics: The CallMetrics of the call or None.
+        """
+
+        # ---------------------------------------------------------------------
+        # The EXIT message.
+        # ---------------------------------------------------------------------
+        core_msg = type(exception).__name__ + " RAISED"
+        msg = exit_prefix(metrics) + ": " + core_msg
+
+        if str(exception) != "":
+            msg += " - " + str(exception)
+
+        if self.exception_warning:
+            warnings.warn(core_msg, RuntimeWarning)
+
+        if self.exception_tb_file or self.exception_tb_stderr:
+
+            # -----------------------------------------------------------------
+            # The traceback is only rendered by the innermost traced
+            # frame the exception passes through, once for the log file
+            # and once for stderr. It numbers the exception and the outer
+            # frames refer to that number, but only once the traceback
+            # is in the log file: a frame that only wrote it to stderr
+            # leaves the log file to the next frame that writes there.
+            # -----------------------------------------------------------------
+            file_id = getattr(exception, EXCEPTION_ID_ATTR, None)
+            stderr_id = getattr(exception, EXCEPTION_STDERR_ATTR, None)
+
+            to_file = self.exception_tb_file and file_id is None
+            to_stderr = self.exception_tb_stderr and stderr_id is None
+
+            if self.exception_tb_file and file_id is not None:
+                msg += " (see EXCEPTION #{})".format(file_id)
+
+            if to_file or to_stderr:
+                exception_id = file_id or stderr_id or next(EXCEPTION_IDS)
+
+                if self.exception_tb_summary:
+                    tb = raise_site(sys.exc_info()[2])
+                else:
+                    import traceback
+                    tb = traceback.format_exc()
+
+                header = "--- EXCEPTION #{} ---".format(exception_id)
+                footer = "-" * len(header)
+
+                if to_file:
+                    msg += "\n" + header + "\n" + tb + footer
+                    stamp_exception(exception, EXCEPTION_ID_ATTR,
+                                    exception_id)
+
+                if to_stderr:
+                    sys.stderr.write(header + "\n" + tb + footer + "\n")
+                    stamp_exception(exception, EXCEPTION_STDERR_ATTR,
+                                    exception_id)
+
+        trace(msg, function=self.function)
+        return
+
+    def get_value_string(self, value):
+
+        """ Convert value to a string for the log.
+        """
+
+        return get_value_string(value)
+
+
+def get_value_string(value):
+
+    """ Convert value to a string for the log.
+    """
+
+    if isinstance(value, list) and COLLAPSE_LISTS:
+        return collapse_list(value)
+    elif isinstance(value, dict) and COLLAPSE_DICTS:
+        return collapse_dict(value)
+
+    if RENDER_CACHE:
+        cache = RenderCache.instance
+        if cache is None or cache.size != RENDER_CACHE:
+            cache = RenderCache.current()
+
+        cacheable = cache.cacheable.get(type(value))
+        if cacheable is None:
+            cacheable = cache.classify(type(value))
+
+        if cacheable:
+            return cache.render(value)
+
+    return str(value)
+
+
+class RenderCache(object):
+
+    """ The LRU cache of value strings used by RENDER_CACHE.
+
+        Values are cached by identity rather than by equality, as
+        equal values may have different strings (0.0 and -0.0, 1 and
+        True). Every entry holds a reference to its value, so the id of
+        a cached value cannot be reused by another object until the
+        entry is evicted. Only immutable values and values of the types
+        in RENDER_CACHE_TYPES are cached. The immutable types cached by
+        default are the ones whose strings take longer to build than
+        to look up: the strings of numbers, strings and plain enum
+        members are cheaper to build again.
+
+        The cache takes no lock. Concurrent updates may evict an entry
+        early or let the cache grow past its size for a moment, but
+        never return a wrong string.
+    """
+
+    IMMUTABLE_TYPES = (bytes, date, datetime_time, timedelta)
+
+    instance = None
+
+    @staticmethod
+    def current():
+
+        """ Get the cache, creating it on first use or when RENDER_CACHE
+            has changed.
+        """
+
+        cache = RenderCache.instance
+        if cache is None or cache.size != RENDER_CACHE:
+            cache = RenderCache.instance = RenderCache(RENDER_CACHE,
+                                                       RENDER_CACHE_TYPES)
+
+        return cache
+
+    def __init__(self, size, types):
+
+        """ Constructor for RenderCache.
+
+            :param int size: The maximum number of entries.
+            :param types: The further types whose values are cached.
+        """
+
+        self.size = size
+        self.types = tuple(types)
+
+        # ---------------------------------------------------------------------
+        # id(value) -> (value, string), least recently used first.
+        # ---------------------------------------------------------------------
+        self.entries = OrderedDict()
+
+        # ---------------------------------------------------------------------
+        # Whether the values of a type are cached, by type.
+        # ---------------------------------------------------------------------
+        self.cacheable = {}
+
+    def classify(self, value_type):
+
+        """ Work out whether the values of a type are cached.
+        """
+
+        cacheable = issubclass(value_type, self.IMMUTABLE_TYPES + self.types)
+        self.cacheable[value_type] = cacheable
+        return cacheable
+
+    def render(self, value):
+
+        """ Convert a value of a cacheable type to a string for the
+            log.
+        """
+
+        key = id(value)
+        entries = self.entries
+        entry = entries.get(key)
+
+        if entry is not None:
+            try:
+                entries.move_to_end(key)
+            except KeyError:
+                pass
+
+            if PYLG_STATS:
+                PyLg.buffer().render_hits += 1
+            return entry[1]
+
+        string = str(value)
+        entries[key] = (value, string)
+
+        if len(entries) > self.size:
+            try:
+                entries.popitem(last=False)
+            except KeyError:
+                pass
+
+        if PYLG_STATS:
+            PyLg.buffer().render_misses += 1
+        return string
+
+
+def collapse_list(ll):
+    return "[ len=" + str(len(ll)) + " ]"
+
+
+def collapse_dict(dd):
+    return "{ len=" + str(len(dd)) + " }"
+
+
+# -----------------------------------------------------------------------------
+# Exceptions whose traceback has been written to the log file and to
+# stderr are numbered through these attributes.
+# -----------------------------------------------------------------------------
+EXCEPTION_ID_ATTR = "_pylg_exception_id"
+EXCEPTION_STDERR_ATTR = "_pylg_exception_stderr_id"
+EXCEPTION_IDS = itertools.count(1)
+
+
+def stamp_exception(exception, attr, exception_id):
+
+    """ Number an exception whose traceback has been rendered.
+        Exceptions that do not take attributes are left alone, their
+        traceback is then rendered again by outer frames.
+    """
+
+    try:
+        setattr(exception, attr, exception_id)
+    except (AttributeError, TypeError):
+        pass
+
+
+def raise_site(tb):
+
+    """ Summarise a traceback as the place the exception was raised,
+        for exception_tb_summary.
+
+        :param tb: The traceback object.
+        :return: The summary line, including the final newline.
+    """
+
+    while tb.tb_next is not None:
+        tb = tb.tb_next
+
+    code = tb.tb_frame.f_code
+    return "raised at {}:{} in {}\n".format(os.path.basename(code.co_filename),
+                                            tb.tb_lineno, code.co_name)
+
+
+def entry_message(function, trace_args, args, kwargs):
+
+    """ Build the ENTRY message.
+
+        :param function: The TraceFunctionStruct of the traced function.
+        :param bool trace_args: Whether to log the argument values.
+        :param args: The positional arguments of the call.
+        :param kwargs: The keyword arguments of the call.
+        :return: The ENTRY message.
+    """
+
+    msg = "-> ENTRY"
+    if args or kwargs:
+        if trace_args:
+            values = function.plan.format_args(args, kwargs)
+            if values:
+                msg += ": " + values
+
+        else:
+            msg += ": ---"
+
+    return msg
+
+
+# -----------------------------------------------------------------------------
+# Code flags for functions with *args and **kwargs. They are copied
+# from the inspect module to avoid importing it.
+# -----------------------------------------------------------------------------
+CO_VARARGS = 0x04
+CO_VARKEYWORDS = 0x08
+
+
+class BindingPlan(object):
+
+    """ How the arguments of a call bind to the parameters of a traced
+        function. The plan is worked out from the function's signature
+        once, when it is decorated, so that binding a call is a single
+        pass over precomputed slots. Every kind of parameter is
+        handled: positional-only, keyword-only, *args and **kwargs.
+    """
+
+    __slots__ = ("names", "labels", "labels_without_self", "has_self",
+                 "defaults", "default_slots", "first_default",
+                 "n_positional", "n_positional_only", "keyword_slots",
+                 "keywords", "var_positional", "var_keyword")
+
+    # -------------------------------------------------------------------------
+    # The default of a parameter that has none.
+    # -------------------------------------------------------------------------
+    EMPTY = object()
+
+    # -------------------------------------------------------------------------
+    # The kinds of parameters, numbered as by inspect.Parameter.
+    # -------------------------------------------------------------------------
+    POSITIONAL_ONLY = 0
+    POSITIONAL_OR_KEYWORD = 1
+    VAR_POSITIONAL = 2
+    KEYWORD_ONLY = 3
+    VAR_KEYWORD = 4
+
+    def __init__(self, function):
+
+        """ Constructor for BindingPlan.
+
+            :param function: The decorated function.
+        """
+
+        import inspect
+        empty = inspect.Parameter.empty
+
+        # ---------------------------------------------------------------------
+        # Some builtins have no signature. All their arguments are
+        # logged as *args and **kwargs.
+        # ---------------------------------------------------------------------
+        try:
+            params = inspect.signature(function).parameters.values()
+        except (TypeError, ValueError):
+            params = None
+        else:
+            params = [(param.name, param.kind,
+                       BindingPlan.EMPTY if param.default is empty
+                       else param.default)
+                      for param in params]
+
+        self.setup(params)
+
+    @staticmethod
+    def from_code(code):
+
+        """ Build the plan of a code object, for callers that only see
+            the frames of calls. The defaults of the parameters are not
+            known, so every parameter must be passed.
+
+            :param code: The code object of the function.
+            :return: The BindingPlan.
+        """
 
-            try:
-                self.exception_tb_stderr = kwargs[exception_tb_stderr_str]
-                pylg_check_bool(self.exception_tb_stderr,
-                                "exception_tb_stderr")
-            except (KeyError, ImportError):
-                self.exception_tb_stderr = DEFAULT_EXCEPTION_TB_STDERR
+        names = code.co_varnames
+        n_positional = code.co_argcount
+        n_positional_only = getattr(code, "co_posonlyargcount", 0)
+        n_keyword = n_positional + code.co_kwonlyargcount
 
-            try:
-                self.exception_exit = kwargs[exception_exit_str]
-                pylg_check_bool(self.exception_exit, "exception_exit")
-            except (KeyError, ImportError):
-                self.exception_exit = DEFAULT_EXCEPTION_EXIT
+        params = [(name, BindingPlan.POSITIONAL_ONLY
+                   if index < n_positional_only
+                   else BindingPlan.POSITIONAL_OR_KEYWORD, BindingPlan.EMPTY)
+                  for index, name in enumerate(names[:n_positional])]
 
-            try:
-                self.trace_args = kwargs[trace_args_str]
-                pylg_check_bool(self.trace_args, "trace_args")
-            except (KeyError, ImportError):
-                self.trace_args = DEFAULT_TRACE_ARGS
+        # ---------------------------------------------------------------------
+        # The names of *args and **kwargs follow the keyword-only
+        # parameters in co_varnames, but *args comes before them in the
+        # signature.
+        # ---------------------------------------------------------------------
+        rest = n_keyword
+        if code.co_flags & CO_VARARGS:
+            params.append((names[rest], BindingPlan.VAR_POSITIONAL,
+                           BindingPlan.EMPTY))
+            rest += 1
 
-            try:
-                self.trace_rv = kwargs[trace_rv_str]
-                pylg_check_bool(self.trace_rv, "trace_rv")
-            except (KeyError, ImportError):
-                self.trace_rv = DEFAULT_TRACE_RV
+        params.extend((name, BindingPlan.KEYWORD_ONLY, BindingPlan.EMPTY)
+                      for name in names[n_positional:n_keyword])
 
-            try:
-                self.trace_rv_type = kwargs[trace_rv_type_str]
-                pylg_check_bool(self.trace_rv_type, "trace_rv_type")
-            except (KeyError, ImportError):
-                self.trace_rv_type = DEFAULT_TRACE_RV_TYPE
+        if code.co_flags & CO_VARKEYWORDS:
+            params.append((names[rest], BindingPlan.VAR_KEYWORD,
+                           BindingPlan.EMPTY))
 
-            self.function = None
+        plan = BindingPlan.__new__(BindingPlan)
+        plan.setup(params)
+        return plan
 
-    def __call__(self, *args, **kwargs):
+    def setup(self, params):
 
-        """ The actual wrapper that is called when a call to a
-            decorated function is made. It also handles extra
-            initialisation when parameters are passed to
-            TraceFunction.
+        """ Work out the plan from the parameters.
 
-            :return: The return value of the decorated function.
+            :param params: (name, kind, default) tuples in the order of
+                           the signature, with BindingPlan.EMPTY for no
+                           default, or None if the signature is not
+                           known.
         """
 
         # ---------------------------------------------------------------------
-        # __call__ has to behave differently depending on whether the
-        # decorator has been given any parameters. The reason for this
-        # is as follows:
-        #
-        # @TraceFunction
-        # decorated_function
-        #
-        # translates to TraceFunction(decorated_function)
-        #
-        # @TraceFunction(*args, **kwargs)
-        # decorated_function
-        #
-        # translates to TraceFunction(*args, **kwargs)(decorated_function)
+        # The parameters that can be passed by position are described
+        # by parallel tuples of their names, their labels as written in
+        # the log ('name = ') and their defaults. The positional-only
+        # ones come first. The keyword-only parameters are (label, name,
+        # default) slots. The *args and **kwargs parameters are only
+        # kept as their labels.
         #
-        # In both cases, the result should be a callable object which
-        # will be called whenever the decorated function is called. In
-        # the first case, the callable object is an instance of
-        # TraceFunction, in the latter case the return value of
-        # TraceFunction.__call__ is the callable object.
+        # The (label, default) pairs of all the parameters with defaults
+        # are also kept in order, which is all that is needed when a
+        # call passes no keyword arguments.
         # ---------------------------------------------------------------------
+        names = []
+        labels = []
+        defaults = []
+        keyword_slots = []
+        default_slots = []
+        self.n_positional_only = 0
+        self.var_positional = None
+        self.var_keyword = None
+
+        if params is None:
+            params = []
+            self.var_positional = "*args = "
+            self.var_keyword = "**kwargs = "
+
+        for name, kind, default in params:
 
-        if self.function is None:
             # -----------------------------------------------------------------
-            # If the decorator has been passed a parameter, __init__
-            # will not define self.function and __call__ will be
-            # called immediately after __init__ with the decorated
-            # function as the only parameter. Therefore, this __call__
-            # function has to return the callable object that is meant
-            # to be called every time the decorated function is
-            # called. Here, self is returned in order to return the
-            # object as the callable handle for the decorated
-            # function. This if block should be hit only once at most
-            # and only during initialisation.
+            # Labels are interned: most parameter names are shared by
+            # many functions.
             # -----------------------------------------------------------------
-            self.init_function(*args, **kwargs)
-            return self
+            label = sys.intern(name + " = ")
 
-        # ---------------------------------------------------------------------
-        # The actual decorating.
-        # ---------------------------------------------------------------------
-        ClassNameStack.insert(self.function.classname)
-        self.trace_entry(*args, **kwargs)
+            if kind == BindingPlan.VAR_POSITIONAL:
+                self.var_positional = "*" + label
 
-        try:
-            rv = self.function.function(*args, **kwargs)
-        except Exception as e:
-            self.trace_exception(e)
+            elif kind == BindingPlan.VAR_KEYWORD:
+                self.var_keyword = "**" + label
 
-            if self.exception_exit:
-                warnings.warn("Exit forced by EXCEPTION_EXIT")
-                os._exit(1)
+            elif kind == BindingPlan.KEYWORD_ONLY:
+                keyword_slots.append((label, name, default))
+                if default is not BindingPlan.EMPTY:
+                    default_slots.append((label, default))
 
-            raise
+            else:
+                if kind == BindingPlan.POSITIONAL_ONLY:
+                    self.n_positional_only += 1
 
-        self.trace_exit(rv)
-        ClassNameStack.pop()
+                names.append(name)
+                labels.append(label)
+                defaults.append(default)
+                if default is not BindingPlan.EMPTY:
+                    default_slots.append((label, default))
 
-        return rv
+        self.names = tuple(names)
+        self.labels = tuple(labels)
+        self.defaults = tuple(defaults)
+        self.keyword_slots = tuple(keyword_slots)
+        self.n_positional = len(labels)
 
-    def init_function(self, *args, **kwargs):
+        # ---------------------------------------------------------------------
+        # Only trailing positional parameters can have defaults.
+        # ---------------------------------------------------------------------
+        self.default_slots = tuple(default_slots)
+        self.first_default = self.n_positional
+        while (self.first_default and
+               defaults[self.first_default - 1] is not BindingPlan.EMPTY):
+            self.first_default -= 1
 
-        """ Function to initialise the TraceFunctionStruct kept by the
-            decorator.
-        """
+        # ---------------------------------------------------------------------
+        # The names a keyword argument binds to are only needed to tell
+        # the arguments that go to **kwargs apart.
+        # ---------------------------------------------------------------------
+        self.keywords = None
+        if self.var_keyword is not None:
+            self.keywords = frozenset(
+                names[self.n_positional_only:] +
+                [name for _, name, _ in keyword_slots])
 
         # ---------------------------------------------------------------------
-        # This function should only ever be called with one parameter
-        # - the function to be decorated. These checks are done here,
-        # rather than by the caller, as anything that calls this
-        # function should also have been called with the decorated
-        # function as its only parameter.
+        # The labels used when a 'self' parameter is not logged, see
+        # TRACE_SELF.
         # ---------------------------------------------------------------------
-        assert not kwargs
-        assert len(args) == 1
-        assert callable(args[0])
+        self.has_self = names[:1] == ["self"]
+        self.labels_without_self = None
+        if self.has_self:
+            self.labels_without_self = (None,) + self.labels[1:]
 
-        self.function = TraceFunction.TraceFunctionStruct()
+    def format_args(self, args, kwargs):
 
-        self.function.function = args[0]
+        """ Bind the arguments of a call to the parameters and format
+            them as 'name = value, ...' in the order of the parameters.
+            Parameters that are neither passed nor have a default are
+            left out.
+
+            :param args: The positional arguments of the call.
+            :param kwargs: The keyword arguments of the call.
+            :return: The formatted arguments.
+        """
+
+        labels = self.labels
+        if not TRACE_SELF and self.has_self:
+            labels = self.labels_without_self
 
-        argspec = inspect.getargspec(self.function.function)
+        msg = ""
+        for label, value in zip(labels, args):
+            if label is not None:
+                msg += label + get_value_string(value) + ", "
 
-        self.function.varnames = argspec.args
-        if argspec.defaults is not None:
-            self.function.defaults = dict(
-                zip(argspec.args[-len(argspec.defaults):],
-                    argspec.defaults))
+        n_args = len(args)
+        n_positional = self.n_positional
 
         # ---------------------------------------------------------------------
-        # init_function is called from either __init__ or __call__ and
-        # we want the frame before that.
+        # Without keyword arguments, the parameters that were not passed
+        # take their defaults.
         # ---------------------------------------------------------------------
-        frames_back = 2
-        caller_frame = inspect.stack()[frames_back]
+        if not kwargs and n_args <= n_positional:
+            slots = self.default_slots
+            start = n_args - self.first_default
+            if start > 0:
+                slots = slots[start:]
+            for label, value in slots:
+                msg += label + get_value_string(value) + ", "
+            return msg[:-2]
+
+        empty = BindingPlan.EMPTY
+
+        if n_args > n_positional:
+            if self.var_positional is not None:
+                msg += (self.var_positional +
+                        get_value_string(args[n_positional:]) + ", ")
 
-        self.function.filename = os.path.basename(caller_frame[1])
-        self.function.lineno = caller_frame[2]
-        self.function.classname = caller_frame[3]
-        self.function.functionname = self.function.function.__name__
+        else:
+            # -----------------------------------------------------------------
+            # Positional-only parameters cannot be passed by keyword, a
+            # keyword argument of the same name goes to **kwargs.
+            # -----------------------------------------------------------------
+            names = self.names
+            defaults = self.defaults
+            n_positional_only = self.n_positional_only
+            for index in range(n_args, n_positional):
+                value = defaults[index]
+                if index >= n_positional_only:
+                    value = kwargs.get(names[index], value)
+                if value is not empty:
+                    msg += self.labels[index] + get_value_string(value) + ", "
 
-    def trace_entry(self, *args, **kwargs):
+        for label, name, default in self.keyword_slots:
+            value = kwargs.get(name, default)
+            if value is not empty:
+                msg += label + get_value_string(value) + ", "
 
-        """ Called on function entry. This function collects all the
-            function arguments and constructs a message to pass to
-            trace.
-        """
+        if self.var_keyword is not None and kwargs:
+            keywords = self.keywords
+            extra = dict((name, value) for name, value in kwargs.items()
+                         if name not in keywords)
+            if extra:
+                msg += self.var_keyword + get_value_string(extra) + ", "
 
-        # ---------------------------------------------------------------------
-        # The ENTRY message.
-        # ---------------------------------------------------------------------
-        msg = "-> ENTRY"
-        if args or kwargs:
-            msg += ": "
+        return msg[:-2]
 
-            n_args = len(args)
-            if self.trace_args:
-                for arg in range(n_args):
 
-                    if not TRACE_SELF and \
-                       self.function.varnames[arg] == "self":
-                        continue
+def exit_prefix(metrics):
 
-                    msg += (self.function.varnames[arg] + " = " +
-                            self.get_value_string(args[arg]) + ", ")
+    """ Build the start of an EXIT message, with the measurements of
+        the call if there are any.
 
-                for name in self.function.varnames[n_args:]:
-                    msg += name + " = "
-                    if name in kwargs:
-                        value = kwargs[name]
-                    else:
-                        value = self.function.defaults[name]
-                    msg += self.get_value_string(value) + ", "
+        :param metrics: The CallMetrics of the call or None.
+    """
 
-                msg = msg[:-2]
+    if metrics is not None:
+        measured = str(metrics)
+        if measured:
+            return "<- EXIT " + measured + " "
 
-            else:
-                msg += "---"
+    return "<- EXIT "
 
-        trace(msg, function=self.function)
 
-    def trace_exit(self, rv=None):
+def exit_message(rv, trace_rv, trace_rv_type, metrics=None):
 
-        """ Called on function exit to log the fact that a function has
-            finished executing.
+    """ Build the EXIT message for a function that returned normally.
 
-            :param rv: The return value of the traced function.
-        """
+        :param rv: The return value of the traced function.
+        :param bool trace_rv: Whether to log the return value.
+        :param bool trace_rv_type: Whether to log the return value type.
+        :param metrics: The CallMetrics of the call or None.
+        :return: The EXIT message.
+    """
 
-        # ---------------------------------------------------------------------
-        # The EXIT message.
-        # ---------------------------------------------------------------------
-        msg = "<- EXIT "
-        if rv is not None:
-            msg += ": "
-            if self.trace_rv:
-                msg += self.get_value_string(rv)
-            else:
-                msg += "---"
+    msg = exit_prefix(metrics)
+    if rv is not None:
+        msg += ": "
+        if trace_rv:
+            msg += get_value_string(rv)
+        else:
+            msg += "---"
 
-            if self.trace_rv_type:
-                msg += " (type: " + type(rv).__name__ + ")"
+        if trace_rv_type:
+            msg += " (type: " + type(rv).__name__ + ")"
 
-        trace(msg, function=self.function)
-        return
+    return msg
 
-    def trace_exception(self, exception):
 
-        """ Called when a function terminated due to an exception.
+class LazyMessage(object):
 
-            :param exception: The raised exception.
+    """ A message that is only built when it is converted to a
+        string, used by DEFERRED_FORMAT.
+    """
+
+    __slots__ = ("build", "args")
+
+    def __init__(self, build, *args):
+
+        """ Constructor for LazyMessage.
+
+            :param build: The function that builds the message.
+            :param args: The arguments to call build with.
         """
 
-        # ---------------------------------------------------------------------
-        # The EXIT message.
-        # ---------------------------------------------------------------------
-        core_msg = type(exception).__name__ + " RAISED"
-        msg = "<- EXIT : " + core_msg
+        self.build = build
+        self.args = args
 
-        if str(exception) is not "":
-            msg += " - " + str(exception)
+    def __str__(self):
+        return self.build(*self.args)
 
-        if self.exception_warning:
-            warnings.warn(core_msg, RuntimeWarning)
 
-        if self.exception_tb_file:
-            msg += "\n--- EXCEPTION ---\n"
-            msg += traceback.format_exc()
-            msg += "-----------------"
+# -----------------------------------------------------------------------------
+# The mutable types copied by the 'shallow' DEFERRED_SNAPSHOT policy.
+# -----------------------------------------------------------------------------
+SNAPSHOT_TYPES = (list, dict, set, bytearray)
 
-        if self.exception_tb_stderr:
-            print("--- EXCEPTION ---", file=sys.stderr)
-            traceback.print_exc(file=sys.stderr)
-            print("-----------------", file=sys.stderr)
 
-        trace(msg, function=self.function)
-        return
+def snapshot_value(value):
 
-    def get_value_string(self, value):
+    """ Apply the DEFERRED_SNAPSHOT policy to a value kept for
+        deferred formatting.
+    """
 
-        """ Convert value to a string for the log.
-        """
+    if DEFERRED_SNAPSHOT == "shallow" and type(value) in SNAPSHOT_TYPES:
+        return type(value)(value)
 
-        if isinstance(value, list) and COLLAPSE_LISTS:
-            return self.collapse_list(value)
-        elif isinstance(value, dict) and COLLAPSE_DICTS:
-            return self.collapse_dict(value)
-        else:
-            return str(value)
+    return value
 
-    def collapse_list(self, ll):
-        return "[ len=" + str(len(ll)) + " ]"
 
-    def collapse_dict(self, dd):
-        return "{ len=" + str(len(dd)) + " }"
+def snapshot(values):
 
+    """ Apply the DEFERRED_SNAPSHOT policy to the arguments of a
+        call.
 
-def trace(message, function=None):
+        :param values: The tuple of positional or the dictionary of
+                       keyword arguments.
+    """
 
-    """ Writes message to the log file. It will also log the time,
-        filename, line number and function name.
+    if DEFERRED_SNAPSHOT != "shallow":
+        return values
 
-        :param str message: The log message.
-        :param function: A TraceFunctionStruct object if called from within
-                         TraceFunction.
+    if isinstance(values, dict):
+        return dict((name, snapshot_value(value))
+                    for name, value in values.items())
+
+    return tuple(snapshot_value(value) for value in values)
+
+
+def wrap(line, width):
+
+    """ Wrap a single line of a message to the given width. This is
+        the same as textwrap.wrap, except that textwrap is only
+        imported for finite widths.
+
+        :return: The list of wrapped lines.
     """
 
-    if function is None:
+    if width == float("inf"):
         # ---------------------------------------------------------------------
-        # If there is no function object, we need to work out
-        # where the trace call was made from.
+        # With an unlimited width, textwrap only expands tabs and
+        # drops trailing whitespace. The line comes from splitlines
+        # so it has no other whitespace textwrap would replace. Lines
+        # ending in non-ASCII whitespace are left to textwrap.
         # ---------------------------------------------------------------------
-        frames_back = 1
-        caller_frame = inspect.stack()[frames_back]
+        stripped = line.expandtabs().rstrip(" ")
+        if not stripped:
+            return []
+        if not stripped[-1].isspace():
+            return [stripped]
 
-        filename = os.path.basename(caller_frame[1])
-        lineno = caller_frame[2]
-        functionname = caller_frame[3]
+    import textwrap
+    return textwrap.wrap(line, width)
 
-    else:
-        filename = function.filename
-        lineno = function.lineno
-        functionname = function.functionname
 
-    # -------------------------------------------------------------------------
-    # If CLASS_NAME_RESOLUTION is enabled, the top element of the
-    # stack should be the class name of the function from which this
-    # trace call is made. This cannot be policed so the user must make
-    # sure this is the case by ensuring that trace is only called
-    # outside of any function or from within functions that have the
-    # @TraceFunction decorator.
-    # -------------------------------------------------------------------------
-    classname = ClassNameStack.get()
-    if classname is not None and classname != "<module>":
-        functionname = classname + "." + functionname
+# -----------------------------------------------------------------------------
+# The call site reported for the periodic PYLG STATS records.
+# -----------------------------------------------------------------------------
+STATS_SITE = TraceFunction.TraceFunctionStruct()
+STATS_SITE.filename = "pylg"
+STATS_SITE.lineno = 0
+STATS_SITE.functionname = "PyLgStats"
 
-    # -------------------------------------------------------------------------
-    # Generate the string based on the settings.
-    # -------------------------------------------------------------------------
-    msg = ""
 
-    if TRACE_TIME:
-        msg += datetime.now().strftime(TIME_FORMAT) + "  "
+def site_columns(filename, lineno, functionname):
+
+    """ Format the filename, line number and function name columns
+        enabled by the settings.
+    """
+
+    columns = ""
 
     if TRACE_FILENAME:
-        msg += '{filename:{w}.{w}}  '.format(filename=filename,
-                                             w=FILENAME_COLUMN_WIDTH)
+        columns += '{filename:{w}.{w}}  '.format(filename=filename,
+                                                 w=FILENAME_COLUMN_WIDTH)
 
     if TRACE_LINENO:
-        msg += '{lineno:0{w}}: '.format(lineno=lineno, w=LINENO_WIDTH)
+        columns += '{lineno:0{w}}: '.format(lineno=lineno, w=LINENO_WIDTH)
 
     if TRACE_FUNCTION:
-        msg += '{function:{w}.{w}}  '.format(function=functionname,
-                                             w=FUNCTION_COLUMN_WIDTH)
+        columns += '{function:{w}.{w}}  '.format(function=functionname,
+                                                 w=FUNCTION_COLUMN_WIDTH)
+
+    return columns
+
+
+def format_record(now, threadname, spanids, columns, filename, lineno,
+                  functionname, indent, message):
+
+    """ Generate the string of a record based on the settings.
+
+        :param datetime now: The time of the record if TRACE_TIME is
+                             enabled.
+        :param str threadname: The thread name if TRACE_THREAD is
+                               enabled.
+        :param str spanids: The span column if TRACE_SPANS is enabled.
+        :param str columns: The call site column if COMPACT_SITES is
+                            enabled, otherwise None.
+        :param int indent: The number of spaces to indent the message
+                           by.
+        :param message: The log message.
+        :return: The record string.
+    """
+
+    msg = ""
+
+    if TRACE_TIME:
+        msg += now.strftime(TIME_FORMAT) + "  "
+
+    if TRACE_THREAD:
+        msg += '{thread:{w}.{w}}  '.format(thread=threadname,
+                                           w=THREAD_COLUMN_WIDTH)
+
+    if TRACE_SPANS:
+        msg += '{ids:{w}}  '.format(ids=spanids, w=SPAN_COLUMN_WIDTH)
+
+    if columns is None:
+        columns = site_columns(filename, lineno, functionname)
+    msg += columns
 
     if TRACE_MESSAGE:
 
         message = str(message)
+        msg += " " * indent
 
         # ---------------------------------------------------------------------
         # Get the length of the trace line so far
@@ -535,7 +2278,7 @@ def trace(message, function=None):
             # -----------------------------------------------------------------
             # Wrap the text.
             # -----------------------------------------------------------------
-            wrapped = textwrap.wrap(line, MESSAGE_WIDTH)
+            wrapped = wrap(line, MESSAGE_WIDTH)
 
             if not wrapped:
                 wrapped = [""]
@@ -576,7 +2319,7 @@ def trace(message, function=None):
                     # ---------------------------------------------------------
 
                     if MESSAGE_WIDTH > 1:
-                        wrapped = textwrap.wrap(wrapped[0], MESSAGE_WIDTH - 1)
+                        wrapped = wrap(wrapped[0], MESSAGE_WIDTH - 1)
                         assert wrapped
 
                         msg += ('{m:{w}}'.format(m=wrapped[0],
@@ -599,7 +2342,139 @@ def trace(message, function=None):
             # -----------------------------------------------------------------
             msg += "\n"
 
+    return msg
+
+
+def trace(message, function=None):
+
+    """ Writes message to the log file. It will also log the time,
+        filename, line number and function name.
+
+        :param str message: The log message.
+        :param function: A TraceFunctionStruct object if called from within
+                         TraceFunction.
+    """
+
+    # -------------------------------------------------------------------------
+    # With PYLG_LOGGER, nothing is done unless the logger is enabled
+    # for LOGGER_LEVEL.
+    # -------------------------------------------------------------------------
+    sink = None
+    if PYLG_LOGGER is not None:
+        sink = PyLg.logging_sink()
+        if not sink.enabled():
+            return
+
+    if PYLG_STATS:
+        start = perf_counter()
+
+    if function is None:
+        # ---------------------------------------------------------------------
+        # If there is no function object, we need to work out
+        # where the trace call was made from.
+        # ---------------------------------------------------------------------
+        frames_back = 1
+        caller_frame = sys._getframe(frames_back)
+
+        filename = os.path.basename(caller_frame.f_code.co_filename)
+        lineno = caller_frame.f_lineno
+        functionname = caller_frame.f_code.co_name
+
+    else:
+        filename = function.filename
+        lineno = function.lineno
+        functionname = function.functionname
+
+    # -------------------------------------------------------------------------
+    # If CLASS_NAME_RESOLUTION is enabled, the top element of the
+    # stack should be the class name of the function from which this
+    # trace call is made. This cannot be policed so the user must make
+    # sure this is the case by ensuring that trace is only called
+    # outside of any function or from within functions that have the
+    # @TraceFunction decorator.
+    # -------------------------------------------------------------------------
+    top = CALL_STACK.get()
+
+    if CLASS_NAME_RESOLUTION and top is not None:
+        classname = top[1]
+        if classname != "<module>":
+            functionname = classname + "." + functionname
+
+    # -------------------------------------------------------------------------
+    # A traced function's records are indented by the number of traced
+    # calls it is nested in.
+    # -------------------------------------------------------------------------
+    indent = 0
+    held = None
+    if top is not None:
+        if INDENT_WIDTH:
+            indent = (top[0] - 1) * INDENT_WIDTH
+        held = top[3]
+
+    spanids = None
+    if TRACE_SPANS:
+        span = SPAN.get()
+        spanids = span[2] if span is not None else NO_SPAN
+
+    # -------------------------------------------------------------------------
+    # The logging module fills in the time and the thread itself and
+    # leaves the formatting to its handlers.
+    # -------------------------------------------------------------------------
+    if sink is not None:
+        record = sink.record(filename, lineno, functionname, indent, message,
+                             spanids)
+
+        if held is not None:
+            held.append((perf_counter(), functionname, record))
+            return
+
+        sink.handle(record)
+        if PYLG_STATS:
+            PyLg.buffer().records += 1
+        return
+
+    # -------------------------------------------------------------------------
+    # Collect what the record needs from the calling thread. With
+    # DEFERRED_FORMAT, the string itself is only generated when the
+    # record is written. Records held back by a filtered call are never
+    # formatted unless the call passes its filters.
+    # -------------------------------------------------------------------------
+    now = datetime.now() if TRACE_TIME else None
+    threadname = threading.current_thread().name if TRACE_THREAD else None
+
+    buf = PyLg.buffer()
+
+    columns = None
+    if COMPACT_SITES:
+        columns = buf.site(filename, lineno, functionname)
+
+    if DEFERRED_FORMAT or held is not None:
+        msg = (now, threadname, spanids, columns, filename, lineno,
+               functionname, indent, message)
+    else:
+        msg = format_record(now, threadname, spanids, columns, filename,
+                            lineno, functionname, indent, message)
+
+    if held is not None:
+        held.append((perf_counter(), functionname, msg))
+        return
+
     # -------------------------------------------------------------------------
     # Write the data to the log file.
     # -------------------------------------------------------------------------
-    PyLg.write(msg)
+    if not PYLG_STATS:
+        buf.add(msg, functionname)
+        return
+
+    formatted = perf_counter()
+    buf.add(msg, functionname)
+    end = perf_counter()
+
+    buf.records += 1
+    buf.format_time += formatted - start
+    buf.write_time += end - formatted
+
+    if (STATS_INTERVAL and function is not STATS_SITE and
+            end - PyLgStats.last_report >= STATS_INTERVAL):
+        PyLgStats.last_report = end
+        trace(PyLgStats.report(), function=STATS_SITE)
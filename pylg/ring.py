@@ -0,0 +1,258 @@
+# -----------------------------------------------------------------------------
+# PyLg: module to facilitate and automate the process of writing runtime logs.
+# Copyright (C) 2017 Wojciech Kozlowski <wk@wojciechkozlowski.eu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+
+""" Reader for the rings written with PYLG_RING.
+
+    Usage:
+
+        python -m pylg.ring [NAME ...] [--output DIR] [--list] [--clean]
+
+    Takes a snapshot of the rings of the given names, or of every ring
+    in /dev/shm, and prints their records. The processes writing them
+    are not interrupted: each ring is copied once and only the records
+    that were complete and not overwritten while it was copied are
+    printed. --output writes every ring to a log file of its own
+    instead, which the other PyLg tools can read.
+"""
+
+from collections import namedtuple
+from datetime import datetime
+import argparse
+import sys
+import os
+
+from .sinks import (RING_PREFIX, RING_MAGIC, RING_HEADER, RING_COUNTER,
+                    RING_LENGTH, RING_RESERVED, RING_COMMITTED, RING_DATA,
+                    shared_memory, unlink_shared_memory)
+
+SHM_DIR = "/dev/shm"
+HEADER = b"=== Log initialised at "
+
+# -----------------------------------------------------------------------------
+# The number of times a ring is copied before giving up on finding a
+# record that was not overwritten during the copy.
+# -----------------------------------------------------------------------------
+ATTEMPTS = 10
+
+# -----------------------------------------------------------------------------
+# The records of a ring when it was copied. written is the number of
+# bytes written to it since it was created, running whether its
+# process is still alive.
+# -----------------------------------------------------------------------------
+Snapshot = namedtuple("Snapshot", ["name", "pid", "created", "written",
+                                   "running", "records"])
+
+
+def find_rings():
+
+    """ Find the rings in /dev/shm.
+
+        :return: The ring names, ordered by pid.
+    """
+
+    try:
+        names = [name for name in os.listdir(SHM_DIR)
+                 if name.startswith(RING_PREFIX)]
+    except OSError:
+        return []
+
+    def pid(name):
+        field = name[len(RING_PREFIX):].partition(".")[0]
+        return (int(field) if field.isdigit() else 0, name)
+
+    return sorted(names, key=pid)
+
+
+def is_running(pid):
+
+    """ Check whether a process is alive.
+    """
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read(data, pos, size):
+
+    """ Read bytes from the data area of a ring, wrapping around its
+        end.
+
+        :param int pos: The counter value to read from.
+    """
+
+    offset = pos % len(data)
+    chunk = data[offset:offset + size]
+    if len(chunk) < size:
+        chunk += data[:size - len(chunk)]
+    return chunk
+
+
+def entries(data, reserved, committed):
+
+    """ Walk the entries of a copied ring back from the committed
+        counter. The oldest ones may have been overwritten, as may
+        those before reserved - capacity while the ring was copied.
+
+        :param bytes data: The copied data area.
+        :param int reserved: The reserved counter after the copy.
+        :param int committed: The committed counter before the copy.
+        :return: The entries, oldest first.
+    """
+
+    size = RING_LENGTH.size
+    low = max(reserved - len(data), 0)
+
+    found = []
+    pos = committed
+    while pos - 2 * size >= low:
+        length, = RING_LENGTH.unpack(read(data, pos - size, size))
+        start = pos - 2 * size - length
+        if start < low:
+            break
+
+        # ---------------------------------------------------------------------
+        # Both lengths agree unless the entry was only partly
+        # overwritten.
+        # ---------------------------------------------------------------------
+        if RING_LENGTH.unpack(read(data, start, size))[0] != length:
+            break
+
+        found.append(read(data, start + size, length))
+        pos = start
+
+    found.reverse()
+    return found
+
+
+def snapshot(name):
+
+    """ Copy the records of a ring.
+
+        :param str name: The ring name.
+        :return: The Snapshot.
+    """
+
+    shm = shared_memory(name)
+    try:
+        buf = shm.buf
+        magic, capacity, pid, _, _, created = RING_HEADER.unpack_from(buf, 0)
+        if magic != RING_MAGIC:
+            raise ValueError(name + " is not a PyLg ring")
+
+        # ---------------------------------------------------------------------
+        # A process writing faster than the ring is copied can
+        # overwrite all of it in the meantime. Try again in that case.
+        # ---------------------------------------------------------------------
+        for attempt in range(ATTEMPTS):
+            committed, = RING_COUNTER.unpack_from(buf, RING_COMMITTED)
+            data = bytes(buf[RING_DATA:RING_DATA + capacity])
+            reserved, = RING_COUNTER.unpack_from(buf, RING_RESERVED)
+
+            found = entries(data, reserved, committed)
+            if found or not committed:
+                break
+
+        buf = None
+    finally:
+        shm.close()
+
+    records = [entry for entry in found if not entry.startswith(HEADER)]
+
+    return Snapshot(name, pid, datetime.fromtimestamp(created), committed,
+                    is_running(pid), records)
+
+
+def remove(name):
+
+    """ Remove a ring.
+    """
+
+    shm = shared_memory(name)
+    shm.close()
+    unlink_shared_memory(shm)
+
+
+def describe(snap):
+
+    return "{}: pid {}, {}, {} records, {} bytes written".format(
+        snap.name, snap.pid, "running" if snap.running else "exited",
+        len(snap.records), snap.written)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        prog="python -m pylg.ring",
+        description="Print the records of the rings written with "
+                    "PYLG_RING.")
+    parser.add_argument("names", metavar="NAME", nargs="*",
+                        help="the rings to read, every ring in " + SHM_DIR +
+                             " by default")
+    parser.add_argument("--output", metavar="DIR",
+                        help="write every ring to a log file named after it "
+                             "in DIR")
+    parser.add_argument("--list", action="store_true",
+                        help="only list the rings")
+    parser.add_argument("--clean", action="store_true",
+                        help="remove the rings of processes that have "
+                             "exited once they are read")
+    args = parser.parse_args(argv)
+
+    names = args.names or find_rings()
+    if not names:
+        sys.exit("No rings found")
+
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+
+    out = sys.stdout.buffer if hasattr(sys.stdout, "buffer") else sys.stdout
+
+    for name in names:
+        try:
+            snap = snapshot(name)
+        except (OSError, ValueError) as e:
+            print("Cannot read " + name + ": " + str(e), file=sys.stderr)
+            continue
+
+        if args.list:
+            print(describe(snap))
+
+        elif args.output:
+            filename = os.path.join(args.output, name)
+            with open(filename, "wb") as log:
+                log.write(HEADER + str(snap.created).encode() + b" ===\n\n")
+                log.writelines(snap.records)
+            print(describe(snap) + " -> " + filename, file=sys.stderr)
+
+        else:
+            out.write(("=== " + describe(snap) + " ===\n\n").encode())
+            out.writelines(snap.records)
+            out.write(b"\n")
+            out.flush()
+
+        if args.clean and not snap.running:
+            remove(name)
+
+
+if __name__ == "__main__":
+    main()
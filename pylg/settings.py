@@ -39,11 +39,19 @@ DEFAULT_EXCEPTION_WARNING = True
 DEFAULT_EXCEPTION_TB_FILE = True
 
 # -----------------------------------------------------------------------------
-# The default value for 'exception_tb_file'. If True, PyLg will print
+# The default value for 'exception_tb_stderr'. If True, PyLg will print
 # the exception tracebacks to stderr.
 # -----------------------------------------------------------------------------
 DEFAULT_EXCEPTION_TB_STDERR = False
 
+# -----------------------------------------------------------------------------
+# The default value for 'exception_tb_summary'. If True, the exception
+# tracebacks are replaced by the file, line and function the exception
+# was raised in. This is much cheaper for code that uses exceptions
+# for control flow.
+# -----------------------------------------------------------------------------
+DEFAULT_EXCEPTION_TB_SUMMARY = False
+
 # -----------------------------------------------------------------------------
 # The default value for 'exception_exit'. If True, PyLg will force the
 # program to exit (and not just raise SystemExit) whenever an
@@ -63,6 +71,33 @@ TRACE_TIME = True
 # -----------------------------------------------------------------------------
 TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
 
+# -----------------------------------------------------------------------------
+# Enable/disable the logging of the name of the thread from which the
+# trace call was made.
+# -----------------------------------------------------------------------------
+TRACE_THREAD = False
+
+# -----------------------------------------------------------------------------
+# The column width for the thread name. If a name is too long, it will
+# be truncated.
+# -----------------------------------------------------------------------------
+THREAD_COLUMN_WIDTH = 12
+
+# -----------------------------------------------------------------------------
+# Enable/disable the span column, which correlates the records of a
+# request. The outermost traced call starts a trace and every traced
+# call is a span within it. The column reads 'trace/span/parent', with
+# '-' for ids that are not set. See pylg.TraceContext to give a trace
+# an id of your own and pylg.propagate to carry it into other threads.
+# -----------------------------------------------------------------------------
+TRACE_SPANS = False
+
+# -----------------------------------------------------------------------------
+# The minimum column width for the span ids. The ids are never
+# truncated.
+# -----------------------------------------------------------------------------
+SPAN_COLUMN_WIDTH = 24
+
 # -----------------------------------------------------------------------------
 # Enable/disable file name logging.
 # -----------------------------------------------------------------------------
@@ -111,6 +146,13 @@ FUNCTION_COLUMN_WIDTH = 32
 # -----------------------------------------------------------------------------
 CLASS_NAME_RESOLUTION = False
 
+# -----------------------------------------------------------------------------
+# The number of spaces the message column is indented by for every
+# traced call the record is nested in, to show the call depth. Zero
+# disables indentation.
+# -----------------------------------------------------------------------------
+INDENT_WIDTH = 0
+
 # -----------------------------------------------------------------------------
 # Enable/disable message logging.
 # -----------------------------------------------------------------------------
@@ -148,6 +190,26 @@ TRACE_SELF = False
 COLLAPSE_LISTS = False
 COLLAPSE_DICTS = False
 
+# -----------------------------------------------------------------------------
+# If non-zero, the strings of up to this many argument and return
+# values are kept in an LRU cache, so that values passed over and over
+# again are only converted to strings once. Values are cached by
+# identity. Of the immutable types, only bytes, dates, times and
+# timedeltas are cached by default: the strings of numbers, strings
+# and plain enum members are cheaper to build than to look up. Zero
+# disables the cache.
+# -----------------------------------------------------------------------------
+RENDER_CACHE = 0
+
+# -----------------------------------------------------------------------------
+# Further types whose values are cached by RENDER_CACHE, e.g. the
+# classes of configuration objects or enum.Enum for enums with costly
+# strings. Values of these types and their subclasses are cached
+# whether they are mutable or not: a value that changes after it was
+# cached is logged as it was.
+# -----------------------------------------------------------------------------
+RENDER_CACHE_TYPES = ()
+
 # -----------------------------------------------------------------------------
 # The default setting for 'trace_args'. If True, PyLg will log input
 # parameters.
@@ -165,3 +227,185 @@ DEFAULT_TRACE_RV = True
 # return value types.
 # -----------------------------------------------------------------------------
 DEFAULT_TRACE_RV_TYPE = False
+
+# -----------------------------------------------------------------------------
+# Measurements of every traced call written in its EXIT record, e.g.
+# '<- EXIT [wall=0.012034s cpu=0.000410s alloc=+2048B] : 1'. Each one
+# has its own overhead so they are enabled separately:
+#
+# TRACE_DURATION - the wall clock time of the call.
+# TRACE_CPU_TIME - the CPU time of the calling thread during the call.
+#                  Much less than the wall clock time means the call
+#                  was mostly waiting, e.g. on I/O or locks.
+# TRACE_ALLOCATIONS - the net number of bytes allocated during the
+#                     call. Only measured while tracemalloc is tracing.
+# -----------------------------------------------------------------------------
+TRACE_DURATION = False
+TRACE_CPU_TIME = False
+TRACE_ALLOCATIONS = False
+
+# -----------------------------------------------------------------------------
+# The default value for 'max_depth'. Calls made while this many traced
+# calls are already in progress in the same thread are not logged. Zero
+# means unlimited.
+# -----------------------------------------------------------------------------
+DEFAULT_MAX_DEPTH = 0
+
+# -----------------------------------------------------------------------------
+# The default value for 'recursion_limit'. Recursive calls of a traced
+# function more than this many levels deep are not logged. They are
+# counted and timed instead and summarised in a single line before the
+# EXIT line of the deepest logged call. Zero means no limit.
+# -----------------------------------------------------------------------------
+DEFAULT_RECURSION_LIMIT = 0
+
+# -----------------------------------------------------------------------------
+# The default value for 'min_duration'. Calls that return in less than
+# this many seconds are not logged. Zero means every call is logged.
+# -----------------------------------------------------------------------------
+DEFAULT_MIN_DURATION = 0
+
+# -----------------------------------------------------------------------------
+# Filters for the traced functions whose name matches a pattern. Every
+# rule is a dictionary with a 'function' fnmatch pattern, matched
+# against both the function name and 'ClassName.function_name', and
+# any of the 'args', 'rv' and 'min_duration' filters of TraceFunction.
+# The first matching rule completes the filters not given to the
+# decorator. For example:
+#
+# FILTER_RULES = [
+#     {"function": "handle_*", "args": lambda request: request.user_id == 42},
+#     {"function": "Db.*", "min_duration": 0.05},
+# ]
+# -----------------------------------------------------------------------------
+FILTER_RULES = []
+
+# -----------------------------------------------------------------------------
+# Enable/disable PyLg's own counters (records and bytes written, time
+# spent formatting and writing, dropped records and flushes). They are
+# available from pylg.stats().
+# -----------------------------------------------------------------------------
+PYLG_STATS = True
+
+# -----------------------------------------------------------------------------
+# If non-zero, PyLg will write its counters to the log file at most
+# once every STATS_INTERVAL seconds. Zero means never.
+# -----------------------------------------------------------------------------
+STATS_INTERVAL = 0
+
+# -----------------------------------------------------------------------------
+# If True, PyLg will write a sidecar index next to the log file (with
+# an '.idx' suffix) to find records by time or function without
+# scanning the whole log. See 'python -m pylg.index'.
+# -----------------------------------------------------------------------------
+PYLG_INDEX = False
+
+# -----------------------------------------------------------------------------
+# The number of seconds between the time entries of the index.
+# -----------------------------------------------------------------------------
+INDEX_INTERVAL = 1
+
+# -----------------------------------------------------------------------------
+# The number of records each thread buffers before they are written
+# out. Threads append to their own buffers without locking. Unless
+# THREAD_FILES is enabled, the buffers of all threads are merged in
+# time order into the log file. Zero means records are written
+# immediately. Buffered records are written at exit or by PyLg.close.
+# Only one thread at a time writes to the log file.
+# -----------------------------------------------------------------------------
+THREAD_BUFFER = 0
+
+# -----------------------------------------------------------------------------
+# If True, each thread writes its records to its own log file named
+# after the log file and the thread, e.g. 'pylg.log.MainThread'.
+# -----------------------------------------------------------------------------
+THREAD_FILES = False
+
+# -----------------------------------------------------------------------------
+# If non-zero, log files are written through a memory map and
+# preallocated in chunks of this many bytes, so that writing a record
+# needs no system call. The file is truncated to its real length when
+# it is closed, which also happens at exit. Zero means log files are
+# written with regular writes.
+# -----------------------------------------------------------------------------
+MMAP_CHUNK = 0
+
+# -----------------------------------------------------------------------------
+# If set, log files are sent to a collector instead of being written
+# locally, see 'python -m pylg.collector'. The address is either
+# 'unix:PATH' for a Unix domain socket or 'tcp:HOST:PORT'. None means
+# log files are written locally.
+# -----------------------------------------------------------------------------
+PYLG_COLLECTOR = None
+
+# -----------------------------------------------------------------------------
+# Records are sent to the collector in frames of up to
+# COLLECTOR_BATCH bytes. A frame is sent once it is full or once its
+# first record has waited for COLLECTOR_LATENCY seconds.
+# -----------------------------------------------------------------------------
+COLLECTOR_BATCH = 65536
+COLLECTOR_LATENCY = 1.0
+
+# -----------------------------------------------------------------------------
+# If the collector does not accept a connection or a frame within
+# COLLECTOR_TIMEOUT seconds, frames are spooled to a local file named
+# after the log file with a '.spool' suffix. The sink tries to
+# reconnect every COLLECTOR_RETRY seconds and sends the spooled frames
+# first when it does.
+# -----------------------------------------------------------------------------
+COLLECTOR_TIMEOUT = 1.0
+COLLECTOR_RETRY = 5.0
+
+# -----------------------------------------------------------------------------
+# If set, records are passed to the 'logging' logger of this name as
+# LogRecords instead of being written to a log file. The logger's
+# level is checked before a record is built, so traced calls cost
+# little while LOGGER_LEVEL is disabled. The time, thread and call
+# site are left to the logging formatter, the message keeps its
+# indentation. None means records are written to log files.
+# -----------------------------------------------------------------------------
+PYLG_LOGGER = None
+
+# -----------------------------------------------------------------------------
+# The level of the LogRecords passed to PYLG_LOGGER, a level name
+# such as 'DEBUG' or a number.
+# -----------------------------------------------------------------------------
+LOGGER_LEVEL = "DEBUG"
+
+# -----------------------------------------------------------------------------
+# If non-zero, every process writes its records to a ring buffer of
+# this many bytes in shared memory instead of a log file, overwriting
+# the oldest records once it is full. Nothing is written to disk and
+# 'python -m pylg.ring' prints the recent records of every process on
+# demand. The ring is removed when the process exits normally and
+# left behind if it dies. Must be at least 4096. Zero means log files
+# are written normally.
+# -----------------------------------------------------------------------------
+PYLG_RING = 0
+
+# -----------------------------------------------------------------------------
+# If True, the filename, line number and function name columns are
+# replaced by a call site id, e.g. '@12'. Every call site is defined
+# once in a line of the form '#<id>\t<filename>\t<lineno>\t<function>'
+# before the first record that uses it. The parser and the analysis
+# tools read such logs directly and 'python -m pylg.expand' rewrites
+# them in the full layout.
+# -----------------------------------------------------------------------------
+COMPACT_SITES = False
+
+# -----------------------------------------------------------------------------
+# If True, records are only formatted when they are written to the log
+# rather than when they are logged. The arguments and return values of
+# traced functions are kept until then. With THREAD_BUFFER, this moves
+# formatting out of the traced code into the flushes.
+# -----------------------------------------------------------------------------
+DEFERRED_FORMAT = False
+
+# -----------------------------------------------------------------------------
+# What DEFERRED_FORMAT keeps of the arguments and return values:
+# 'reference' keeps the objects themselves, so the log shows their
+# state when the record is written; 'shallow' keeps shallow copies of
+# lists, dicts, sets and bytearrays, so the log shows their contents
+# at the time of the call.
+# -----------------------------------------------------------------------------
+DEFERRED_SNAPSHOT = "shallow"
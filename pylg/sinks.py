@@ -0,0 +1,689 @@
+# -----------------------------------------------------------------------------
+# PyLg: module to facilitate and automate the process of writing runtime logs.
+# Copyright (C) 2017 Wojciech Kozlowski <wk@wojciechkozlowski.eu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+
+""" Alternative destinations for log records. The file sinks behave
+    like a file opened for writing in binary mode: they have write,
+    flush and close methods, whether they write to a file, a socket or
+    shared memory. LoggingSink passes the records to the logging
+    module before they are formatted instead.
+"""
+
+import threading
+import socket
+import struct
+import time
+import mmap
+import sys
+import os
+
+
+class MmapFile(object):
+
+    """ A log file written through a memory map. The file is extended
+        in chunks and records are copied straight into the mapping, so
+        writing a record needs no system call. The file is truncated
+        to the length actually written when it is closed.
+
+        Until then, the file is padded with NUL bytes up to the end of
+        the current chunk. If the process dies without closing it, the
+        padding is left at the end of the log.
+    """
+
+    def __init__(self, filename, chunk):
+
+        """ Constructor for MmapFile. The file is created or
+            truncated.
+
+            :param str filename: The log file name.
+            :param int chunk: The number of bytes to extend the file
+                              by when the mapping is full.
+        """
+
+        self.file = open(filename, "w+b")
+        self.chunk = chunk
+        self.mm = None
+        self.size = 0
+        self.pos = 0
+
+    def grow(self, needed):
+
+        """ Extend the file and the mapping to hold at least needed
+            bytes.
+        """
+
+        size = (needed // self.chunk + 1) * self.chunk
+
+        if self.mm is not None:
+            self.mm.close()
+
+        self.file.truncate(size)
+        self.mm = mmap.mmap(self.file.fileno(), size)
+        self.size = size
+
+    def write(self, data):
+
+        """ Write bytes at the end of the log.
+
+            :param bytes data: The data to write.
+        """
+
+        end = self.pos + len(data)
+        if end > self.size:
+            self.grow(end)
+
+        self.mm[self.pos:end] = data
+        self.pos = end
+
+    def flush(self):
+
+        """ Nothing to do: the mapping shares the page cache with the
+            file, so other processes reading it see the records
+            already.
+        """
+
+    def close(self):
+
+        """ Unmap the file and truncate it to the length written.
+        """
+
+        if self.mm is not None:
+            self.mm.flush()
+            self.mm.close()
+            self.mm = None
+
+        self.file.truncate(self.pos)
+        self.file.close()
+
+
+# -----------------------------------------------------------------------------
+# The layout of a ring in shared memory. The header holds a magic
+# number, the capacity of the data area, the pid of the writer, the
+# reserved and committed byte counters and the creation time. The
+# data area follows at RING_DATA. Every entry in it is a 4-byte
+# length, the bytes written and the length again, so that a reader
+# can walk the entries back from the committed counter. The counters
+# only ever grow: an entry starts at counter % capacity and may wrap
+# around the end of the data area.
+# -----------------------------------------------------------------------------
+RING_PREFIX = "pylg."
+RING_MAGIC = b"PYLGRNG1"
+RING_HEADER = struct.Struct("<8sQQQQd")
+RING_COUNTER = struct.Struct("<Q")
+RING_LENGTH = struct.Struct("<I")
+RING_RESERVED = 24
+RING_COMMITTED = 32
+RING_DATA = 64
+
+
+def ring_name(pid, filename):
+
+    """ Get the name of the ring of a process for a log file, e.g.
+        'pylg.1234.pylg.log'.
+
+        :param int pid: The pid of the writer.
+        :param str filename: The log file name.
+    """
+
+    return "{}{}.{}".format(RING_PREFIX, pid, os.path.basename(filename))
+
+
+def shared_memory(name, create=False, size=0):
+
+    """ Open a shared memory segment that is not removed when this
+        process exits. Before Python 3.13, multiprocessing registers
+        every segment it opens with its resource tracker, which would
+        unlink it at exit even if it was only attached, so it is
+        unregistered straight away.
+
+        :param str name: The segment name.
+        :param bool create: Whether to create the segment.
+        :param int size: The size of a new segment.
+        :return: The SharedMemory.
+    """
+
+    from multiprocessing.shared_memory import SharedMemory
+
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name, create, size, track=False)
+
+    from multiprocessing import resource_tracker
+
+    shm = SharedMemory(name, create, size)
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def unlink_shared_memory(shm):
+
+    """ Remove a segment opened with shared_memory. Before Python
+        3.13, unlink also unregisters it from the resource tracker, so
+        it is registered again first.
+
+        :param shm: The SharedMemory.
+    """
+
+    if sys.version_info < (3, 13):
+        from multiprocessing import resource_tracker
+        resource_tracker.register(shm._name, "shared_memory")
+
+    shm.unlink()
+
+
+class RingSink(object):
+
+    """ A log kept in a ring buffer in shared memory, see
+        'python -m pylg.ring'. Every write is an entry of the ring and
+        the oldest entries are overwritten once it is full, so nothing
+        ever reaches the disk. A reader may copy the ring at any time:
+        the reserved counter is advanced before an entry is copied in
+        and the committed counter after, so the reader can tell which
+        entries were complete and not overwritten while it copied.
+
+        Every process has its own ring, named after its pid. A process
+        forked after the ring was created starts its own on its first
+        write. The ring is removed when it is closed by the process
+        that created it.
+    """
+
+    def __init__(self, filename, size):
+
+        """ Constructor for RingSink.
+
+            :param str filename: The log file name the ring is named
+                                 after.
+            :param int size: The size of the ring in bytes, including
+                             its header.
+        """
+
+        self.filename = filename
+        self.size = size
+        self.capacity = size - RING_DATA
+
+        # ---------------------------------------------------------------------
+        # Longer writes only keep their end so that an entry always
+        # fits in the ring.
+        # ---------------------------------------------------------------------
+        self.limit = self.capacity - 2 * RING_LENGTH.size
+
+        self.shm = None
+        self.create()
+
+    def create(self):
+
+        """ Create the ring of this process. A ring left behind by a
+            dead process with the same pid is replaced.
+        """
+
+        if self.shm is not None:
+            self.shm.close()
+
+        self.pid = os.getpid()
+        name = ring_name(self.pid, self.filename)
+
+        try:
+            self.shm = shared_memory(name, True, self.size)
+        except FileExistsError:
+            stale = shared_memory(name)
+            stale.close()
+            unlink_shared_memory(stale)
+            self.shm = shared_memory(name, True, self.size)
+
+        self.buf = self.shm.buf
+        self.head = 0
+        RING_HEADER.pack_into(self.buf, 0, RING_MAGIC, self.capacity,
+                              self.pid, 0, 0, time.time())
+
+    def write(self, data):
+
+        """ Add bytes to the ring as one entry.
+
+            :param bytes data: The data to write.
+        """
+
+        if self.pid != os.getpid():
+            self.create()
+
+        length = len(data)
+        if length > self.limit:
+            data = data[length - self.limit:]
+            length = self.limit
+
+        size = RING_LENGTH.pack(length)
+        entry = size + data + size
+
+        buf = self.buf
+        start = self.head
+        end = start + len(entry)
+        RING_COUNTER.pack_into(buf, RING_RESERVED, end)
+
+        capacity = self.capacity
+        offset = start % capacity
+        first = capacity - offset
+        if first >= len(entry):
+            buf[RING_DATA + offset:RING_DATA + offset + len(entry)] = entry
+        else:
+            buf[RING_DATA + offset:RING_DATA + capacity] = entry[:first]
+            buf[RING_DATA:RING_DATA + len(entry) - first] = entry[first:]
+
+        RING_COUNTER.pack_into(buf, RING_COMMITTED, end)
+        self.head = end
+
+    def flush(self):
+
+        """ Nothing to do: readers see every entry once it is
+            committed.
+        """
+
+    def close(self):
+
+        """ Detach from the ring and remove it if this process created
+            it.
+        """
+
+        if self.shm is None:
+            return
+
+        self.buf = None
+        self.shm.close()
+        if self.pid == os.getpid():
+            unlink_shared_memory(self.shm)
+        self.shm = None
+
+
+# -----------------------------------------------------------------------------
+# The frames sent to a collector. Every frame is a 4-byte big-endian
+# length, a 1-byte kind and the payload. A connection starts with a
+# HELLO frame naming the source, followed by DATA frames of whole
+# records. Spool files hold the same frames.
+# -----------------------------------------------------------------------------
+FRAME_HEADER = struct.Struct(">Ic")
+FRAME_HELLO = b"H"
+FRAME_DATA = b"D"
+
+SPOOL_SUFFIX = ".spool"
+
+
+def parse_address(address):
+
+    """ Parse a collector address, 'unix:PATH' or 'tcp:HOST:PORT'.
+
+        :param str address: The address.
+        :return: A (family, address) tuple for socket.socket and
+                 socket.connect.
+    """
+
+    kind, _, rest = address.partition(":")
+
+    if kind == "unix" and rest:
+        return socket.AF_UNIX, rest
+
+    if kind == "tcp":
+        host, _, port = rest.rpartition(":")
+        if host and port.isdigit():
+            return socket.AF_INET, (host, int(port))
+
+    raise ValueError("Invalid collector address " + repr(address) +
+                     " - should be 'unix:PATH' or 'tcp:HOST:PORT'")
+
+
+class SocketSink(object):
+
+    """ A log sent to a collector over a Unix domain or TCP socket.
+        Records are batched into frames of up to batch bytes. A frame
+        is sent once it is full or its first record has waited for
+        latency seconds, whichever comes first.
+
+        A collector that does not accept a frame within timeout
+        seconds, because it is down or cannot keep up, is disconnected
+        and the frame is written to a local spool file instead, so the
+        traced program is never held up for longer than that. Every
+        retry seconds, the sink tries to reconnect and sends the
+        spooled frames first, so the collector receives the records of
+        the sink in order.
+    """
+
+    def __init__(self, address, filename, batch, latency, timeout, retry):
+
+        """ Constructor for SocketSink. The connection is made when
+            the first frame is sent.
+
+            :param str address: The collector address, see
+                                parse_address.
+            :param str filename: The log file name. It names the
+                                 source of the records and frames are
+                                 spooled next to it, with a '.spool'
+                                 suffix, while the collector is
+                                 unavailable.
+            :param int batch: The size of a frame in bytes.
+            :param float latency: The longest time a record waits to be
+                                  sent, in seconds.
+            :param float timeout: The time to wait for the collector to
+                                  accept a connection or a frame, in
+                                  seconds.
+            :param float retry: The time between attempts to
+                                reconnect, in seconds.
+        """
+
+        self.family, self.address = parse_address(address)
+        self.spool_filename = filename + SPOOL_SUFFIX
+        self.batch_size = batch
+        self.latency = latency
+        self.timeout = timeout
+        self.retry = retry
+
+        self.source = (socket.gethostname() + ":" + str(os.getpid()) + ":" +
+                       filename)
+        hello = self.source.encode("utf-8")
+        self.hello = FRAME_HEADER.pack(len(hello), FRAME_HELLO) + hello
+
+        self.sock = None
+        self.next_attempt = 0.0
+
+        self.batch = bytearray()
+        self.batch_started = None
+
+        # ---------------------------------------------------------------------
+        # The spool file is only created when needed. sent is the
+        # offset up to which it has been replayed to the collector.
+        # The frames spooled by this sink are preceded by its HELLO
+        # frame, so that those left by an earlier run are not taken for
+        # this one's when they are replayed.
+        # ---------------------------------------------------------------------
+        self.spool = None
+        self.sent = 0
+        self.spool_named = False
+        self.replayed_hello = None
+
+        # ---------------------------------------------------------------------
+        # PyLg only writes to the sink from one thread at a time, so
+        # the lock is only ever contended by the thread that sends
+        # frames that have waited for too long.
+        # ---------------------------------------------------------------------
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.timer = threading.Thread(target=self.send_late,
+                                      name="pylg-sink")
+        self.timer.daemon = True
+        self.timer.start()
+
+    def write(self, data):
+
+        """ Add bytes to the current frame, sending it if it is full.
+
+            :param bytes data: Whole records.
+        """
+
+        with self.lock:
+            if not self.batch:
+                self.batch_started = time.monotonic()
+
+            self.batch += data
+            if len(self.batch) >= self.batch_size:
+                self.send_batch()
+
+    def flush(self):
+
+        """ Send the current frame if its first record has waited for
+            long enough. PyLg flushes after every write, so flushing
+            does not send every frame.
+        """
+
+        with self.lock:
+            if (self.batch and
+                    time.monotonic() - self.batch_started >= self.latency):
+                self.send_batch()
+
+    def send_late(self):
+
+        """ Send the frames that have waited for too long while
+            nothing was written. Runs in the sink's own thread.
+        """
+
+        while not self.closed.wait(self.latency / 2.0):
+            self.flush()
+
+    def close(self):
+
+        """ Send the current frame and disconnect. Frames that cannot
+            be sent are left in the spool file.
+        """
+
+        self.closed.set()
+
+        with self.lock:
+            if self.batch:
+                self.next_attempt = 0.0
+                self.send_batch()
+
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+
+            if self.spool is not None:
+                self.spool.close()
+                self.spool = None
+
+    def send_batch(self):
+
+        """ Send the current frame, or spool it if the collector is
+            unavailable. Must be called with the lock held.
+        """
+
+        frame = (FRAME_HEADER.pack(len(self.batch), FRAME_DATA) +
+                 bytes(self.batch))
+        self.batch = bytearray()
+
+        if self.connect() and self.send(frame):
+            return
+
+        self.spool_frame(frame)
+
+    def connect(self):
+
+        """ Connect to the collector if not connected and if it is
+            time to try again, and send the spooled frames.
+
+            :return: True if connected.
+        """
+
+        if self.sock is not None:
+            return True
+
+        now = time.monotonic()
+        if now < self.next_attempt:
+            return False
+
+        self.next_attempt = now + self.retry
+
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+        except (OSError, socket.timeout):
+            sock.close()
+            return False
+
+        self.sock = sock
+
+        if not self.send(self.hello):
+            return False
+
+        return self.replay()
+
+    def send(self, frame):
+
+        """ Send a frame, disconnecting if the collector does not take
+            it in time. A frame that was cut off is dropped by the
+            collector, so it can be sent again in full.
+
+            :return: True if sent.
+        """
+
+        try:
+            self.sock.sendall(frame)
+            return True
+        except (OSError, socket.timeout):
+            self.sock.close()
+            self.sock = None
+            return False
+
+    def spool_frame(self, frame):
+
+        """ Append a frame to the spool file. The frames left in it by
+            an earlier run that could not reach the collector are kept
+            and sent first.
+        """
+
+        if self.spool is None:
+            self.spool = open(self.spool_filename, "a+b")
+            self.sent = 0
+
+        if not self.spool_named:
+            self.spool.write(self.hello)
+            self.spool_named = True
+
+        self.spool.write(frame)
+
+    def replay(self):
+
+        """ Send the spooled frames, one at a time. The spool file is
+            emptied once all of them have been sent.
+
+            :return: True if all of them were sent.
+        """
+
+        if self.spool is None:
+            if not os.path.exists(self.spool_filename):
+                return True
+            self.spool = open(self.spool_filename, "a+b")
+            self.sent = 0
+            self.replayed_hello = None
+
+        # ---------------------------------------------------------------------
+        # A replay cut off by a lost connection resumes with the last
+        # HELLO frame it sent.
+        # ---------------------------------------------------------------------
+        if (self.replayed_hello is not None and
+                not self.send(self.replayed_hello)):
+            return False
+
+        while True:
+            self.spool.seek(self.sent)
+            # -----------------------------------------------------------------
+            # A frame cut off by a crash while it was spooled is
+            # dropped.
+            # -----------------------------------------------------------------
+            header = self.spool.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                break
+
+            length, kind = FRAME_HEADER.unpack(header)
+            payload = self.spool.read(length)
+            if len(payload) < length:
+                break
+
+            if not self.send(header + payload):
+                return False
+
+            if kind == FRAME_HELLO:
+                self.replayed_hello = header + payload
+
+            self.sent += FRAME_HEADER.size + length
+
+        # ---------------------------------------------------------------------
+        # The replayed frames may have named an earlier run as their
+        # source, so the frames that follow are named again.
+        # ---------------------------------------------------------------------
+        if self.sent and not self.send(self.hello):
+            return False
+
+        self.spool.close()
+        self.spool = None
+        self.spool_named = False
+        os.remove(self.spool_filename)
+        return True
+
+
+class LoggingSink(object):
+
+    """ Passes records to a logger of the logging module as
+        LogRecords. The record is only built once the logger is known
+        to be enabled for the level, and PyLg does none of its own
+        formatting: the time, thread and call site go in the fields of
+        the LogRecord and the message is only converted to a string
+        when a handler formats it.
+
+        Every LogRecord has a pylg_span attribute, the span column if
+        TRACE_SPANS is enabled and None otherwise. PyLgHandler ignores
+        the records that have it so that the two cannot feed each
+        other.
+    """
+
+    def __init__(self, name, level):
+
+        """ Constructor for LoggingSink.
+
+            :param str name: The logger name.
+            :param level: The level of the records, a level name or a
+                          number.
+        """
+
+        import logging
+
+        self.name = name
+        self.logger = logging.getLogger(name)
+
+        if isinstance(level, str):
+            level = logging.getLevelName(level)
+        self.level = level
+
+    def enabled(self):
+
+        """ Check whether the logger handles records of the level.
+        """
+
+        return self.logger.isEnabledFor(self.level)
+
+    def record(self, filename, lineno, functionname, indent, message,
+               spanids):
+
+        """ Build the LogRecord of a record.
+
+            :param int indent: The number of spaces to indent the
+                               message by.
+            :param message: The log message, converted to a string
+                            when the LogRecord is formatted.
+            :param str spanids: The span column or None.
+            :return: The LogRecord.
+        """
+
+        if indent:
+            msg, args = "%s%s", (" " * indent, message)
+        else:
+            msg, args = message, None
+
+        return self.logger.makeRecord(self.logger.name, self.level, filename,
+                                      lineno, msg, args, None, functionname,
+                                      {"pylg_span": spanids})
+
+    def handle(self, record):
+
+        """ Pass a LogRecord to the logger's handlers.
+        """
+
+        self.logger.handle(record)
@@ -0,0 +1,457 @@
+# -----------------------------------------------------------------------------
+# PyLg: module to facilitate and automate the process of writing runtime logs.
+# Copyright (C) 2017 Wojciech Kozlowski <wk@wojciechkozlowski.eu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+
+""" Rebuild per-request timelines from the span column of a PyLg log.
+
+    Usage:
+
+        python -m pylg.timeline LOG [--trace ID] [--json]
+                                    [--sort KEY] [--limit N]
+                                    [--idle SECONDS] [--jobs N]
+
+    The log must have been written with TRACE_SPANS. Prints the
+    duration, number of spans and threads and the critical path of
+    every trace. The critical path is the chain of spans the end of the
+    trace waited on: work done in parallel with it did not delay the
+    trace. --trace prints the timeline of a single trace, with the
+    spans on its critical path marked by '*'.
+"""
+
+from collections import OrderedDict
+import argparse
+import json
+import sys
+import re
+
+from .parser import parse_file
+
+ENTRY = "-> ENTRY"
+EXIT = "<- EXIT"
+
+# -----------------------------------------------------------------------------
+# The EXIT record of a call that raised, see TraceFunction.trace_exception.
+# -----------------------------------------------------------------------------
+RAISED = re.compile(r"<- EXIT (\[[^\]]*\] )?: \w+ RAISED( |$)")
+
+
+class SpanInfo(object):
+
+    """ A span of a trace, i.e. a single traced call. Times are
+        datetimes while the trace is read and seconds from the start
+        of the trace once it is finished.
+    """
+
+    def __init__(self, span_id, parent_id, name, thread, start):
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.thread = thread
+        self.start = start
+        self.end = None
+        self.last = start
+        self.raised = False
+        self.critical = 0.0
+        self.children = []
+        self.events = []
+
+    def as_dict(self):
+        return {"span": self.span_id,
+                "function": self.name,
+                "thread": self.thread,
+                "start": self.start,
+                "duration": self.end - self.start,
+                "critical": self.critical,
+                "raised": self.raised,
+                "events": [{"time": time, "message": message}
+                           for time, message in self.events],
+                "children": [child.as_dict() for child in self.children]}
+
+
+class TraceState(object):
+
+    """ A trace that is still being read.
+    """
+
+    def __init__(self, trace_id, detailed):
+        self.trace_id = trace_id
+        self.detailed = detailed
+        self.spans = OrderedDict()
+        self.open = 0
+        self.first = None
+        self.last = None
+
+        # ---------------------------------------------------------------------
+        # Records logged in the trace outside of any traced call.
+        # ---------------------------------------------------------------------
+        self.events = []
+
+
+class TraceSummary(object):
+
+    """ The totals of a finished trace.
+    """
+
+    def __init__(self, trace_id, start, duration, spans, threads, raised,
+                 critical):
+        self.trace_id = trace_id
+        self.start = start
+        self.duration = duration
+        self.spans = spans
+        self.threads = threads
+        self.raised = raised
+
+        # ---------------------------------------------------------------------
+        # The time on the critical path per function as a list of
+        # (function, seconds), longest first.
+        # ---------------------------------------------------------------------
+        self.critical = critical
+
+    def as_dict(self):
+        return {"trace": self.trace_id,
+                "start": str(self.start),
+                "duration": self.duration,
+                "spans": self.spans,
+                "threads": self.threads,
+                "raised": self.raised,
+                "critical_path": [{"function": name, "time": time}
+                                  for name, time in self.critical]}
+
+
+def critical_path(span, end):
+
+    """ Work out the critical path below a span. Starting from the end
+        of the span, the child that ended last is on the critical path,
+        then the child that ended last before that one started, and so
+        on. The time in between is spent in the span itself. The time
+        every span contributes is added to its critical attribute.
+
+        :param SpanInfo span: A span of a finished trace.
+        :param float end: The time the critical path leaves the span.
+    """
+
+    cursor = end
+    for child in sorted(span.children, key=lambda child: child.end,
+                        reverse=True):
+
+        if child.start >= cursor:
+            continue
+
+        child_end = min(child.end, cursor)
+        span.critical += cursor - child_end
+        critical_path(child, child_end)
+        cursor = child.start
+
+    if cursor > span.start:
+        span.critical += cursor - span.start
+
+
+class Timelines(object):
+
+    """ Rebuilds the traces of a log. A trace is finished once none of
+        its spans has been open for idle seconds of log time, so only
+        the traces in progress are kept in memory and logs of any size
+        can be streamed through it. Only the detailed traces keep
+        their spans and messages once they are finished.
+    """
+
+    def __init__(self, detailed=(), idle=10.0):
+
+        """ Constructor for Timelines.
+
+            :param detailed: The ids of the traces to keep in full.
+            :param float idle: The seconds of log time after which a
+                               trace with no open spans is finished.
+        """
+
+        self.detailed = set(detailed)
+        self.idle = idle
+
+        self.active = {}
+
+        # ---------------------------------------------------------------------
+        # The traces with no open spans, in the order they became
+        # idle.
+        # ---------------------------------------------------------------------
+        self.waiting = OrderedDict()
+
+        self.summaries = []
+
+        # ---------------------------------------------------------------------
+        # The root spans of the finished detailed traces keyed by
+        # trace id.
+        # ---------------------------------------------------------------------
+        self.roots = {}
+
+    def add(self, record):
+
+        """ Process a single Record.
+        """
+
+        if record.time is None or record.trace is None:
+            return
+
+        self.expire(record.time)
+
+        state = self.active.get(record.trace)
+        if state is None:
+            state = self.active[record.trace] = TraceState(
+                record.trace, record.trace in self.detailed)
+            state.first = record.time
+
+        state.last = record.time
+        message = record.message
+
+        if record.span is None:
+            if state.detailed:
+                state.events.append((record.time, message))
+            return
+
+        span = state.spans.get(record.span)
+        if span is None:
+            # -----------------------------------------------------------------
+            # A span without an ENTRY record was already in progress
+            # when the log started.
+            # -----------------------------------------------------------------
+            span = SpanInfo(record.span, record.parent, record.function,
+                            record.thread, record.time)
+            state.spans[record.span] = span
+            state.open += 1
+            self.waiting.pop(record.trace, None)
+
+        span.last = record.time
+
+        if message.startswith(EXIT):
+            span.end = record.time
+            span.raised = RAISED.match(message) is not None
+            state.open -= 1
+            if not state.open:
+                self.waiting[record.trace] = state
+
+        elif state.detailed and not message.startswith(ENTRY):
+            span.events.append((record.time, message))
+
+    def expire(self, now):
+
+        """ Finish the traces that have been idle for long enough.
+        """
+
+        while self.waiting:
+            trace_id, state = next(iter(self.waiting.items()))
+            if (now - state.last).total_seconds() < self.idle:
+                break
+
+            del self.waiting[trace_id]
+            self.finish(state)
+
+    def close(self):
+
+        """ Finish all the traces once the whole log has been read.
+            Spans that never exited end at their last record.
+        """
+
+        for state in list(self.active.values()):
+            self.finish(state)
+
+        self.waiting.clear()
+
+    def finish(self, state):
+
+        """ Build the span tree of a trace, work out its critical path
+            and summarise it.
+        """
+
+        del self.active[state.trace_id]
+
+        t0 = state.first
+
+        def seconds(time):
+            return (time - t0).total_seconds()
+
+        # ---------------------------------------------------------------------
+        # The spans whose parent is not in the log, because it was
+        # filtered or is in another process, hang from a root that
+        # covers the whole trace.
+        # ---------------------------------------------------------------------
+        root = SpanInfo(None, None, None, None, 0.0)
+        root.end = seconds(state.last)
+
+        for span in state.spans.values():
+            span.start = seconds(span.start)
+            span.end = seconds(span.end if span.end is not None
+                               else span.last)
+            span.events = [(seconds(time), message)
+                           for time, message in span.events]
+
+            parent = state.spans.get(span.parent_id, root)
+            parent.children.append(span)
+
+        root.events = [(seconds(time), message)
+                       for time, message in state.events]
+
+        critical_path(root, root.end)
+
+        critical = {}
+        for span in state.spans.values():
+            if span.critical > 0:
+                critical[span.name] = (critical.get(span.name, 0.0) +
+                                       span.critical)
+
+        threads = set(span.thread for span in state.spans.values()
+                      if span.thread is not None)
+
+        self.summaries.append(TraceSummary(
+            state.trace_id, t0, root.end, len(state.spans), len(threads),
+            any(span.raised for span in state.spans.values()),
+            sorted(critical.items(), key=lambda item: item[1],
+                   reverse=True)))
+
+        if state.detailed:
+            self.roots[state.trace_id] = root
+
+
+def build(filename, timelines=None, jobs=1):
+
+    """ Stream a log file into Timelines.
+
+        :param str filename: The log file name.
+        :param timelines: The Timelines to add to, new ones if None.
+        :param int jobs: The number of processes parsing the log, see
+                         parse_file.
+        :return: The Timelines with all the traces finished.
+    """
+
+    if timelines is None:
+        timelines = Timelines()
+
+    for record in parse_file(filename, jobs, TRACE_SPANS=True):
+        timelines.add(record)
+
+    timelines.close()
+    return timelines
+
+
+def print_timeline(root, summary, out=sys.stdout):
+
+    """ Print the timeline of a detailed trace, one line per span and
+        message in the order they started.
+    """
+
+    out.write("trace {}: {:.6f} s, {} spans, {} threads\n".format(
+        summary.trace_id, summary.duration, summary.spans, summary.threads))
+    out.write("   {:>12} {:>14}  {:12}  {}\n".format(
+        "offset (s)", "duration (s)", "thread", "function"))
+
+    # -------------------------------------------------------------------------
+    # The messages of a span are sorted with its children so that they
+    # appear between the calls it made.
+    # -------------------------------------------------------------------------
+    def ordered(span, depth):
+
+        entries = [(time, None, message) for time, message in span.events]
+        entries += [(child.start, child, None) for child in span.children]
+        entries.sort(key=lambda entry: (entry[0], entry[1] is None))
+
+        for time, child, message in entries:
+            if child is None:
+                out.write("   {:12.6f} {:>14}  {:12}  {}{}\n".format(
+                    time, "", "", "  " * depth, message.split("\n", 1)[0]))
+                continue
+
+            mark = "*" if child.critical > 0 else " "
+            name = child.name + (" RAISED" if child.raised else "")
+            out.write(" {} {:12.6f} {:14.6f}  {:12.12}  {}{}\n".format(
+                mark, child.start, child.end - child.start,
+                child.thread or "", "  " * depth, name))
+            ordered(child, depth + 1)
+
+    ordered(root, 0)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        prog="python -m pylg.timeline",
+        description="Rebuild per-request timelines from a PyLg log written "
+                    "with TRACE_SPANS.")
+    parser.add_argument("log", help="the PyLg log file")
+    parser.add_argument("--trace", metavar="ID", action="append", default=[],
+                        help="print the timeline of this trace (can be "
+                             "repeated)")
+    parser.add_argument("--json", action="store_true",
+                        help="print the traces as JSON")
+    parser.add_argument("--sort", default="duration",
+                        choices=["duration", "start", "spans"],
+                        help="the column to sort the table by")
+    parser.add_argument("--limit", type=int, default=0,
+                        help="only print the top LIMIT traces")
+    parser.add_argument("--idle", type=float, default=10.0,
+                        help="seconds of log time after which a trace with "
+                             "no open spans is finished (default: 10)")
+    parser.add_argument("--jobs", type=int, default=0,
+                        help="the number of processes parsing the log, "
+                             "0 for one per CPU (default: 0)")
+    args = parser.parse_args(argv)
+
+    timelines = build(args.log, Timelines(args.trace, args.idle), args.jobs)
+    summaries = timelines.summaries
+
+    if args.trace:
+        summaries = [summary for summary in summaries
+                     if summary.trace_id in timelines.roots]
+
+        if args.json:
+            trees = [timelines.roots[summary.trace_id].as_dict()
+                     for summary in summaries]
+            json.dump([dict(summary.as_dict(), events=tree["events"],
+                            tree=tree["children"])
+                       for summary, tree in zip(summaries, trees)],
+                      sys.stdout, indent=2)
+            print()
+            return
+
+        for summary in summaries:
+            print_timeline(timelines.roots[summary.trace_id], summary)
+            print()
+        return
+
+    summaries = sorted(summaries, key=lambda summary:
+                       getattr(summary, args.sort),
+                       reverse=args.sort != "start")
+    if args.limit:
+        summaries = summaries[:args.limit]
+
+    if args.json:
+        json.dump([summary.as_dict() for summary in summaries], sys.stdout,
+                  indent=2)
+        print()
+        return
+
+    print("{:16} {:26} {:>14} {:>6} {:>7}  {}".format(
+        "trace", "start", "duration (s)", "spans", "threads",
+        "critical path (s)"))
+    for summary in summaries:
+        path = ", ".join("{} {:.6f}".format(name, time)
+                         for name, time in summary.critical[:3])
+        print("{:16} {:26} {:14.6f} {:6d} {:7d}  {}".format(
+            summary.trace_id + ("!" if summary.raised else ""),
+            str(summary.start), summary.duration, summary.spans,
+            summary.threads, path))
+
+
+if __name__ == "__main__":
+    main()